@@ -0,0 +1,360 @@
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import interactions
+from sqlalchemy import delete, insert, select, update
+
+from bridge_discord import datastore
+from bridge_discord.datastore import fetch
+from bridge_discord.extensions import profile, tournament
+
+parser = argparse.ArgumentParser(description='time the bot hot paths against a synthetic SQLite dataset.')
+parser.add_argument('--members', default=20000, type=int, help='guild members for sync_member_list')
+parser.add_argument('--challenges', default=5000, type=int, help='friend challenges stored and rated')
+parser.add_argument('--entrants', default=200, type=int, help='tournament entrants for info and start')
+parser.add_argument('--teams', default=20, type=int, required=False)
+parser.add_argument(
+    '--quadrature-results', default=20, type=int, help='results rated by the quadrature reference, which is slow')
+parser.add_argument('--page-boards', default=2000, type=int, help='boards on the page given to the parser')
+parser.add_argument('--repeat', default=5, type=int, required=False)
+parser.add_argument('--seed', default=0, type=int, required=False)
+parser.add_argument('--output', default=None, type=str, help='write the results as JSON to this file')
+parser.add_argument('--baseline', default=None, type=open, help='JSON results of an earlier run to compare against')
+parser.add_argument(
+    '--threshold', default=0.25, type=float, help='allowed slowdown of a median against the baseline, 0.25 = 25%%')
+
+
+class FakeGuild:
+    def __init__(self, member_ids):
+        self.member_ids = member_ids
+
+    async def get_members(self):
+        for member_id in self.member_ids:
+            yield interactions.Member(user=interactions.User(id=member_id))
+
+
+class FakeClient(interactions.Client):
+    # A client that never connects: extensions are loaded as usual and the guild is served from memory.
+    def __init__(self, member_ids):
+        super().__init__(token="benchmark")
+        self.fake_guild = FakeGuild(member_ids)
+
+    @property
+    def guilds(self):
+        return [self.fake_guild]
+
+
+class FakeContext:
+    user = interactions.User(id=1)
+
+    async def send(self, *args, **kwargs):
+        pass
+
+    async def defer(self, *args, **kwargs):
+        pass
+
+
+def challenge_page(number_of_boards, rng):
+    rows = "".join(
+        f'<tr class="{"odd" if number % 2 else "even"}"><td>{number}</td>'
+        f'<td><a href="https://www.bridgebase.com/tools/handviewer.html?lin={number}h">3NT</a></td>'
+        f'<td>{rng.choice((-100, 400, 430, 600))}</td><td>{rng.randint(0, 12)}</td><td>{rng.randint(0, 12)}</td>'
+        f'<td><a href="https://www.bridgebase.com/tools/handviewer.html?lin={number}v">4S</a></td>'
+        f'<td>{rng.choice((-50, 420, 450, 620))}</td></tr>'
+        for number in range(1, number_of_boards + 1)
+    )
+    return (
+        '<html><body><table class="handrecords">'
+        '<tr><td class="username">hero</td><td class="final_score">(IMPs)</td><td class="username">villain</td></tr>'
+        f'{rows}</table></body></html>'
+    )
+
+
+async def page_chunks(page, chunk_size=fetch.CHUNK_SIZE):
+    # The page as the streaming fetch path hands it to the parser.
+    for start in range(0, len(page), chunk_size):
+        yield page[start:start + chunk_size]
+
+
+def populate(session, args, rng):
+    players = [f"player{ix}" for ix in range(max(args.entrants, 2 * args.teams))]
+    session.execute(insert(datastore.BBOProfile.__table__), [
+        dict(bbo_user=player, mmr_m=rng.gauss(1200.0, 200.0), mmr_s=rng.uniform(50.0, 400.0)) for player in players
+    ])
+    session.execute(insert(datastore.ServerProfile.__table__), [
+        dict(discord_user=ix + 1) for ix in range(len(players))
+    ])
+    session.execute(insert(datastore.BBOMain.__table__), [
+        dict(bbo_user=player, discord_user=ix + 1) for ix, player in enumerate(players)
+    ])
+
+    started = datetime.datetime(2022, 1, 1)
+    challenges, boards = [], []
+    for match_id in range(1, args.challenges + 1):
+        hero, villain = rng.sample(players, 2)
+        challenge_boards = [
+            dict(match_id=match_id, number=number, hero_matchscore=rng.randint(0, 12),
+                 villain_matchscore=rng.randint(0, 12))
+            for number in range(1, 8)
+        ]
+        hero_total, villain_total, board_count = datastore.challenge.BBOChallengeParser.totals(
+            challenge_boards, dict.get)
+        challenges.append(dict(
+            match_id=match_id, hero=hero, villain=villain, scoring_method=datastore.ScoringMethod.IMPS,
+            created_at=started + datetime.timedelta(minutes=match_id),
+            hero_total=hero_total, villain_total=villain_total, board_count=board_count))
+        boards.extend(challenge_boards)
+    if challenges:
+        session.execute(insert(datastore.FriendChallenge.__table__), challenges)
+        session.execute(insert(datastore.FriendChallengeBoard.__table__), boards)
+
+    tournament_model = datastore.TeamRRTournament(
+        tournament_name="benchmark", state=datastore.TournamentState.SIGNUP, number_of_teams=args.teams)
+    session.add(tournament_model)
+    session.flush()
+    session.execute(insert(datastore.TeamRREntry.__table__), [
+        dict(tournament_id=tournament_model.tournament_id, bbo_user=player) for player in players[:args.entrants]
+    ])
+    session.commit()
+    return tournament_model.tournament_id, challenges
+
+
+def hold_write_lock(path, ready, release):
+    # Runs in another process: takes the database's write lock and keeps it until release is set.
+    connection = datastore.basic.create_datastore_engine(path).raw_connection()
+    connection.isolation_level = None
+    cursor = connection.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("UPDATE bbo_profile SET mmr_m = mmr_m")
+    ready.set()
+    release.wait(600)
+    cursor.execute("COMMIT")
+    connection.close()
+
+
+def timed_during_write(path, repeat, fn):
+    # timed(), while a second process holds a write transaction open on the same database.
+    context = multiprocessing.get_context("spawn")
+    ready, release = context.Event(), context.Event()
+    writer = context.Process(target=hold_write_lock, args=(path, ready, release))
+    writer.start()
+    try:
+        if not ready.wait(60):
+            raise RuntimeError("The writer process did not take the write lock.")
+        return timed(repeat, fn)
+    finally:
+        release.set()
+        writer.join()
+
+
+def timed(repeat, fn, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return dict(median=statistics.median(timings), min=min(timings), repeat=repeat)
+
+
+def quadrature_update(mu, sigma, opponent_mu, opponent_sigma, win):
+    # The update BBOProfile.update_mmr made before datastore.rating, kept as the reference update_ratings is checked
+    # and timed against: the posterior mean and standard deviation by numerical integration. Two precedence bugs of
+    # the original are fixed: the win branch is normalized, and the opponent's sigma is squared in the normalizer.
+    # It also integrates over mu +- 12 sigma rather than the whole real line, where quad misses a narrow prior far
+    # from zero; the prior's tails beyond that no longer register in double precision.
+    import functools
+
+    from scipy import integrate, stats
+
+    normalizer = stats.norm.cdf(
+        0, opponent_mu - mu if win else mu - opponent_mu, (sigma * sigma + opponent_sigma * opponent_sigma) ** 0.5)
+
+    def integrand(r, moment):
+        other_cdf = stats.norm.cdf(r, opponent_mu, opponent_sigma)
+        return r ** moment * stats.norm.pdf(r, mu, sigma) * (other_cdf if win else 1.0 - other_cdf) / normalizer
+
+    def moment(power):
+        return integrate.quad(
+            functools.partial(integrand, moment=power), mu - 12.0 * sigma, mu + 12.0 * sigma,
+            epsabs=0.0, epsrel=1e-13, limit=200)[0]
+
+    new_mu = moment(1)
+    m2 = moment(2)
+    return new_mu, (m2 - new_mu * new_mu) ** 0.5
+
+
+def balance_quality(ratings, teams, number_of_teams, conflicts):
+    # How even an assignment is: the spread of team mean ratings, the objective variance_balance minimizes and the
+    # conflict pairs left on one team.
+    import numpy as np
+
+    from bridge_discord.datastore import balancing
+
+    ratings = np.asarray(ratings, dtype=float)
+    mu, variance = ratings[:, 0], ratings[:, 1] ** 2
+    sizes = np.maximum(np.bincount(teams, minlength=number_of_teams), 1).astype(float)
+    violated, objective = balancing._score(
+        mu, variance, teams, sizes, balancing._conflict_matrix(len(mu), conflicts))
+    means = np.bincount(teams, weights=mu, minlength=number_of_teams) / sizes
+    return dict(team_mean_spread=float(means.std()), objective=float(objective), violated_conflicts=int(violated))
+
+
+def run_benchmarks(args):
+    rng = random.Random(args.seed)
+    db_path = os.path.join(tempfile.mkdtemp(prefix="bridge_discord_bench"), "bench.db")
+    datastore.setup_connection({"path": db_path})
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    client = FakeClient(list(range(10 ** 6, 10 ** 6 + args.members)))
+    profile_extension = profile.ProfileExtension(client)
+    tournament_extension = tournament.TeamRRManagerExtension(client)
+    with datastore.Session() as session:
+        tournament_id, challenges = populate(session, args, rng)
+    page = challenge_page(args.page_boards, rng)
+    results = {}
+
+    def reset_members():
+        with datastore.Session() as session:
+            session.execute(delete(datastore.ServerProfile.__table__).where(
+                datastore.ServerProfile.discord_user >= 10 ** 6))
+            session.commit()
+
+    results["sync_member_list"] = timed(
+        args.repeat, lambda: loop.run_until_complete(profile_extension.sync_member_list()), reset_members)
+    results["info"] = timed(
+        args.repeat, lambda: loop.run_until_complete(
+            tournament_extension.info.coro(tournament_extension, FakeContext())))
+
+    def reset_tournament():
+        with datastore.Session() as session:
+            session.execute(
+                update(datastore.TeamRRTournament.__table__)
+                .where(datastore.TeamRRTournament.tournament_id == tournament_id)
+                .values(state=datastore.TournamentState.SIGNUP.name)
+            )
+            datastore.tournament_cache.touch(session)
+            session.commit()
+
+    with datastore.Session() as session:
+        entrant_ratings = session.execute(
+            select(datastore.BBOProfile.mmr_m, datastore.BBOProfile.mmr_s)
+            .join(datastore.TeamRREntry, datastore.TeamRREntry.bbo_user == datastore.BBOProfile.bbo_user)
+            .order_by(datastore.BBOProfile.bbo_user)
+        ).all()
+    # A representative conflict for roughly one entrant in ten, from a generator of its own like page_1k below.
+    conflict_rng = random.Random(args.seed)
+    conflicts = [
+        tuple(conflict_rng.sample(range(len(entrant_ratings)), 2)) for _ in range(len(entrant_ratings) // 10)]
+    for name, balancer in datastore.BALANCERS.items():
+        teams = balancer(entrant_ratings, args.teams, conflicts, rng=random.Random(args.seed))
+        results[f"balance_{name}"] = dict(
+            timed(args.repeat, lambda: balancer(entrant_ratings, args.teams, conflicts, rng=random.Random(args.seed))),
+            **balance_quality(entrant_ratings, teams, args.teams, conflicts))
+
+    results["start"] = timed(
+        args.repeat, lambda: loop.run_until_complete(
+            tournament_extension.start.coro(tournament_extension, FakeContext())), reset_tournament)
+    results["parse_challenge_page"] = timed(args.repeat, lambda: datastore.FriendChallenge.init_from_html(page))
+    # A fixed 1000-board page from its own generator, so the datasets above do not depend on it.
+    page_1k = challenge_page(1000, random.Random(args.seed))
+    results["parse_1k_boards"] = timed(args.repeat, lambda: datastore.FriendChallenge.init_from_html(page_1k))
+    results["parse_1k_boards_streamed"] = timed(args.repeat, lambda: loop.run_until_complete(
+        datastore.FriendChallenge.async_init_from_chunks(page_chunks(page_1k))))
+
+    def read_leaderboard():
+        with datastore.Session() as session:
+            session.execute(
+                select(datastore.BBOProfile.bbo_user)
+                .order_by(datastore.BBOProfile.conservative_mmr_estimate.desc())
+                .limit(100)
+            ).all()
+
+    # WAL lets readers in this process carry on while another process is writing; the two should be close.
+    results["read_idle"] = timed(args.repeat, read_leaderboard)
+    results["read_during_write"] = timed_during_write(db_path, args.repeat, read_leaderboard)
+
+    with datastore.Session() as session:
+        profiles = {
+            profile_model.bbo_user: profile_model
+            for profile_model in session.execute(select(datastore.BBOProfile)).scalars()
+        }
+
+        def rate_challenges():
+            for challenge in challenges:
+                hero, villain = profiles[challenge["hero"]], profiles[challenge["villain"]]
+                hero_win = rng.random() < 0.5
+                hero_before = datastore.BBOProfile(mmr_m=hero.mmr_m, mmr_s=hero.mmr_s)
+                hero.update_mmr(villain, hero_win)
+                villain.update_mmr(hero_before, not hero_win)
+            session.flush()
+
+        results["update_mmr"] = timed(args.repeat, rate_challenges, session.rollback)
+        ratings = [(profile_model.mmr_m, profile_model.mmr_s) for profile_model in profiles.values()]
+        opponents, wins = ratings[1:] + ratings[:1], [rng.random() < 0.5 for _ in ratings]
+        results["update_ratings"] = timed(
+            args.repeat, lambda: datastore.rating.update_ratings(ratings, opponents, wins))
+        # The same results rated one at a time by the quadrature reference, and in one batch by update_ratings.
+        reference = list(zip(ratings, opponents, wins))[:args.quadrature_results]
+        results["update_ratings_quadrature"] = timed(args.repeat, lambda: [
+            quadrature_update(mu, sigma, opponent_mu, opponent_sigma, win)
+            for (mu, sigma), (opponent_mu, opponent_sigma), win in reference])
+        results["update_ratings_quadrature_batch"] = timed(args.repeat, lambda: datastore.rating.update_ratings(
+            [rating for rating, _, _ in reference], [opponent for _, opponent, _ in reference],
+            [win for _, _, win in reference]))
+        results["replay_mmr"] = timed(args.repeat, lambda: datastore.replay_mmr(session), session.rollback)
+        results["rebuild_stats"] = timed(args.repeat, lambda: datastore.rebuild_stats(session), session.rollback)
+    loop.close()
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name in baseline:
+            ratio = result["median"] / baseline[name]["median"]
+            print(f"{name:24} {result['median'] * 1000:10.1f}ms  baseline {baseline[name]['median'] * 1000:10.1f}ms"
+                  f"  {ratio:5.2f}x{'  REGRESSION' if ratio > 1.0 + threshold else ''}")
+            if ratio > 1.0 + threshold:
+                regressions.append(name)
+        else:
+            print(f"{name:24} {result['median'] * 1000:10.1f}ms  (no baseline)")
+    return regressions
+
+
+def benchmark_main(args):
+    results = run_benchmarks(args)
+    report = dict(
+        parameters={key: getattr(args, key) for key in (
+            "members", "challenges", "entrants", "teams", "page_boards", "repeat", "seed")},
+        python=platform.python_version(),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if not args.baseline:
+        print(json.dumps(report, indent=2))
+        return 0
+
+    baseline = json.load(args.baseline)
+    if baseline.get("parameters") != report["parameters"]:
+        print("Baseline was recorded with different parameters, timings are not comparable.")
+        return 2
+    regressions = compare(results, baseline["results"], args.threshold)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(benchmark_main(parser.parse_args()))
@@ -1,6 +1,43 @@
 # noqa: F401
-from .basic import Session, setup_connection
+import importlib
 
-from .profile import BBOMain, BBOProfile, BBORepresentative, ServerProfile
-from .tournament import TournamentState, TeamRRTournament, TeamRREntry
-from .challenge import FriendChallenge, FriendChallengeBoard, ScoringMethod
+from .basic import AsyncSession, DatastoreVersion, Session, VersionPoller, run_sync, setup_connection
+
+# Everything else is imported from its submodule on first access, so a bot only pays for the modules (and the
+# numpy or scipy imports behind them) that it actually uses. setup_connection imports every module that
+# defines tables.
+_LAZY_ATTRIBUTES = {
+    "profile": (
+        "BBOMain", "BBOProfile", "BBORepresentative", "ServerProfile", "Identity", "IdentityCache", "identities"),
+    "tournament": ("TournamentState", "TeamRRTournament", "TeamRREntry", "ActiveTournamentCache", "tournament_cache"),
+    "challenge": ("FriendChallenge", "FriendChallengeBoard", "ScoringMethod"),
+    "replay": ("MMRCheckpoint", "MMRCheckpointRating", "replay_mmr"),
+    "matchlink": ("MatchlinkCacheEntry", "normalize_matchlink", "resolve_matchlink"),
+    "ingest": ("IngestReport", "ParsePool", "extract_matchlinks", "ingest_matchlinks", "parse_pool"),
+    "standings": (
+        "TeamRRMatch", "TeamRRSegment", "TeamRRStanding", "create_schedule", "get_standings",
+        "record_active_segment", "record_segment", "round_robin_schedule", "update_segment", "victory_points",
+    ),
+    "leaderboard": ("Leaderboard", "rankings"),
+    "balancing": ("BALANCERS", "pot_balance", "variance_balance"),
+    "members": ("MemberWriteBuffer", "pending_members"),
+    "stats": ("HeadToHeadStats", "PlayerStats", "get_stats", "rebuild_stats", "record_challenge_stats"),
+    "jobs": ("IngestJob", "IngestionQueue", "PendingJob", "ingest_one"),
+}
+_MODULE_BY_ATTRIBUTE = {
+    attribute: module_name for module_name, attributes in _LAZY_ATTRIBUTES.items() for attribute in attributes}
+_SUBMODULES = frozenset(("rating", "fetch", "migrations", *_LAZY_ATTRIBUTES))
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    if name not in _MODULE_BY_ATTRIBUTE:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_MODULE_BY_ATTRIBUTE[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted({*globals(), *_SUBMODULES, *_MODULE_BY_ATTRIBUTE})
@@ -0,0 +1,161 @@
+import random
+
+from boltons.iterutils import chunked
+
+# numpy is imported inside the functions, so listing BALANCERS (e.g. for command choices) stays cheap.
+
+# Weight of the spread in team rating uncertainty relative to the spread in team mean rating.
+UNCERTAINTY_WEIGHT = 0.25
+
+
+def pot_balance(ratings, number_of_teams, conflicts=(), rng=None):
+    # Players are ranked by conservative estimate, split into pots of number_of_teams and shuffled within each pot.
+    # This is the original method and does not look at conflicts.
+    import numpy as np
+
+    rng = rng or random.Random()
+    ratings = np.asarray(ratings, dtype=float).reshape(-1, 2)
+    order = np.argsort(-(ratings[:, 0] - 3.0 * ratings[:, 1]), kind='stable').tolist()
+    teams = np.empty(len(order), dtype=int)
+    for pot in chunked(order, number_of_teams):
+        rng.shuffle(pot)
+        for ix, player in enumerate(pot):
+            teams[player] = ix
+    return teams
+
+
+def _conflict_matrix(number_of_players, conflicts):
+    import numpy as np
+
+    matrix = np.zeros((number_of_players, number_of_players))
+    for i, j in conflicts:
+        if i != j:
+            matrix[i, j] = matrix[j, i] = 1.0
+    return matrix
+
+
+def _greedy(mu, variance, number_of_teams, conflict_matrix):
+    # Strongest players first, the more certain of equal ratings first, each to the team with room that has the
+    # fewest conflicts, then the lowest total rating, then the lowest total variance.
+    import numpy as np
+
+    capacity = np.full(number_of_teams, len(mu) // number_of_teams)
+    capacity[:len(mu) % number_of_teams] += 1
+    totals, variance_totals = np.zeros(number_of_teams), np.zeros(number_of_teams)
+    team_conflicts = np.zeros((len(mu), number_of_teams))
+    teams = np.empty(len(mu), dtype=int)
+    for player in np.lexsort((variance, -mu)):
+        candidates = np.flatnonzero(capacity > 0)
+        team = candidates[np.lexsort(
+            (variance_totals[candidates], totals[candidates], team_conflicts[player, candidates]))[0]]
+        teams[player] = team
+        capacity[team] -= 1
+        totals[team] += mu[player]
+        variance_totals[team] += variance[player]
+        team_conflicts[:, team] += conflict_matrix[:, player]
+    return teams
+
+
+def _spread(team_values):
+    return team_values.var()
+
+
+def _spread_after_swap(team_values, a, b, new_a, new_b):
+    # Variance over teams when only teams a and b (index matrices) change to new_a and new_b.
+    number_of_teams = len(team_values)
+    total = team_values.sum() - team_values[a] - team_values[b] + new_a + new_b
+    total_sq = (team_values * team_values).sum() - team_values[a] ** 2 - team_values[b] ** 2 + new_a ** 2 + new_b ** 2
+    return total_sq / number_of_teams - (total / number_of_teams) ** 2
+
+
+def _score(mu, variance, teams, sizes, conflict_matrix):
+    # (violated conflict pairs, objective) of an assignment, compared as a tuple.
+    import numpy as np
+
+    one_hot = np.eye(len(sizes))[teams]
+    same_team = one_hot @ one_hot.T
+    means, deviations = (mu @ one_hot) / sizes, np.sqrt(variance @ one_hot) / sizes
+    return (conflict_matrix * same_team).sum() / 2, _spread(means) + UNCERTAINTY_WEIGHT * _spread(deviations)
+
+
+def _swapped(teams, swaps):
+    teams = teams.copy()
+    for i, j in swaps:
+        teams[i], teams[j] = teams[j], teams[i]
+    return teams
+
+
+def variance_balance(ratings, number_of_teams, conflicts=(), rng=None, max_rounds=1000, tolerance=1e-3):
+    # Minimizes the variance of team mean rating plus UNCERTAINTY_WEIGHT times the variance of the standard deviation
+    # of each team mean, keeping the players in each `conflicts` pair on different teams where possible.
+    # A greedy assignment is refined with improving pairwise swaps, evaluated for all pairs at once. Each round
+    # applies the best swap of every disjoint pair of teams, falling back to the single best swap when the batch
+    # does worse, and stops when no swap gains more than tolerance (in squared rating points).
+    import numpy as np
+
+    ratings = np.asarray(ratings, dtype=float).reshape(-1, 2)
+    mu, variance = ratings[:, 0], ratings[:, 1] ** 2
+    number_of_players = len(mu)
+    if number_of_players == 0:
+        return np.empty(0, dtype=int)
+    conflict_matrix = _conflict_matrix(number_of_players, conflicts)
+    teams = _greedy(mu, variance, number_of_teams, conflict_matrix)
+    sizes = np.maximum(np.bincount(teams, minlength=number_of_teams), 1).astype(float)
+    mu_diff = mu[None, :] - mu[:, None]
+    variance_diff = variance[None, :] - variance[:, None]
+    players = np.arange(number_of_players)
+
+    for _ in range(max_rounds):
+        one_hot = np.eye(number_of_teams)[teams]
+        mu_sums, variance_sums = mu @ one_hot, variance @ one_hot
+        means, deviations = mu_sums / sizes, np.sqrt(variance_sums) / sizes
+        a, b = np.meshgrid(teams, teams, indexing='ij')
+
+        # Swapping i (team a) with j (team b): conflicts i gains on b and j gains on a, minus those they leave.
+        team_conflicts = conflict_matrix @ one_hot
+        gained = team_conflicts[:, teams] - conflict_matrix
+        own = team_conflicts[players, teams]
+        conflict_delta = gained + gained.T - own[:, None] - own[None, :]
+
+        objective_delta = (
+            _spread_after_swap(
+                means, a, b, (mu_sums[a] + mu_diff) / sizes[a], (mu_sums[b] - mu_diff) / sizes[b]) +
+            UNCERTAINTY_WEIGHT * _spread_after_swap(
+                deviations, a, b,
+                np.sqrt(np.maximum(variance_sums[a] + variance_diff, 0.0)) / sizes[a],
+                np.sqrt(np.maximum(variance_sums[b] - variance_diff, 0.0)) / sizes[b]) -
+            _spread(means) - UNCERTAINTY_WEIGHT * _spread(deviations)
+        )
+
+        valid = np.triu(a != b)
+        if (conflict_delta[valid] < 0).any():
+            valid &= conflict_delta < 0
+            delta = conflict_delta
+        else:
+            valid &= (conflict_delta == 0) & (objective_delta < -tolerance)
+            delta = objective_delta
+        candidates = np.flatnonzero(valid)
+        if not len(candidates):
+            break
+
+        swaps, touched = [], np.zeros(number_of_teams, dtype=bool)
+        for flat in candidates[np.argsort(delta.ravel()[candidates], kind='stable')]:
+            i, j = divmod(int(flat), number_of_players)
+            if not touched[teams[i]] and not touched[teams[j]]:
+                touched[teams[i]] = touched[teams[j]] = True
+                swaps.append((i, j))
+                if touched.sum() >= number_of_teams - 1:
+                    break
+        best = _swapped(teams, swaps[:1])
+        batch = _swapped(teams, swaps)
+        if _score(mu, variance, batch, sizes, conflict_matrix) < _score(mu, variance, best, sizes, conflict_matrix):
+            teams = batch
+        else:
+            teams = best
+    return teams
+
+
+BALANCERS = {
+    'pots': pot_balance,
+    'variance': variance_balance,
+}
@@ -1,23 +1,189 @@
-from sqlalchemy import create_engine, Column, DateTime
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import re
+import threading
+import time
+
+from sqlalchemy import create_engine, event, Column, DateTime, Integer, String, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.sql import func
 from sqlalchemy.orm import declarative_base, sessionmaker
 
+from bridge_discord import metrics
+
+DEFAULT_DB_PATH = "bridge_discord.db"
+# Every bot process writes to the same file: WAL lets readers proceed during a write, busy_timeout makes writers
+# queue instead of failing with "database is locked".
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "busy_timeout": 5000,
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+# How long a process may serve a cached value after another process changed it, see DatastoreVersion.
+VERSION_POLL_INTERVAL = 1.0
+
 _sessionmaker = None
+# Every database call made from the event loop goes through this single thread, so a slow commit or fsync never
+# blocks the gateway and SQLite writers are serialized within the process.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="datastore")
 Base = declarative_base()
 
 
-def setup_connection():
+def create_datastore_engine(path=DEFAULT_DB_PATH, pragmas=None, pool_size=5, max_overflow=5):
+    pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+    for name, value in pragmas.items():
+        if not (re.fullmatch(r"\w+", name) and re.fullmatch(r"\w+", str(value))):
+            raise ValueError(f"Invalid SQLite pragma: {name} = {value}")
+    engine = create_engine(
+        f"sqlite:///{path}",
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        connect_args={"timeout": pragmas["busy_timeout"] / 1000.0, "check_same_thread": False},
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    event.listen(engine, "before_cursor_execute", metrics.count_statement)
+    return engine
+
+
+def setup_connection(config=None):
+    # config is the optional "datastore" section of the keyring: {"path": ..., "pragmas": {...}, "pool_size": ...}
     global _sessionmaker
     if _sessionmaker:
         return
-    engine = create_engine("sqlite:///bridge_discord.db")
+    engine = create_datastore_engine(**(config or {}))
     _sessionmaker = sessionmaker(engine)
-    Base.metadata.create_all(engine)
+    from . import migrations
+    migrations.upgrade(engine)
 
 
 def Session():
     return _sessionmaker()
 
 
+async def run_sync(fn, *args, **kwargs):
+    # The context is carried over to the datastore thread, so statements are counted against the calling command.
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, functools.partial(contextvars.copy_context().run, fn, *args, **kwargs))
+
+
+def _run_and_commit(session, fn, *args, **kwargs):
+    result = fn(session, *args, **kwargs)
+    session.commit()
+    return result
+
+
+class AsyncSession:
+    # A Session whose I/O runs on the datastore thread. Objects it returns must be fully loaded before they are
+    # used on the event loop, so lazy loads belong inside run_sync. Writes go through run_and_commit: a write left
+    # uncommitted when its datastore call returns holds SQLite's write lock while other sessions' calls queue
+    # behind it on the same thread, and their writes then stall for the busy_timeout.
+    def __init__(self):
+        self.sync_session = Session()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await run_sync(self.sync_session.close)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_sync(fn, self.sync_session, *args, **kwargs)
+
+    async def run_and_commit(self, fn, *args, **kwargs):
+        # fn(session, *args, **kwargs) and the commit, in one datastore call; returns fn's result.
+        return await run_sync(_run_and_commit, self.sync_session, fn, *args, **kwargs)
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    async def get(self, *args, **kwargs):
+        return await run_sync(self.sync_session.get, *args, **kwargs)
+
+    async def delete(self, instance):
+        await run_sync(self.sync_session.delete, instance)
+
+    async def flush(self):
+        await run_sync(self.sync_session.flush)
+
+    async def commit(self):
+        await run_sync(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_sync(self.sync_session.rollback)
+
+
 class CreatedAtMixin:
     created_at = Column(DateTime, server_default=func.now())
+
+
+class DatastoreVersion(Base):
+    # Version stamps bumped by writers in the same transaction as their change, so caches in other bot processes
+    # notice it with one primary key lookup.
+    __tablename__ = "datastore_version"
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def get(cls, session, name):
+        return session.execute(select(cls.version).where(cls.name == name)).scalar() or 0
+
+    @classmethod
+    def bump(cls, session, name):
+        session.execute(
+            sqlite_insert(cls.__table__).values(name=name, version=1)
+            .on_conflict_do_update(index_elements=[cls.name], set_={"version": cls.version + 1})
+        )
+
+
+class VersionPoller:
+    # What an in-memory cache knows about one DatastoreVersion stamp: the version its contents were loaded under,
+    # and when the stamp was last compared. Writers in this process invalidate the cache directly; changes made by
+    # other processes are noticed at most poll_interval seconds late, at the cost of one primary key lookup.
+    def __init__(self, name, poll_interval=VERSION_POLL_INTERVAL):
+        self.name = name
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+
+    def read(self, session):
+        # Read before the cached rows are loaded, so the rows are never older than the version they are stored under.
+        return DatastoreVersion.get(session, self.name)
+
+    def poll(self, session):
+        # The stamp's new version if it moved since the last record(), or None if it did not or was compared less than
+        # poll_interval seconds ago.
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at < self.poll_interval:
+                return None
+        version = self.read(session)
+        with self._lock:
+            if version == self._version:
+                self._checked_at = now
+                return None
+        return version
+
+    def record(self, version):
+        # The cache now holds what was committed as of version.
+        with self._lock:
+            self._version, self._checked_at = version, time.monotonic()
+
+    def advance(self, version):
+        # A bump by this process, already applied to the cache, moved the stamp to version. A bump by another process
+        # since the last record() still leaves the cache behind, and the next poll() reports it.
+        with self._lock:
+            if self._version == version - 1:
+                self._version = version
@@ -1,13 +1,14 @@
+import asyncio
 import enum
 from html.parser import HTMLParser
 import re
 from urllib.parse import urlparse
 
-import requests
-from sqlalchemy import Column, ForeignKey, Enum, Integer, String, Float
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, ForeignKey, Enum, Integer, String, Float, select
+from sqlalchemy.orm import relationship, selectinload
 
 from .basic import Base, CreatedAtMixin
+from .profile import BBOProfile
 
 
 class ScoringMethod(enum.Enum):
@@ -20,8 +21,12 @@ class FriendChallenge(Base, CreatedAtMixin):
 
     match_id = Column(Integer, primary_key=True, autoincrement=True)
     scoring_method = Column(Enum(ScoringMethod))
-    hero = Column(String)
-    villain = Column(String)
+    hero = Column(String, index=True)
+    villain = Column(String, index=True)
+    # Sums over the boards, stored when the challenge is, so readers never aggregate the board table.
+    hero_total = Column(Float, nullable=False, server_default="0")
+    villain_total = Column(Float, nullable=False, server_default="0")
+    board_count = Column(Integer, nullable=False, server_default="0")
 
     boards = relationship("FriendChallengeBoard", backref="bbo_friend_challenge")
     hero_profile = relationship(
@@ -40,14 +45,34 @@ class FriendChallenge(Base, CreatedAtMixin):
     )
 
     @classmethod
-    def init_from_matchlink(cls, matchlink):
+    def get_with_profiles(cls, session, match_id):
+        return session.execute(
+            select(cls).where(cls.match_id == match_id).options(
+                selectinload(cls.boards),
+                selectinload(cls.hero_profile).selectinload(BBOProfile.discord_main),
+                selectinload(cls.villain_profile).selectinload(BBOProfile.discord_main),
+            )
+        ).scalar_one()
+
+    @staticmethod
+    def validate_matchlink(matchlink):
         parsed_url = urlparse(matchlink)
         if parsed_url.scheme != 'https' or parsed_url.netloc != 'webutil.bridgebase.com':
             raise ValueError('Matchlink is not from webutil.bridgebase.com. Refusing to parse.')
 
+    @classmethod
+    def init_from_chunks(cls, chunks):
+        parser = BBOChallengeParser()
+        return parser.finalize(list(parser.iter_boards(chunks)))
+
+    @classmethod
+    def init_from_html(cls, html):
+        return cls.init_from_chunks((html,))
+
+    @classmethod
+    async def async_init_from_chunks(cls, chunks):
         parser = BBOChallengeParser()
-        parser.feed(requests.get(matchlink).text)
-        return parser.finalize()
+        return parser.finalize([board async for board in parser.aiter_boards(chunks)])
 
 
 class FriendChallengeBoard(Base):
@@ -66,75 +91,141 @@ class FriendChallengeBoard(Base):
 
 
 class BBOChallengeParser(HTMLParser):
+    # Streaming state machine: only tags that change the parse state are tracked on the stack, together with the
+    # nesting depth at which they were opened, and completed boards are handed out as soon as their row closes.
     match_details_order = ['hero', 'scoring_method', 'villain']
     board_details_order = [
         'number',
         'hero_lin', 'hero_result', 'hero_score', 'hero_matchscore',
         'villain_matchscore', 'villain_lin', 'villain_result', 'villain_score',
     ]
+    int_fields = frozenset((0, 3, 4, 5, 8))
+    section_classes = frozenset(('odd', 'even', 'username', 'final_score'))
+    void_tags = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'wbr'))
+    board_factory = FriendChallengeBoard
 
     def __init__(self):
-        self.context_stack = []
-        self.boards = [[]]
+        self.depth = 0
+        self.state_stack = [(None, 0)]
+        self.row = []
+        self.completed_boards = []
         self.match_details = []
         self.accumulator = None
+        self.text_pieces = []
         super().__init__()
 
     @property
     def current_state(self):
-        return self.context_stack[-1] if self.context_stack else None
+        return self.state_stack[-1][0]
 
     def handle_starttag(self, tag, attrs):
-        if tag == 'hr':
+        self.flush_text()
+        if tag in self.void_tags:
             return
-        state = self.current_state
-        if state is None and any(attr == ('class', 'handrecords') for attr in attrs):
-            state = 'handrecords'
+        self.depth += 1
+        state = prev_state = self.current_state
+        if state is None:
+            if ('class', 'handrecords') in attrs:
+                state = 'handrecords'
         elif state == 'handrecords':
-            state = next(
-                (
-                    class_id
-                    for class_id in ('odd', 'even', 'username', 'final_score')
-                    if any(attr == ('class', class_id) for attr in attrs)
-                ),
-                state
-            )
-        elif state in ('odd', 'even') and tag == 'td':
+            class_id = dict(attrs).get('class')
+            if class_id in self.section_classes:
+                state = class_id
+        elif tag == 'td' and state in ('odd', 'even'):
             state = 'td'
         if state == 'td' and tag == 'a':
-            self.boards[-1].append(next(
-                (attr[1] for attr in attrs if attr[0] == 'href'), None))
-        self.context_stack.append(state)
+            self.row.append(dict(attrs).get('href'))
+        if state is not prev_state:
+            self.state_stack.append((state, self.depth))
+
+    def handle_startendtag(self, tag, attrs):
+        if tag not in self.void_tags:
+            self.handle_starttag(tag, attrs)
+            self.handle_endtag(tag)
 
     def handle_endtag(self, tag):
-        prev_state = self.context_stack.pop()
-        if prev_state == 'odd' or prev_state == 'even':
-            self.boards[-1] = FriendChallengeBoard(**{
-                k: v
-                for k, v in zip(self.board_details_order, self.boards[-1])
-            })
-            self.boards.append([])
-        elif prev_state == 'td' and tag == 'td':
-            if len(self.boards[-1]) in (0, 3, 4, 5, 8):
-                self.boards[-1].append(int(self.accumulator or '0'))
+        self.flush_text()
+        if tag in self.void_tags:
+            return
+        state, depth = self.state_stack[-1]
+        self.depth -= 1
+        if state is None or depth <= self.depth:
+            return
+        self.state_stack.pop()
+        if state == 'odd' or state == 'even':
+            self.completed_boards.append(self.board_factory(**dict(zip(self.board_details_order, self.row))))
+            self.row = []
+        elif state == 'td' and tag == 'td':
+            if len(self.row) in self.int_fields:
+                self.row.append(int(self.accumulator or '0'))
             else:
-                self.boards[-1].append(self.accumulator)
+                self.row.append(self.accumulator)
             self.accumulator = None
 
     def handle_data(self, data):
-        if self.current_state == 'username':
+        # A text node can arrive in several pieces when it straddles a chunk boundary.
+        self.text_pieces.append(data)
+
+    def flush_text(self):
+        if not self.text_pieces:
+            return
+        data = self.text_pieces[0] if len(self.text_pieces) == 1 else ''.join(self.text_pieces)
+        self.text_pieces.clear()
+        state = self.current_state
+        if state == 'td':
+            self.accumulator = self.accumulator or data
+        elif state == 'username':
             self.match_details.append(data)
-        elif self.current_state == 'final_score':
+        elif state == 'final_score':
             search = re.search(r"\((.+)\)", data)
             if search:
                 self.match_details.append(ScoringMethod[search.group(1).upper()])
-        elif self.current_state == 'td':
-            self.accumulator = self.accumulator or data
 
-    def finalize(self):
-        match_details_kwargs = {
+    def drain_boards(self):
+        boards, self.completed_boards = self.completed_boards, []
+        return boards
+
+    def iter_boards(self, chunks):
+        for chunk in chunks:
+            self.feed(chunk)
+            yield from self.drain_boards()
+        self.close()
+        yield from self.drain_boards()
+
+    async def aiter_boards(self, chunks):
+        # iter_boards over an async iterable of chunks, such as a response body still arriving. Each chunk is
+        # parsed on a worker thread, so a large page does not hold up the event loop.
+        async for chunk in chunks:
+            await asyncio.to_thread(self.feed, chunk)
+            for board in self.drain_boards():
+                yield board
+        self.close()
+        for board in self.drain_boards():
+            yield board
+
+    def match_details_kwargs(self):
+        return {
             k: v
             for k, v in zip(self.match_details_order, self.match_details)
         }
-        match_details_kwargs['boards'] = self.boards[:-1]
-        return FriendChallenge(**match_details_kwargs)
+
+    @staticmethod
+    def totals(boards, get=getattr):
+        # (hero_total, villain_total, board_count) of ORM boards, or of row dicts with get=dict.get.
+        return (
+            sum(get(board, 'hero_matchscore') or 0 for board in boards),
+            sum(get(board, 'villain_matchscore') or 0 for board in boards),
+            len(boards),
+        )
+
+    def validate(self, boards):
+        # Pages without both players, the scoring method and a board (login pages, errors) are not challenges.
+        if len(self.match_details_kwargs()) != len(self.match_details_order) or not boards:
+            raise ValueError('Page does not contain a friend challenge.')
+
+    def finalize(self, boards):
+        self.validate(boards)
+        hero_total, villain_total, board_count = self.totals(boards)
+        return FriendChallenge(
+            boards=boards, hero_total=hero_total, villain_total=villain_total, board_count=board_count,
+            **self.match_details_kwargs())
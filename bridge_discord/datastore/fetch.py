@@ -0,0 +1,95 @@
+import asyncio
+import codecs
+import random
+import time
+
+import aiohttp
+
+from bridge_discord import metrics
+
+
+CHUNK_SIZE = 1 << 16
+
+
+async def _read_text(response):
+    return response.status, response.headers, await response.text()
+
+
+async def iter_text(response, chunk_size=CHUNK_SIZE):
+    # The body decoded chunk by chunk as it arrives; a character split across chunks is held back until complete.
+    decoder = codecs.getincrementaldecoder(response.get_encoding())(errors='replace')
+    async for chunk in response.content.iter_chunked(chunk_size):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+class BBOFetcher:
+    # Shared keep-alive HTTP client for BBO pages. Concurrency is bounded per attempt, so requests waiting on a
+    # retry backoff do not hold a slot.
+    def __init__(self, max_concurrency=4, connect_timeout=5.0, read_timeout=15.0, retries=3, backoff=0.5):
+        self.max_concurrency = max_concurrency
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=30.0),
+                timeout=self.timeout,
+                raise_for_status=True,
+            )
+        return self._session
+
+    @staticmethod
+    def _is_retryable(error):
+        return not isinstance(error, aiohttp.ClientResponseError) or error.status >= 500
+
+    async def _attempt(self, url, headers, read):
+        async with self._semaphore:
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                async with self._get_session().get(url, headers=headers) as response:
+                    outcome = str(response.status)
+                    return await read(response)
+            except aiohttp.ClientResponseError as e:
+                outcome = str(e.status)
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                outcome = type(e).__name__
+                raise
+            finally:
+                metrics.registry.observe_fetch(outcome, time.perf_counter() - start)
+
+    async def _retried(self, url, headers, read):
+        for attempt in range(self.retries):
+            try:
+                return await self._attempt(url, headers, read)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries - 1 or not self._is_retryable(e):
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt * (1.0 + random.random()))
+
+    async def get(self, url, headers=None):
+        # (status, headers, text) of the whole body.
+        return await self._retried(url, headers, _read_text)
+
+    async def stream(self, url, consume, headers=None):
+        # Returns consume(response), which reads the body while it arrives, e.g. through iter_text. A failed
+        # attempt is retried with a new call to consume, so it must not keep state between calls.
+        return await self._retried(url, headers, consume)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+fetcher = BBOFetcher()
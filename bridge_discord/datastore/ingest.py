@@ -0,0 +1,188 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import hashlib
+import multiprocessing
+import re
+import time
+from types import SimpleNamespace
+
+import aiohttp
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from . import fetch, matchlink, stats
+from .challenge import BBOChallengeParser, FriendChallenge, FriendChallengeBoard
+from .matchlink import MatchlinkCacheEntry
+
+MATCHLINK_PATTERN = re.compile(r"https://webutil\.bridgebase\.com/[^\s,;\"'<>]+", re.IGNORECASE)
+
+
+class _RowParser(BBOChallengeParser):
+    board_factory = dict
+
+
+def parse_challenge_page(html):
+    # Runs in a worker process, so it returns plain rows instead of ORM objects.
+    parser = _RowParser()
+    boards = list(parser.iter_boards((html,)))
+    parser.validate(boards)
+    details = parser.match_details_kwargs()
+    details['hero_total'], details['villain_total'], details['board_count'] = parser.totals(boards, dict.get)
+    return details, boards
+
+
+class ParsePool:
+    # Worker processes for parse_challenge_page, started on first use and kept until close(). They are started with
+    # forkserver (spawn where that is unavailable), since forking the bot itself would copy its loop, sockets and
+    # datastore thread into every worker.
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._pool = None
+
+    def get(self):
+        if self._pool is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._pool = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context(start_method))
+        return self._pool
+
+    async def close(self):
+        # shutdown joins the workers, so it waits on a thread rather than on the event loop.
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            await asyncio.to_thread(pool.shutdown)
+
+
+parse_pool = ParsePool()
+
+
+def extract_matchlinks(text):
+    return MATCHLINK_PATTERN.findall(text)
+
+
+class IngestReport:
+    def __init__(self):
+        self.links = 0
+        self.created = {}
+        self.duplicates = {}
+        self.failures = {}
+        self.elapsed = 0.0
+
+    @property
+    def links_per_second(self):
+        return self.links / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (
+            f"Ingested {self.links} links: {len(self.created)} new, {len(self.duplicates)} already recorded, "
+            f"{len(self.failures)} failed in {self.elapsed:.1f}s ({self.links_per_second:.1f} links/s)."
+        )
+
+
+async def _fetch_and_parse(url, pool):
+    try:
+        _, headers, html = await fetch.fetcher.get(url)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise ValueError(f'Failed to fetch matchlink: {e!r}')
+    details, boards = await asyncio.get_running_loop().run_in_executor(pool, parse_challenge_page, html)
+    return headers, hashlib.sha256(html.encode()).hexdigest(), details, boards
+
+
+def _cached_match_ids(session, urls):
+    return dict(session.execute(
+        select(MatchlinkCacheEntry.url, MatchlinkCacheEntry.match_id)
+        .where(MatchlinkCacheEntry.url.in_(urls), MatchlinkCacheEntry.match_id.is_not(None))
+    ).all())
+
+
+def _store_parsed(session, urls, parsed, report):
+    known_hashes = dict(session.execute(
+        select(MatchlinkCacheEntry.content_hash, MatchlinkCacheEntry.match_id)
+        .where(
+            MatchlinkCacheEntry.content_hash.in_({content_hash for _, _, content_hash, _, _ in parsed}),
+            MatchlinkCacheEntry.match_id.is_not(None)
+        )
+    ).all())
+
+    challenge_rows, board_rows, new_hashes = [], [], {}
+    for _, _, content_hash, details, boards in parsed:
+        if content_hash not in known_hashes and content_hash not in new_hashes:
+            new_hashes[content_hash] = len(challenge_rows)
+            challenge_rows.append(details)
+            board_rows.append(boards)
+    if challenge_rows:
+        match_ids = session.execute(
+            insert(FriendChallenge).returning(FriendChallenge.match_id, sort_by_parameter_order=True),
+            challenge_rows
+        ).scalars().all()
+        session.execute(
+            insert(FriendChallengeBoard.__table__),
+            [dict(board, match_id=match_id) for match_id, boards in zip(match_ids, board_rows) for board in boards]
+        )
+        stats.record_challenge_stats(session, [SimpleNamespace(**details) for details in challenge_rows])
+        known_hashes.update((content_hash, match_ids[ix]) for content_hash, ix in new_hashes.items())
+
+    now = datetime.datetime.utcnow()
+    cache_rows = []
+    for url, headers, content_hash, _, _ in parsed:
+        match_id = known_hashes[content_hash]
+        if new_hashes.pop(content_hash, None) is not None:
+            report.created[urls[url]] = match_id
+        else:
+            report.duplicates[urls[url]] = match_id
+        cache_rows.append(dict(
+            url=url,
+            content_hash=content_hash,
+            etag=headers.get('ETag'),
+            last_modified=headers.get('Last-Modified'),
+            match_id=match_id,
+            validated_at=now,
+            accessed_at=now,
+        ))
+    if cache_rows:
+        upsert = sqlite_insert(MatchlinkCacheEntry.__table__)
+        session.execute(
+            upsert.on_conflict_do_update(
+                index_elements=[MatchlinkCacheEntry.url],
+                set_={key: upsert.excluded[key] for key in cache_rows[0] if key != 'url'}
+            ),
+            cache_rows
+        )
+        matchlink.evict_cache_entries(session)
+
+
+async def ingest_matchlinks(session, matchlinks, pool=None):
+    # Fetches all links concurrently, parses them in a ParsePool (parse_pool unless given) and stores every new
+    # challenge with bulk inserts on the AsyncSession, then commits. Failed links are collected in the report.
+    start = time.perf_counter()
+    report = IngestReport()
+    urls = {}
+    for link in matchlinks:
+        url = matchlink.normalize_matchlink(link)
+        try:
+            FriendChallenge.validate_matchlink(url)
+        except ValueError as e:
+            report.failures[link] = e.args[0]
+            continue
+        urls.setdefault(url, link)
+    report.links = len(urls) + len(report.failures)
+
+    # Committed straight away, so no read transaction stays open while the links are fetched and parsed.
+    cached = await session.run_and_commit(_cached_match_ids, urls)
+    report.duplicates.update((urls[url], match_id) for url, match_id in cached.items())
+    pending_urls = [url for url in urls if url not in cached]
+    executor = (pool or parse_pool).get()
+    results = await asyncio.gather(
+        *(_fetch_and_parse(url, executor) for url in pending_urls), return_exceptions=True)
+
+    parsed = []
+    for url, result in zip(pending_urls, results):
+        if isinstance(result, Exception):
+            report.failures[urls[url]] = str(result) or type(result).__name__
+        else:
+            parsed.append((url, *result))
+    if parsed:
+        await session.run_and_commit(_store_parsed, urls, parsed, report)
+
+    report.elapsed = time.perf_counter() - start
+    return report
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+from sqlalchemy import BigInteger, Column, Integer, String
+from sqlalchemy import delete, insert, select, update
+
+from bridge_discord import metrics
+from .basic import AsyncSession, Base, CreatedAtMixin, Session, run_sync
+from .challenge import FriendChallenge
+from .matchlink import normalize_matchlink, resolve_matchlink
+from .standings import record_active_segment
+
+
+class IngestJob(Base, CreatedAtMixin):
+    # One row per request still waiting for its result; deleted once the result has been delivered.
+    __tablename__ = "bbo_ingest_job"
+
+    job_id = Column(Integer, primary_key=True, autoincrement=True)
+    url = Column(String, nullable=False, index=True)
+    channel_id = Column(BigInteger)
+    requested_by = Column(BigInteger)
+    # Attempts started on the URL, counted before each one, so a job whose ingestion takes the process down is
+    # counted too.
+    attempts = Column(Integer, nullable=False, default=0)
+
+
+class PendingJob:
+    def __init__(self, job_id, url, channel_id, requested_by, ctx=None, attempts=0):
+        self.job_id = job_id
+        self.url = url
+        self.channel_id = channel_id
+        self.requested_by = requested_by
+        # The interaction to answer, None for jobs restored after a restart.
+        self.ctx = ctx
+        self.attempts = attempts
+
+
+def _with_session(fn, *args):
+    # Job bookkeeping runs in a short session of its own, apart from any command's session.
+    with Session() as session:
+        return fn(session, *args)
+
+
+def _add_job(session, url, channel_id, requested_by):
+    job_id = session.execute(
+        insert(IngestJob.__table__).values(url=url, channel_id=channel_id, requested_by=requested_by)
+    ).inserted_primary_key[0]
+    session.commit()
+    return job_id
+
+
+def _pending_jobs(session):
+    return [
+        PendingJob(
+            job_model.job_id, job_model.url, job_model.channel_id, job_model.requested_by,
+            attempts=job_model.attempts)
+        for job_model in session.execute(select(IngestJob).order_by(IngestJob.job_id)).scalars()
+    ]
+
+
+def _record_attempt(session, url):
+    session.execute(update(IngestJob.__table__).where(IngestJob.url == url).values(attempts=IngestJob.attempts + 1))
+    session.commit()
+
+
+def _finish_jobs(session, job_ids):
+    session.execute(delete(IngestJob.__table__).where(IngestJob.job_id.in_(job_ids)))
+    session.commit()
+
+
+def _record_segment(session, match_id):
+    rr_match = record_active_segment(session, match_id)
+    return rr_match.rr_match_id if rr_match is not None else None
+
+
+async def ingest_one(matchlink):
+    # Returns (match_id, rr_match_id); rr_match_id is None when the challenge is not a segment of the running
+    # Team RR tournament. A retry after a failed segment finds the challenge stored and records only the segment.
+    async with AsyncSession() as session:
+        friend_challenge, _ = await resolve_matchlink(session, matchlink)
+        match_id = friend_challenge.match_id
+        rr_match_id = await session.run_and_commit(_record_segment, match_id)
+    return match_id, rr_match_id
+
+
+class IngestionQueue:
+    # Background matchlink ingestion. Requests are persisted before they are acknowledged and resumed by start() after
+    # a restart. Requests for a URL that is already queued or running wait on that job instead of fetching it again.
+    # deliver(jobs, result, error) is awaited once per URL with every request waiting on it; result is the return
+    # value of ingest_one, error a message for the user. Restored jobs that already had max_attempts attempts are
+    # answered with an error instead of being run again.
+    def __init__(self, deliver, max_workers=4, retries=3, backoff=2.0, max_attempts=10):
+        self.deliver = deliver
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_attempts = max_attempts
+        self._queue = asyncio.Queue()
+        self._waiting = {}
+        self._enqueued_at = {}
+        self._workers = []
+
+    @property
+    def depth(self):
+        # URLs queued or running.
+        return len(self._waiting)
+
+    def _register(self, job):
+        if job.url in self._waiting:
+            self._waiting[job.url].append(job)
+            return
+        self._waiting[job.url] = [job]
+        self._enqueued_at[job.url] = time.perf_counter()
+        self._queue.put_nowait(job.url)
+        metrics.registry.set_ingest_depth(self.depth)
+
+    async def enqueue(self, matchlink, channel_id=None, requested_by=None, ctx=None):
+        # Raises ValueError for links that are not BBO matchlinks, so they can be refused before deferring.
+        url = normalize_matchlink(matchlink)
+        FriendChallenge.validate_matchlink(url)
+        job_id = await run_sync(_with_session, _add_job, url, channel_id, requested_by)
+        self._register(PendingJob(job_id, url, channel_id, requested_by, ctx))
+        return job_id
+
+    async def start(self):
+        if self._workers:
+            return
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.max_workers)]
+        restored = await run_sync(_with_session, _pending_jobs)
+        exhausted = {}
+        for job in restored:
+            if job.attempts >= self.max_attempts:
+                exhausted.setdefault(job.url, []).append(job)
+            elif not any(job.job_id == waiting.job_id for waiting in self._waiting.get(job.url, ())):
+                self._register(job)
+        if restored:
+            logging.info("Resumed %d pending ingestion jobs.", len(restored) - sum(map(len, exhausted.values())))
+        for url, jobs in exhausted.items():
+            logging.warning("Giving up on %s after %d attempts.", url, jobs[0].attempts)
+            await self._finish(url, jobs, None, f"Gave up after {jobs[0].attempts} attempts.")
+
+    async def stop(self):
+        # Jobs still queued or running stay in the database and are resumed by the next start().
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = asyncio.Queue()
+        self._waiting.clear()
+        self._enqueued_at.clear()
+        metrics.registry.set_ingest_depth(0)
+
+    @staticmethod
+    def _is_retryable(error):
+        # resolve_matchlink reports fetch failures as ValueError after the fetcher's own retries; other ValueErrors
+        # are about the page itself and would fail again.
+        return not isinstance(error, ValueError) or isinstance(
+            error.__context__, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    async def _run(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                await run_sync(_with_session, _record_attempt, url)
+            except Exception:
+                logging.exception("Recording an attempt of %s failed.", url)
+            try:
+                return await ingest_one(url), None
+            except Exception as e:
+                if attempt == self.retries or not self._is_retryable(e):
+                    if not isinstance(e, ValueError):
+                        logging.exception("Ingestion of %s failed.", url)
+                    return None, ",".join(map(str, e.args)) if isinstance(e, ValueError) else "Failed to ingest."
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def _process(self, url):
+        # Never raises: whatever fails, the URL leaves _waiting and its requests get an answer, so later requests for
+        # it start a new job instead of waiting on this one.
+        try:
+            result, error = await self._run(url)
+        except Exception:
+            logging.exception("Ingestion of %s failed.", url)
+            result, error = None, "Failed to ingest."
+        # A request arriving while the result is delivered starts a job of its own.
+        jobs = self._waiting.pop(url)
+        enqueued_at = self._enqueued_at.pop(url)
+        metrics.registry.set_ingest_depth(self.depth)
+        await self._finish(url, jobs, result, error)
+        metrics.registry.observe_ingest_job("failed" if error else "done", time.perf_counter() - enqueued_at)
+
+    async def _finish(self, url, jobs, result, error):
+        try:
+            await self.deliver(jobs, result, error)
+        except Exception:
+            logging.exception("Delivering the ingestion result for %s failed.", url)
+        try:
+            await run_sync(_with_session, _finish_jobs, [job.job_id for job in jobs])
+        except Exception:
+            # The rows stay and the jobs are run again after the next restart.
+            logging.exception("Removing the finished jobs of %s failed.", url)
+
+    async def _work(self):
+        while True:
+            url = await self._queue.get()
+            try:
+                await self._process(url)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,105 @@
+import threading
+
+from sortedcontainers import SortedList
+from sqlalchemy import event, select
+
+from .basic import VERSION_POLL_INTERVAL, DatastoreVersion, VersionPoller
+
+PAGE_SIZE = 20
+# session.info key of the rating changes staged by Leaderboard.touch in the session's transaction.
+_PENDING_KEY = "leaderboard_pending"
+
+
+def conservative_estimate(mmr_m, mmr_s):
+    return mmr_m - 3.0 * mmr_s
+
+
+class Leaderboard:
+    # In-memory ranking of every BBOProfile by conservative estimate, highest first, so rank and page lookups are
+    # O(log n) and never touch the DB. It is loaded from the DB once; rating changes are staged with touch() and
+    # applied when their transaction commits. touch() also bumps the "rating" version stamp, and sync() rebuilds
+    # when its VersionPoller reports a change by another process. Writers run on the datastore thread and readers
+    # on the event loop, hence the lock.
+    def __init__(self, poll_interval=VERSION_POLL_INTERVAL):
+        self._lock = threading.Lock()
+        self._keys = SortedList()
+        self._key_by_user = {}
+        self._poller = VersionPoller("rating", poll_interval)
+
+    def __len__(self):
+        return len(self._key_by_user)
+
+    def __contains__(self, bbo_user):
+        return bbo_user in self._key_by_user
+
+    def _update(self, bbo_user, mmr_m, mmr_s):
+        old_key = self._key_by_user.get(bbo_user)
+        if old_key is not None:
+            self._keys.remove(old_key)
+        key = (-conservative_estimate(mmr_m, mmr_s), bbo_user)
+        self._keys.add(key)
+        self._key_by_user[bbo_user] = key
+
+    def rebuild(self, session):
+        from .profile import BBOProfile
+
+        version = self._poller.read(session)
+        rows = session.execute(select(BBOProfile.bbo_user, BBOProfile.mmr_m, BBOProfile.mmr_s)).all()
+        keys = {bbo_user: (-conservative_estimate(mmr_m, mmr_s), bbo_user) for bbo_user, mmr_m, mmr_s in rows}
+        with self._lock:
+            self._keys = SortedList(keys.values())
+            self._key_by_user = keys
+        self._poller.record(version)
+
+    def sync(self, session):
+        # Catches up with rating changes committed by other processes; call before reading.
+        if self._poller.poll(session) is not None:
+            self.rebuild(session)
+
+    def touch(self, session, ratings, known_only=False):
+        # Stages (bbo_user, mmr_m, mmr_s) ratings to apply once session's transaction commits; a rollback drops them.
+        # With known_only, users without a profile in the index are skipped. The version stamp is bumped once per
+        # transaction.
+        pending = session.info.get(_PENDING_KEY)
+        if pending is None:
+            if not session.info.get(f"{_PENDING_KEY}_listening"):
+                session.info[f"{_PENDING_KEY}_listening"] = True
+                event.listen(session, "after_commit", self._apply)
+                event.listen(session, "after_rollback", lambda session: session.info.pop(_PENDING_KEY, None))
+            DatastoreVersion.bump(session, "rating")
+            pending = session.info[_PENDING_KEY] = (DatastoreVersion.get(session, "rating"), {})
+        for bbo_user, mmr_m, mmr_s in ratings:
+            pending[1][bbo_user] = (mmr_m, mmr_s, known_only)
+
+    def _apply(self, session):
+        pending = session.info.pop(_PENDING_KEY, None)
+        if pending is None:
+            return
+        version, ratings = pending
+        with self._lock:
+            for bbo_user, (mmr_m, mmr_s, known_only) in ratings.items():
+                if not known_only or bbo_user in self._key_by_user:
+                    self._update(bbo_user, mmr_m, mmr_s)
+        self._poller.advance(version)
+
+    def rank(self, bbo_user):
+        # 1-based rank, or None if the user has no profile.
+        with self._lock:
+            key = self._key_by_user.get(bbo_user)
+            return None if key is None else self._keys.index(key) + 1
+
+    def page_count(self, page_size=PAGE_SIZE):
+        return max(1, -(-len(self) // page_size))
+
+    def page(self, page_number, page_size=PAGE_SIZE):
+        # [(rank, bbo_user, conservative estimate)] of the 1-based page_number.
+        start = (page_number - 1) * page_size
+        with self._lock:
+            return [
+                (rank, bbo_user, -negative_estimate)
+                for rank, (negative_estimate, bbo_user) in enumerate(
+                    self._keys.islice(start, start + page_size), start=start + 1)
+            ]
+
+
+rankings = Leaderboard()
@@ -0,0 +1,198 @@
+import asyncio
+import datetime
+import hashlib
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+import aiohttp
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import delete, func, inspect, select
+
+from . import fetch, standings, stats
+from .basic import Base
+from .challenge import FriendChallenge, FriendChallengeBoard
+
+CACHE_MAX_AGE = datetime.timedelta(days=7)
+CACHE_MAX_ENTRIES = 10000
+
+
+class MatchlinkCacheEntry(Base):
+    __tablename__ = "bbo_matchlink_cache"
+
+    url = Column(String, primary_key=True)
+    content_hash = Column(String, index=True)
+    etag = Column(String)
+    last_modified = Column(String)
+    match_id = Column(Integer, ForeignKey("bbo_friend_challenge.match_id"))
+    validated_at = Column(DateTime)
+    accessed_at = Column(DateTime, index=True)
+
+
+def normalize_matchlink(matchlink):
+    parsed_url = urlparse(matchlink.strip())
+    return urlunparse((
+        parsed_url.scheme.lower(),
+        parsed_url.netloc.lower(),
+        parsed_url.path or '/',
+        parsed_url.params,
+        urlencode(sorted(parse_qsl(parsed_url.query, keep_blank_values=True))),
+        '',
+    ))
+
+
+def evict_cache_entries(session, max_entries=CACHE_MAX_ENTRIES):
+    excess = session.execute(select(func.count()).select_from(MatchlinkCacheEntry)).scalar() - max_entries
+    if excess > 0:
+        stale_urls = select(MatchlinkCacheEntry.url).order_by(MatchlinkCacheEntry.accessed_at).limit(excess)
+        session.execute(
+            delete(MatchlinkCacheEntry.__table__).where(MatchlinkCacheEntry.url.in_(stale_urls.scalar_subquery()))
+        )
+
+
+def _cached_challenge(session, url, now, max_age):
+    # Only reads. A new entry is returned without being added; _write_resolved writes it.
+    entry = session.get(MatchlinkCacheEntry, url) or MatchlinkCacheEntry(url=url)
+    if entry.match_id is not None and now - entry.validated_at < max_age:
+        return entry, session.get(FriendChallenge, entry.match_id), {}
+
+    headers = {}
+    if entry.match_id is not None and entry.etag:
+        headers['If-None-Match'] = entry.etag
+    if entry.match_id is not None and entry.last_modified:
+        headers['If-Modified-Since'] = entry.last_modified
+    # Nothing is pending, so this only ends the read and hands the connection back to the pool during the fetch.
+    session.commit()
+    return entry, None, headers
+
+
+def _write_resolved(session, entry, now, max_entries, friend_challenge=None, revalidation=None):
+    # Every write of a resolve, run through AsyncSession.run_and_commit. revalidation is
+    # (status, response_headers, content_hash, parsed) after a fetch; returns (friend_challenge, created).
+    new_entry = inspect(entry).transient
+    if new_entry:
+        session.add(entry)
+    entry.accessed_at = now
+    created = False
+    if revalidation is not None:
+        status, response_headers, content_hash, parsed = revalidation
+        friend_challenge = _revalidated_challenge(session, entry, now, status, response_headers, content_hash)
+        if friend_challenge is None:
+            # Pages that are not a challenge are refused here, before anything is stored.
+            if isinstance(parsed, ValueError):
+                raise parsed
+            friend_challenge, created = _store_challenge(session, entry, parsed), True
+    if new_entry:
+        session.flush()
+        evict_cache_entries(session, max_entries)
+    return friend_challenge, created
+
+
+async def _commit_resolved(session, entry, now, max_entries, friend_challenge=None, revalidation=None):
+    friend_challenge, created = await session.run_and_commit(
+        _write_resolved, entry, now, max_entries, friend_challenge, revalidation)
+    # Loaded again here rather than lazily on the event loop.
+    await session.run_sync(lambda sync_session: sync_session.refresh(friend_challenge))
+    return friend_challenge, created
+
+
+def _revalidated_challenge(session, entry, now, status, response_headers, content_hash):
+    entry.validated_at = now
+    if status == 304:
+        return session.get(FriendChallenge, entry.match_id)
+
+    entry.etag = response_headers.get('ETag')
+    entry.last_modified = response_headers.get('Last-Modified')
+    if entry.match_id is not None and entry.content_hash == content_hash:
+        return session.get(FriendChallenge, entry.match_id)
+    entry.content_hash = content_hash
+    duplicate_match_id = session.execute(
+        select(MatchlinkCacheEntry.match_id).where(
+            MatchlinkCacheEntry.content_hash == entry.content_hash,
+            MatchlinkCacheEntry.match_id.is_not(None),
+            MatchlinkCacheEntry.url != entry.url
+        ).limit(1)
+    ).scalar()
+    if duplicate_match_id is not None:
+        entry.match_id = duplicate_match_id
+        return session.get(FriendChallenge, duplicate_match_id)
+    # entry.match_id, if set, is the challenge the changed page replaces.
+    return None
+
+
+def _shares_challenge(session, entry):
+    return session.execute(
+        select(MatchlinkCacheEntry.url).where(
+            MatchlinkCacheEntry.match_id == entry.match_id, MatchlinkCacheEntry.url != entry.url
+        ).limit(1)
+    ).first() is not None
+
+
+def _replace_challenge(session, friend_challenge, parsed):
+    # The page behind a link changed: the stored challenge takes the new details, boards and totals. Its old totals
+    # are taken out of the player aggregates and, if it is a tournament segment, out of its match and standings
+    # before the new ones go in, so everything counts the new page once.
+    stats.record_challenge_stats(session, [friend_challenge], sign=-1)
+    standings.update_segment(session, friend_challenge, -1)
+    session.execute(
+        delete(FriendChallengeBoard.__table__).where(FriendChallengeBoard.match_id == friend_challenge.match_id))
+    session.expire(friend_challenge, ['boards'])
+    # merge copies the parsed challenge and its boards onto the stored row without adding the parsed object itself.
+    parsed.match_id = friend_challenge.match_id
+    friend_challenge = session.merge(parsed)
+    session.flush()
+    stats.record_challenge_stats(session, [friend_challenge])
+    standings.update_segment(session, friend_challenge, 1)
+    return friend_challenge
+
+
+def _store_challenge(session, entry, friend_challenge):
+    if entry.match_id is not None and not _shares_challenge(session, entry):
+        return _replace_challenge(session, session.get(FriendChallenge, entry.match_id), friend_challenge)
+    session.add(friend_challenge)
+    session.flush()
+    entry.match_id = friend_challenge.match_id
+    stats.record_challenge_stats(session, [friend_challenge])
+    return friend_challenge
+
+
+async def _hash_and_parse(response):
+    # Hashes and parses the page while it downloads. A page that fails to parse is returned as its ValueError, so an
+    # unchanged or duplicate page is still answered from the stored challenge. Returns (status, headers,
+    # content_hash, FriendChallenge or ValueError), with None for both on 304.
+    if response.status == 304:
+        return response.status, response.headers, None, None
+    content_hash = hashlib.sha256()
+
+    async def hashed_chunks():
+        async for chunk in fetch.iter_text(response):
+            content_hash.update(chunk.encode())
+            yield chunk
+
+    chunks = hashed_chunks()
+    try:
+        parsed = await FriendChallenge.async_init_from_chunks(chunks)
+    except ValueError as e:
+        parsed = e
+    # Whatever the parser left unread still counts towards the hash.
+    async for _ in chunks:
+        pass
+    return response.status, response.headers, content_hash.hexdigest(), parsed
+
+
+async def resolve_matchlink(session, matchlink, max_age=CACHE_MAX_AGE, max_entries=CACHE_MAX_ENTRIES):
+    # Returns (friend_challenge, created) using an AsyncSession, and commits. Links seen within max_age are answered
+    # from the DB without a request, older ones are revalidated with ETag/Last-Modified, and identical pages under
+    # different URLs share a row.
+    url = normalize_matchlink(matchlink)
+    FriendChallenge.validate_matchlink(url)
+    now = datetime.datetime.utcnow()
+    entry, friend_challenge, headers = await session.run_sync(_cached_challenge, url, now, max_age)
+    if friend_challenge is not None:
+        return await _commit_resolved(session, entry, now, max_entries, friend_challenge)
+
+    try:
+        status, response_headers, content_hash, parsed = await fetch.fetcher.stream(
+            url, _hash_and_parse, headers=headers)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        raise ValueError('Failed to fetch matchlink from webutil.bridgebase.com. Try again later.')
+    return await _commit_resolved(
+        session, entry, now, max_entries, revalidation=(status, response_headers, content_hash, parsed))
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+from .basic import Session, run_sync
+from .profile import ServerProfile
+
+MAX_PENDING = 500
+MAX_DELAY = 0.25
+
+
+def _insert_members(discord_users):
+    with Session() as session:
+        ServerProfile.bulk_insert(session, discord_users)
+        session.commit()
+
+
+class MemberWriteBuffer:
+    # Coalesces guild joins into one upsert transaction per MAX_PENDING ids or MAX_DELAY seconds, whichever comes
+    # first, instead of a transaction and fsync per join. Ids stay visible through `in` until they are committed.
+    def __init__(self, max_pending=MAX_PENDING, max_delay=MAX_DELAY):
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self._pending = set()
+        self._flushing = set()
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    def __contains__(self, discord_user):
+        return discord_user in self._pending or discord_user in self._flushing
+
+    def __len__(self):
+        return len(self._pending) + len(self._flushing)
+
+    def add(self, discord_user):
+        self._pending.add(discord_user)
+        if len(self._pending) >= self.max_pending:
+            asyncio.ensure_future(self._background_flush())
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_delay, lambda: asyncio.ensure_future(self._background_flush()))
+
+    async def _background_flush(self):
+        try:
+            await self.flush()
+        except Exception:
+            logging.exception("Flushing %d new guild members failed, retrying with the next join.", len(self))
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # One flush at a time, so the ids of a failed flush are retried by the next one rather than lost.
+        async with self._lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, set()
+            try:
+                await run_sync(_insert_members, self._flushing)
+            except BaseException:
+                self._pending |= self._flushing
+                raise
+            finally:
+                self._flushing = set()
+
+
+pending_members = MemberWriteBuffer()
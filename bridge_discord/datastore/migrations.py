@@ -0,0 +1,59 @@
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+
+from .basic import Base
+# Every module that defines tables, so create_all and the mappers see the complete schema.
+from . import challenge, jobs, matchlink, profile, replay, standings, stats, tournament  # noqa: F401
+
+
+def _has_column(connection, table_name, column_name):
+    # table_xinfo, unlike table_info, also lists generated columns.
+    return any(row[1] == column_name for row in connection.exec_driver_sql(f"PRAGMA table_xinfo({table_name})"))
+
+
+def _create_missing_indexes(connection, *table_names):
+    for table_name in table_names:
+        for index in Base.metadata.tables[table_name].indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _index_hot_paths(connection):
+    if not _has_column(connection, "bbo_profile", "conservative_mmr_estimate"):
+        connection.exec_driver_sql(
+            "ALTER TABLE bbo_profile ADD COLUMN conservative_mmr_estimate FLOAT "
+            "GENERATED ALWAYS AS (mmr_m - 3.0 * mmr_s) VIRTUAL"
+        )
+    _create_missing_indexes(
+        connection, "bbo_profile", "bbo_representative", "teamrr_tournament", "teamrr_entries", "bbo_friend_challenge")
+
+
+def _challenge_totals(connection):
+    for column_name, column_type in (("hero_total", "FLOAT"), ("villain_total", "FLOAT"), ("board_count", "INTEGER")):
+        if not _has_column(connection, "bbo_friend_challenge", column_name):
+            connection.exec_driver_sql(
+                f"ALTER TABLE bbo_friend_challenge ADD COLUMN {column_name} {column_type} NOT NULL DEFAULT 0")
+    # Fills the new columns and the aggregate tables, which create_all has just created empty.
+    with Session(connection) as session:
+        stats.rebuild_stats(session)
+
+
+# Applied in order to databases created before they existed; PRAGMA user_version records how many have run.
+# Append new steps here, never edit or reorder existing ones.
+MIGRATIONS = [
+    _index_hot_paths,
+    _challenge_totals,
+]
+
+
+def upgrade(engine):
+    # create_all never alters existing tables, so anything a model gains after a DB was created goes through
+    # MIGRATIONS. BEGIN IMMEDIATE keeps bots starting at the same time from migrating twice.
+    with engine.connect() as connection:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        existing_db = inspect(connection).has_table("bbo_profile")
+        version = connection.exec_driver_sql("PRAGMA user_version").scalar() if existing_db else len(MIGRATIONS)
+        Base.metadata.create_all(connection)
+        for migration in MIGRATIONS[version:]:
+            migration(connection)
+        connection.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        connection.commit()
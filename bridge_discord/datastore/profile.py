@@ -1,13 +1,14 @@
-import functools
+import collections
+import threading
 
-import numpy as np
-import interactions
-import scipy
-from sqlalchemy import Column, ForeignKey, Float, Integer, String
-from sqlalchemy.orm import relationship
-from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy import Column, Computed, ForeignKey, Float, Integer, String, bindparam, event, literal, select, union_all
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import object_session, relationship
 
-from .basic import Base
+from . import leaderboard, rating
+from .basic import VERSION_POLL_INTERVAL, Base, DatastoreVersion, VersionPoller
+
+IDENTITY_CACHE_SIZE = 4096
 
 
 class ServerProfile(Base):
@@ -17,50 +18,44 @@ class ServerProfile(Base):
     bbo_main_account = relationship("BBOMain", uselist=False, backref="server_profile")
     bbo_representing = relationship("BBORepresentative", backref="server_profile")
 
-    def is_linked(self, bbo_user):
-        return bbo_user == self.bbo_main_account.bbo_user or any(
-            bbo_user == r.bbo_user for r in self.bbo_representing)
+    @classmethod
+    def existing_ids(cls, session):
+        return set(session.execute(select(cls.discord_user)).scalars())
 
-    async def mention(self, client):
-        return (await interactions.get(client, interactions.User, object_id=self.discord_user)).mention
+    @classmethod
+    def bulk_insert(cls, session, discord_users):
+        if discord_users:
+            session.execute(
+                sqlite_insert(cls.__table__).on_conflict_do_nothing(),
+                [{'discord_user': discord_user} for discord_user in discord_users]
+            )
 
 
 class BBOProfile(Base):
     __tablename__ = "bbo_profile"
     bbo_user = Column(String, primary_key=True)
-    mmr_m = Column(Float, server_default="1200.0")
-    mmr_s = Column(Float, server_default="400.0")
+    mmr_m = Column(Float, server_default=str(rating.INITIAL_MU))
+    mmr_s = Column(Float, server_default=str(rating.INITIAL_SIGMA))
+    # Generated by SQLite from mmr_m/mmr_s, so it can never drift and ORDER BY can use its index.
+    conservative_mmr_estimate = Column(Float, Computed("mmr_m - 3.0 * mmr_s", persisted=False), index=True)
 
     discord_main = relationship("BBOMain", uselist=False, backref="bbo_profile")
     discord_represented = relationship("BBORepresentative", backref="bbo_profile")
 
     def update_mmr(self, other, win):
-        # Message passing with approximate moment matching, aka TrueSkill
-        def integrand(r, moment):
-            other_cdf = scipy.stats.norm.cdf(r, other.mmr_m, other.mmr_s)
-            return r ** moment * (
-                scipy.stats.norm.pdf(r, self.mmr_m, self.mmr_s) *
-                other_cdf if win else (1.0 - other_cdf) /
-                scipy.stats.norm.cdf(
-                    0,
-                    other.mmr_m - self.mmr_m if win else self.mmr_m - other.mmr_m,
-                    (self.mmr_s * self.mmr_s + other.mmr_s) ** 0.5
-                )
-            )
-        self.mmr_m = scipy.integrate.quad(functools.partial(integrand, moment=1), -np.inf, np.inf)[0]
-        m2 = scipy.integrate.quad(functools.partial(integrand, moment=2), -np.inf, np.inf)[0]
-        self.mmr_s = (m2 - self.mmr_m*self.mmr_m)**0.5
-
-    @hybrid_property
-    def conservative_mmr_estimate(self):
-        return self.mmr_m - 3.0 * self.mmr_s
-
-    async def to_str_with_linked_mention(self, client):
-        if self.discord_main:
-            mention_string = await self.discord_main.server_profile.mention(client)
-            mention_string = f"[{mention_string}]"
-        else:
-            mention_string = ""
+        (self.mmr_m, self.mmr_s), = rating.update_ratings(
+            [(self.mmr_m, self.mmr_s)], [(other.mmr_m, other.mmr_s)], [win]).tolist()
+        session = object_session(self)
+        if session is not None:
+            leaderboard.rankings.touch(session, [(self.bbo_user, self.mmr_m, self.mmr_s)])
+
+    @property
+    def linked_discord_user(self):
+        return self.discord_main.discord_user if self.discord_main else None
+
+    def to_str_with_mention(self):
+        # A mention only needs the stored discord id, so no user is fetched from the API.
+        mention_string = f"[<@{self.linked_discord_user}>]" if self.linked_discord_user is not None else ""
         return f"•{self.bbo_user}\t{mention_string}"
 
 
@@ -73,4 +68,73 @@ class BBOMain(Base):
 class BBORepresentative(Base):
     __tablename__ = 'bbo_representative'
     bbo_user = Column(String, ForeignKey('bbo_profile.bbo_user'), primary_key=True)
-    discord_user = Column(Integer, ForeignKey('server_profile.discord_user'))
+    discord_user = Column(Integer, ForeignKey('server_profile.discord_user'), index=True)
+
+
+# Main and represented BBO users of one discord user; both lookups use an index on discord_user.
+_IDENTITY_QUERY = union_all(
+    select(BBOMain.bbo_user, literal(True).label("main")).where(BBOMain.discord_user == bindparam("discord_user")),
+    select(BBORepresentative.bbo_user, literal(False).label("main"))
+    .where(BBORepresentative.discord_user == bindparam("discord_user")),
+)
+
+
+class Identity:
+    def __init__(self, main, represented):
+        self.main = main
+        self.represented = represented
+
+    def is_linked(self, bbo_user):
+        return bbo_user == self.main or bbo_user in self.represented
+
+
+class IdentityCache:
+    # LRU of discord user -> Identity. bbo_link and bbo_unlink call touch() in their transaction; other processes
+    # notice through the "identity" VersionPoller. Runs on the datastore thread.
+    def __init__(self, max_entries=IDENTITY_CACHE_SIZE, poll_interval=VERSION_POLL_INTERVAL):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._poller = VersionPoller("identity", poll_interval)
+
+    def get(self, session, discord_user):
+        version = self._poller.poll(session)
+        if version is not None:
+            with self._lock:
+                self._entries.clear()
+            self._poller.record(version)
+        with self._lock:
+            if discord_user in self._entries:
+                self._entries.move_to_end(discord_user)
+                return self._entries[discord_user]
+        main, represented = None, set()
+        for bbo_user, is_main in session.execute(_IDENTITY_QUERY, {"discord_user": discord_user}):
+            if is_main:
+                main = bbo_user
+            else:
+                represented.add(bbo_user)
+        identity = Identity(main, frozenset(represented))
+        with self._lock:
+            self._entries[discord_user] = identity
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return identity
+
+    def invalidate(self, discord_user):
+        with self._lock:
+            self._entries.pop(discord_user, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+            self._checked_at = 0.0
+
+    def touch(self, session, *discord_users):
+        DatastoreVersion.bump(session, "identity")
+        event.listen(
+            session, "after_commit", lambda _: [self.invalidate(discord_user) for discord_user in discord_users],
+            once=True)
+
+
+identities = IdentityCache()
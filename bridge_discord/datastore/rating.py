@@ -0,0 +1,45 @@
+import math
+
+# numpy and scipy are imported inside the functions: most bots never rate anything and should not pay for them
+# at startup.
+INITIAL_MU = 1200.0
+INITIAL_SIGMA = 400.0
+
+_LOG_SQRT_2PI = 0.5 * math.log(2.0 * math.pi)
+
+
+def _v_w(t):
+    # Truncated Gaussian moment corrections: v = pdf(t) / cdf(t), w = v * (v + t)
+    import numpy as np
+    from scipy.special import log_ndtr
+
+    v = np.exp(-0.5 * t * t - _LOG_SQRT_2PI - log_ndtr(t))
+    return v, v * (v + t)
+
+
+def update_ratings(ratings, opponents, wins):
+    # Message passing with exact moment matching, aka TrueSkill, for a batch of independent results.
+    # ratings and opponents are (n, 2) arrays of (mu, sigma), wins is a length n boolean array.
+    import numpy as np
+
+    ratings = np.asarray(ratings, dtype=float).reshape(-1, 2)
+    opponents = np.asarray(opponents, dtype=float).reshape(-1, 2)
+    sign = np.where(np.asarray(wins, dtype=bool).reshape(-1), 1.0, -1.0)
+
+    mu, sigma = ratings[:, 0], ratings[:, 1]
+    variance = sigma * sigma
+    c = np.sqrt(variance + opponents[:, 1] * opponents[:, 1])
+    v, w = _v_w(sign * (mu - opponents[:, 0]) / c)
+
+    updated = np.empty_like(ratings)
+    updated[:, 0] = mu + sign * variance / c * v
+    updated[:, 1] = sigma * np.sqrt(np.maximum(1.0 - variance / (c * c) * w, 0.0))
+    return updated
+
+
+def update_pairs(heroes, villains, hero_wins):
+    # Rates both sides of each result from their pre-result ratings.
+    import numpy as np
+
+    hero_wins = np.asarray(hero_wins, dtype=bool).reshape(-1)
+    return update_ratings(heroes, villains, hero_wins), update_ratings(villains, heroes, ~hero_wins)
@@ -0,0 +1,192 @@
+from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, String
+from sqlalchemy import and_, bindparam, delete, insert, or_, select, update
+
+from . import leaderboard, rating
+from .basic import Base
+from .challenge import FriendChallenge
+from .profile import BBOProfile
+
+
+class MMRCheckpoint(Base):
+    __tablename__ = "mmr_checkpoint"
+
+    checkpoint_id = Column(Integer, primary_key=True, autoincrement=True)
+    challenge_count = Column(Integer, nullable=False)
+    last_created_at = Column(DateTime, nullable=False)
+    last_match_id = Column(Integer, nullable=False)
+
+
+class MMRCheckpointRating(Base):
+    __tablename__ = "mmr_checkpoint_rating"
+
+    checkpoint_id = Column(Integer, ForeignKey("mmr_checkpoint.checkpoint_id"), primary_key=True)
+    bbo_user = Column(String, primary_key=True)
+    mmr_m = Column(Float, nullable=False)
+    mmr_s = Column(Float, nullable=False)
+
+
+class _RatingTable:
+    def __init__(self, capacity=1024):
+        import numpy as np
+
+        self.index = {}
+        self.ratings = np.empty((capacity, 2))
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, bbo_user):
+        ix = self.index.get(bbo_user)
+        if ix is None:
+            ix = self.add(bbo_user, rating.INITIAL_MU, rating.INITIAL_SIGMA)
+        return ix
+
+    def add_missing(self, bbo_users):
+        # Players without a result in the replayed history start over from the initial rating.
+        for bbo_user in bbo_users:
+            if bbo_user not in self.index:
+                self.add(bbo_user, rating.INITIAL_MU, rating.INITIAL_SIGMA)
+
+    def add(self, bbo_user, mmr_m, mmr_s):
+        ix = len(self.index)
+        if ix == len(self.ratings):
+            self.ratings = self.ratings.repeat(2, axis=0)
+        self.ratings[ix] = (mmr_m, mmr_s)
+        self.index[bbo_user] = ix
+        return ix
+
+    def rows(self, **extra):
+        return [
+            dict(extra, _bbo_user=bbo_user, _mmr_m=mmr_m, _mmr_s=mmr_s)
+            for bbo_user, (mmr_m, mmr_s) in zip(self.index, self.ratings[:len(self.index)].tolist())
+        ]
+
+
+class _Round:
+    # Challenges with pairwise disjoint players, which can be rated in one vectorized call.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.players = set()
+        self.heroes = []
+        self.villains = []
+        self.hero_wins = []
+
+    def add(self, hero_ix, villain_ix, hero_win):
+        self.players.update((hero_ix, villain_ix))
+        self.heroes.append(hero_ix)
+        self.villains.append(villain_ix)
+        self.hero_wins.append(hero_win)
+
+    def apply(self, table):
+        if not self.heroes:
+            return
+        heroes, villains = self.heroes, self.villains
+        table.ratings[heroes], table.ratings[villains] = rating.update_pairs(
+            table.ratings[heroes], table.ratings[villains], self.hero_wins)
+        self.reset()
+
+
+def _challenge_results(session, after=None, yield_per=5000):
+    query = select(
+        FriendChallenge.match_id,
+        FriendChallenge.created_at,
+        FriendChallenge.hero,
+        FriendChallenge.villain,
+        FriendChallenge.hero_total,
+        FriendChallenge.villain_total,
+    ).where(FriendChallenge.board_count > 0)
+    if after is not None:
+        query = query.where(or_(
+            FriendChallenge.created_at > after.last_created_at,
+            and_(
+                FriendChallenge.created_at == after.last_created_at,
+                FriendChallenge.match_id > after.last_match_id
+            )
+        ))
+    query = query.order_by(FriendChallenge.created_at, FriendChallenge.match_id)
+    return session.execute(query).yield_per(yield_per)
+
+
+def _restore_checkpoint(session, since):
+    checkpoint = None
+    if since is not None:
+        checkpoint = session.execute(
+            select(MMRCheckpoint)
+            .where(MMRCheckpoint.last_created_at < since)
+            .order_by(MMRCheckpoint.checkpoint_id.desc())
+            .limit(1)
+        ).scalar()
+    # Every checkpoint after the one we restore from is invalidated by the replay.
+    stale_ids = select(MMRCheckpoint.checkpoint_id)
+    if checkpoint is not None:
+        stale_ids = stale_ids.where(MMRCheckpoint.checkpoint_id > checkpoint.checkpoint_id)
+    session.execute(delete(MMRCheckpointRating.__table__).where(MMRCheckpointRating.checkpoint_id.in_(stale_ids)))
+    session.execute(delete(MMRCheckpoint.__table__).where(MMRCheckpoint.checkpoint_id.in_(stale_ids)))
+
+    table = _RatingTable()
+    if checkpoint is not None:
+        for bbo_user, mmr_m, mmr_s in session.execute(
+            select(MMRCheckpointRating.bbo_user, MMRCheckpointRating.mmr_m, MMRCheckpointRating.mmr_s)
+            .where(MMRCheckpointRating.checkpoint_id == checkpoint.checkpoint_id)
+        ):
+            table.add(bbo_user, mmr_m, mmr_s)
+    return checkpoint, table
+
+
+def _save_checkpoint(session, table, challenge_count, last_created_at, last_match_id):
+    checkpoint_id = session.execute(
+        insert(MMRCheckpoint).values(
+            challenge_count=challenge_count,
+            last_created_at=last_created_at,
+            last_match_id=last_match_id
+        )
+    ).inserted_primary_key[0]
+    if not table:
+        return
+    session.execute(
+        insert(MMRCheckpointRating.__table__).values(
+            checkpoint_id=bindparam('_checkpoint_id'),
+            bbo_user=bindparam('_bbo_user'),
+            mmr_m=bindparam('_mmr_m'),
+            mmr_s=bindparam('_mmr_s'),
+        ),
+        table.rows(_checkpoint_id=checkpoint_id)
+    )
+
+
+def replay_mmr(session, since=None, checkpoint_interval=1000):
+    # Recomputes every BBOProfile rating from the challenge history. When `since` is given, only challenges
+    # created at or after it are replayed, starting from the latest checkpoint that precedes them.
+    checkpoint, table = _restore_checkpoint(session, since)
+    challenge_count = checkpoint.challenge_count if checkpoint else 0
+    current_round = _Round()
+
+    for match_id, created_at, hero, villain, hero_total, villain_total in _challenge_results(session, checkpoint):
+        challenge_count += 1
+        # There is no draw model, so tied challenges do not move ratings.
+        if hero_total != villain_total:
+            hero_ix, villain_ix = table.lookup(hero), table.lookup(villain)
+            if hero_ix in current_round.players or villain_ix in current_round.players:
+                current_round.apply(table)
+            current_round.add(hero_ix, villain_ix, hero_total > villain_total)
+        if challenge_count % checkpoint_interval == 0:
+            current_round.apply(table)
+            _save_checkpoint(session, table, challenge_count, created_at, match_id)
+    current_round.apply(table)
+    # Every profile is written, so ratings left over from before the replayed history do not survive it.
+    table.add_missing(session.execute(select(BBOProfile.bbo_user)).scalars())
+
+    if table:
+        session.execute(
+            update(BBOProfile.__table__)
+            .where(BBOProfile.__table__.c.bbo_user == bindparam('_bbo_user'))
+            .values(mmr_m=bindparam('_mmr_m'), mmr_s=bindparam('_mmr_s')),
+            table.rows()
+        )
+        leaderboard.rankings.touch(
+            session,
+            ((bbo_user, mmr_m, mmr_s) for bbo_user, (mmr_m, mmr_s) in zip(table.index, table.ratings.tolist())),
+            known_only=True)
+    return challenge_count - (checkpoint.challenge_count if checkpoint else 0)
@@ -0,0 +1,208 @@
+import math
+
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer
+from sqlalchemy import and_, delete, insert, or_, select, update
+
+from .basic import Base
+from .challenge import FriendChallenge
+from .tournament import TeamRREntry, TournamentState, tournament_cache
+
+# WBF continuous victory point scale: 20 VPs are split by a golden-ratio curve of the IMP margin per sqrt(boards).
+_TAU = (math.sqrt(5.0) - 1.0) / 2.0
+
+
+class TeamRRMatch(Base):
+    __tablename__ = "teamrr_match"
+    __table_args__ = (Index("ix_teamrr_match_tournament_teams", "tournament_id", "home_team", "away_team"),)
+
+    rr_match_id = Column(Integer, primary_key=True, autoincrement=True)
+    tournament_id = Column(Integer, ForeignKey("teamrr_tournament.tournament_id"), nullable=False)
+    round_number = Column(Integer, nullable=False)
+    home_team = Column(Integer, nullable=False)
+    # None when home_team has a bye this round.
+    away_team = Column(Integer)
+    home_imps = Column(Float, nullable=False, default=0.0)
+    away_imps = Column(Float, nullable=False, default=0.0)
+    boards = Column(Integer, nullable=False, default=0)
+    home_vps = Column(Float)
+    away_vps = Column(Float)
+
+
+class TeamRRSegment(Base):
+    __tablename__ = "teamrr_segment"
+
+    match_id = Column(Integer, ForeignKey("bbo_friend_challenge.match_id"), primary_key=True)
+    rr_match_id = Column(Integer, ForeignKey("teamrr_match.rr_match_id"), nullable=False, index=True)
+
+
+class TeamRRStanding(Base):
+    __tablename__ = "teamrr_standing"
+
+    tournament_id = Column(Integer, ForeignKey("teamrr_tournament.tournament_id"), primary_key=True)
+    team_number = Column(Integer, primary_key=True)
+    played = Column(Integer, nullable=False, default=0)
+    won = Column(Integer, nullable=False, default=0)
+    drawn = Column(Integer, nullable=False, default=0)
+    lost = Column(Integer, nullable=False, default=0)
+    imps_for = Column(Float, nullable=False, default=0.0)
+    imps_against = Column(Float, nullable=False, default=0.0)
+    victory_points = Column(Float, nullable=False, default=0.0)
+
+    @property
+    def imp_difference(self):
+        return self.imps_for - self.imps_against
+
+
+def round_robin_schedule(number_of_teams):
+    # Circle method: team 0 stays put while the others rotate one seat per round. With an odd number of teams the
+    # empty seat (None) is the bye. Team 0 alternates home and away so no team hosts every match.
+    seats = list(range(number_of_teams)) + ([None] if number_of_teams % 2 else [])
+    rounds = []
+    for round_number in range(len(seats) - 1):
+        pairs = [(seats[ix], seats[-1 - ix]) for ix in range(len(seats) // 2)]
+        if round_number % 2:
+            pairs[0] = pairs[0][::-1]
+        rounds.append([(home, away) if home is not None else (away, home) for home, away in pairs])
+        seats.insert(1, seats.pop())
+    return rounds
+
+
+def victory_points(imp_margin, boards):
+    if boards <= 0:
+        return 10.0, 10.0
+    winner = min(
+        20.0, 10.0 + 10.0 * (1.0 - _TAU ** (3.0 * abs(imp_margin) / (15.0 * math.sqrt(boards)))) / (1.0 - _TAU ** 3))
+    winner = round(winner, 2)
+    return (winner, round(20.0 - winner, 2)) if imp_margin >= 0 else (round(20.0 - winner, 2), winner)
+
+
+def create_schedule(session, tournament):
+    # Replaces any previous schedule of the tournament, so starting it again reschedules from scratch.
+    rr_match_ids = select(TeamRRMatch.rr_match_id).where(TeamRRMatch.tournament_id == tournament.tournament_id)
+    session.execute(delete(TeamRRSegment.__table__).where(TeamRRSegment.rr_match_id.in_(rr_match_ids)))
+    for table in (TeamRRMatch.__table__, TeamRRStanding.__table__):
+        session.execute(delete(table).where(table.c.tournament_id == tournament.tournament_id))
+
+    session.execute(insert(TeamRRMatch.__table__), [
+        dict(tournament_id=tournament.tournament_id, round_number=round_number, home_team=home, away_team=away)
+        for round_number, pairs in enumerate(round_robin_schedule(tournament.number_of_teams))
+        for home, away in pairs
+    ])
+    session.execute(insert(TeamRRStanding.__table__), [
+        dict(tournament_id=tournament.tournament_id, team_number=team_number)
+        for team_number in range(tournament.number_of_teams)
+    ])
+
+
+def _update_standing(session, tournament_id, team_number, imps_for, imps_against, vps, sign):
+    # Adds (sign=1) or removes (sign=-1) one match result from a team's running totals.
+    session.execute(
+        update(TeamRRStanding)
+        .where(TeamRRStanding.tournament_id == tournament_id, TeamRRStanding.team_number == team_number)
+        .values(
+            played=TeamRRStanding.played + sign,
+            won=TeamRRStanding.won + sign * (imps_for > imps_against),
+            drawn=TeamRRStanding.drawn + sign * (imps_for == imps_against),
+            lost=TeamRRStanding.lost + sign * (imps_for < imps_against),
+            imps_for=TeamRRStanding.imps_for + sign * imps_for,
+            imps_against=TeamRRStanding.imps_against + sign * imps_against,
+            victory_points=TeamRRStanding.victory_points + sign * vps,
+        )
+    )
+
+
+def _update_match_standings(session, rr_match, sign):
+    if rr_match.home_vps is None:
+        return
+    _update_standing(
+        session, rr_match.tournament_id, rr_match.home_team,
+        rr_match.home_imps, rr_match.away_imps, rr_match.home_vps, sign)
+    _update_standing(
+        session, rr_match.tournament_id, rr_match.away_team,
+        rr_match.away_imps, rr_match.home_imps, rr_match.away_vps, sign)
+
+
+def _add_to_match(session, rr_match, friend_challenge, hero_team, sign):
+    # Adds (sign=1) or removes (sign=-1) a challenge's totals from its match. The match's previous contribution to
+    # the standings is swapped for the new one, and a match left without boards is unplayed again.
+    hero_imps, villain_imps = friend_challenge.hero_total, friend_challenge.villain_total
+    if rr_match.home_team != hero_team:
+        hero_imps, villain_imps = villain_imps, hero_imps
+    _update_match_standings(session, rr_match, -1)
+    rr_match.home_imps += sign * hero_imps
+    rr_match.away_imps += sign * villain_imps
+    rr_match.boards += sign * friend_challenge.board_count
+    if rr_match.boards > 0:
+        rr_match.home_vps, rr_match.away_vps = victory_points(
+            rr_match.home_imps - rr_match.away_imps, rr_match.boards)
+    else:
+        rr_match.home_imps = rr_match.away_imps = 0.0
+        rr_match.home_vps = rr_match.away_vps = None
+    _update_match_standings(session, rr_match, 1)
+
+
+def update_segment(session, friend_challenge, sign):
+    # Adds (sign=1) or removes (sign=-1) the current totals of an already recorded challenge, for when the page
+    # behind it changes. Does nothing if the challenge is not a segment.
+    segment = session.get(TeamRRSegment, friend_challenge.match_id)
+    if segment is None:
+        return
+    rr_match = session.get(TeamRRMatch, segment.rr_match_id)
+    hero_team = session.execute(
+        select(TeamRREntry.team_number).where(
+            TeamRREntry.tournament_id == rr_match.tournament_id, TeamRREntry.bbo_user == friend_challenge.hero)
+    ).scalar()
+    _add_to_match(session, rr_match, friend_challenge, hero_team, sign)
+
+
+def record_segment(session, tournament, friend_challenge):
+    # Adds a challenge between members of two scheduled teams to their match. Each segment costs two standing
+    # updates however far along the tournament is. Returns the updated match, or None if the challenge is not part
+    # of the tournament or is already recorded.
+    if session.get(TeamRRSegment, friend_challenge.match_id) is not None:
+        return None
+    teams = dict(session.execute(
+        select(TeamRREntry.bbo_user, TeamRREntry.team_number).where(
+            TeamRREntry.tournament_id == tournament.tournament_id,
+            TeamRREntry.bbo_user.in_((friend_challenge.hero, friend_challenge.villain))
+        )
+    ).all())
+    hero_team, villain_team = teams.get(friend_challenge.hero), teams.get(friend_challenge.villain)
+    if hero_team is None or villain_team is None or hero_team == villain_team:
+        return None
+    rr_match = session.execute(
+        select(TeamRRMatch).where(
+            TeamRRMatch.tournament_id == tournament.tournament_id,
+            or_(
+                and_(TeamRRMatch.home_team == hero_team, TeamRRMatch.away_team == villain_team),
+                and_(TeamRRMatch.home_team == villain_team, TeamRRMatch.away_team == hero_team),
+            )
+        )
+    ).scalars().first()
+    if rr_match is None:
+        return None
+
+    _add_to_match(session, rr_match, friend_challenge, hero_team, 1)
+    session.add(TeamRRSegment(match_id=friend_challenge.match_id, rr_match_id=rr_match.rr_match_id))
+    return rr_match
+
+
+def record_active_segment(session, match_id):
+    tournament = tournament_cache.get(session)
+    if tournament is None or tournament.state is not TournamentState.STARTED:
+        return None
+    return record_segment(session, tournament, session.get(FriendChallenge, match_id))
+
+
+def get_standings(session, tournament):
+    # Ranked by VPs, then IMP difference, then IMPs scored.
+    return session.execute(
+        select(TeamRRStanding)
+        .where(TeamRRStanding.tournament_id == tournament.tournament_id)
+        .order_by(
+            TeamRRStanding.victory_points.desc(),
+            (TeamRRStanding.imps_for - TeamRRStanding.imps_against).desc(),
+            TeamRRStanding.imps_for.desc(),
+            TeamRRStanding.team_number,
+        )
+    ).scalars().all()
@@ -0,0 +1,192 @@
+from sqlalchemy import Column, Enum, Float, Integer, String
+from sqlalchemy import bindparam, delete, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .basic import Base
+from .challenge import FriendChallenge, FriendChallengeBoard, ScoringMethod
+
+
+class _StatsMixin:
+    matches = Column(Integer, nullable=False, default=0)
+    wins = Column(Integer, nullable=False, default=0)
+    draws = Column(Integer, nullable=False, default=0)
+    losses = Column(Integer, nullable=False, default=0)
+    boards = Column(Integer, nullable=False, default=0)
+    # Sums of the per-board matchscores: IMPs, or MP percentages for matchpoint challenges.
+    score_for = Column(Float, nullable=False, default=0.0)
+    score_against = Column(Float, nullable=False, default=0.0)
+
+    @property
+    def net_per_board(self):
+        return (self.score_for - self.score_against) / self.boards if self.boards else 0.0
+
+    @property
+    def average_per_board(self):
+        return self.score_for / self.boards if self.boards else 0.0
+
+
+class PlayerStats(Base, _StatsMixin):
+    __tablename__ = "bbo_player_stats"
+
+    bbo_user = Column(String, primary_key=True)
+    scoring_method = Column(Enum(ScoringMethod), primary_key=True)
+
+
+class HeadToHeadStats(Base, _StatsMixin):
+    # Stored once from each player's side, so either player finds the pair with a primary key lookup.
+    __tablename__ = "bbo_head_to_head_stats"
+
+    bbo_user = Column(String, primary_key=True)
+    opponent = Column(String, primary_key=True)
+    scoring_method = Column(Enum(ScoringMethod), primary_key=True)
+
+
+_COUNTERS = ("matches", "wins", "draws", "losses", "boards", "score_for", "score_against")
+
+
+def _side_rows(challenge, sign=1):
+    # One row per player of a challenge row (hero, villain, scoring_method, hero_total, villain_total, board_count);
+    # sign=-1 gives the rows that take the challenge back out of the aggregates.
+    hero, villain, scoring_method, hero_total, villain_total, board_count = challenge
+    for player, opponent, score_for, score_against in (
+        (hero, villain, hero_total, villain_total),
+        (villain, hero, villain_total, hero_total),
+    ):
+        yield dict(
+            bbo_user=player, opponent=opponent, scoring_method=scoring_method, matches=sign,
+            wins=sign * int(score_for > score_against), draws=sign * int(score_for == score_against),
+            losses=sign * int(score_for < score_against), boards=sign * board_count,
+            score_for=sign * score_for, score_against=sign * score_against,
+        )
+
+
+def _upsert(session, model, rows):
+    upsert = sqlite_insert(model.__table__)
+    session.execute(
+        upsert.on_conflict_do_update(
+            index_elements=list(model.__table__.primary_key.columns),
+            set_={key: model.__table__.c[key] + upsert.excluded[key] for key in _COUNTERS}
+        ),
+        rows
+    )
+
+
+def record_challenge_stats(session, challenges, sign=1):
+    # Adds newly stored challenges to the aggregates, or with sign=-1 removes challenges that are about to change.
+    # challenges are FriendChallenge objects with their totals set.
+    rows = [
+        row
+        for challenge in challenges
+        if challenge.hero is not None and challenge.villain is not None and challenge.scoring_method is not None
+        for row in _side_rows((
+            challenge.hero, challenge.villain, challenge.scoring_method,
+            challenge.hero_total, challenge.villain_total, challenge.board_count
+        ), sign)
+    ]
+    if not rows:
+        return
+    _upsert(session, HeadToHeadStats, rows)
+    _upsert(session, PlayerStats, [{key: value for key, value in row.items() if key != "opponent"} for row in rows])
+
+
+def get_stats(session, bbo_user, opponent=None):
+    # {scoring_method: stats row}, read by primary key prefix.
+    if opponent is None:
+        query = select(PlayerStats).where(PlayerStats.bbo_user == bbo_user)
+    else:
+        query = select(HeadToHeadStats).where(
+            HeadToHeadStats.bbo_user == bbo_user, HeadToHeadStats.opponent == opponent)
+    return {stats.scoring_method: stats for stats in session.execute(query).scalars()}
+
+
+def _aggregate(np, keys, columns):
+    # Sums every column over the rows sharing a key; keys is a 2d integer array, one row per input row.
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    return unique_keys, {
+        name: np.bincount(inverse, weights=values, minlength=len(unique_keys)) for name, values in columns.items()}
+
+
+def rebuild_stats(session):
+    # Recomputes the challenge totals and both aggregate tables from FriendChallengeBoard. Each table is pulled
+    # column-wise and reduced with NumPy, so the cost is a few passes over arrays rather than per-row Python.
+    import numpy as np
+
+    board_columns = session.execute(select(
+        FriendChallengeBoard.match_id, FriendChallengeBoard.hero_matchscore, FriendChallengeBoard.villain_matchscore
+    )).all()
+    board_match_ids, hero_scores, villain_scores = (
+        np.array(column, dtype=float) for column in zip(*board_columns)) if board_columns else (np.empty(0),) * 3
+    challenge_columns = session.execute(select(
+        FriendChallenge.match_id, FriendChallenge.hero, FriendChallenge.villain, FriendChallenge.scoring_method
+    ).order_by(FriendChallenge.match_id)).all()
+    session.execute(delete(PlayerStats.__table__))
+    session.execute(delete(HeadToHeadStats.__table__))
+    if not challenge_columns:
+        return 0
+    match_ids, heroes, villains, scoring_methods = zip(*challenge_columns)
+    match_ids = np.array(match_ids)
+
+    # Totals per challenge: boards are mapped onto the sorted match ids and summed with bincount.
+    board_ix = np.searchsorted(match_ids, board_match_ids.astype(match_ids.dtype))
+    hero_totals = np.bincount(board_ix, weights=np.nan_to_num(hero_scores), minlength=len(match_ids))
+    villain_totals = np.bincount(board_ix, weights=np.nan_to_num(villain_scores), minlength=len(match_ids))
+    board_counts = np.bincount(board_ix, minlength=len(match_ids))
+    session.execute(
+        update(FriendChallenge.__table__)
+        .where(FriendChallenge.__table__.c.match_id == bindparam('_match_id'))
+        .values(hero_total=bindparam('_hero_total'), villain_total=bindparam('_villain_total'),
+                board_count=bindparam('_board_count')),
+        [
+            dict(_match_id=match_id, _hero_total=hero_total, _villain_total=villain_total, _board_count=board_count)
+            for match_id, hero_total, villain_total, board_count in zip(
+                match_ids.tolist(), hero_totals.tolist(), villain_totals.tolist(), board_counts.tolist())
+        ]
+    )
+
+    # Both sides of every challenge, as integer codes for player, opponent and scoring method. Challenges missing a
+    # player or a scoring method keep their totals but are left out of the aggregates.
+    complete = np.array([
+        hero is not None and villain is not None and method is not None
+        for hero, villain, method in zip(heroes, villains, scoring_methods)
+    ], dtype=bool)
+    players, player_codes = np.unique(
+        np.array([player or "" for player in heroes + villains], dtype=str), return_inverse=True)
+    hero_codes, villain_codes = np.split(player_codes.reshape(-1), 2)
+    method_codes = np.array([ScoringMethod(method).value if method is not None else -1 for method in scoring_methods])
+    complete = np.concatenate((complete, complete))
+    player_codes = np.concatenate((hero_codes, villain_codes))[complete]
+    opponent_codes = np.concatenate((villain_codes, hero_codes))[complete]
+    method_codes = np.concatenate((method_codes, method_codes))[complete]
+    score_for = np.concatenate((hero_totals, villain_totals))[complete]
+    score_against = np.concatenate((villain_totals, hero_totals))[complete]
+    columns = dict(
+        matches=np.ones(len(score_for)),
+        wins=(score_for > score_against).astype(float),
+        draws=(score_for == score_against).astype(float),
+        losses=(score_for < score_against).astype(float),
+        boards=np.concatenate((board_counts, board_counts))[complete].astype(float),
+        score_for=score_for,
+        score_against=score_against,
+    )
+
+    for model, keys in (
+        (PlayerStats, np.stack((player_codes, method_codes), axis=1)),
+        (HeadToHeadStats, np.stack((player_codes, method_codes, opponent_codes), axis=1)),
+    ):
+        if not len(keys):
+            continue
+        unique_keys, sums = _aggregate(np, keys, columns)
+        key_rows = [
+            dict(bbo_user=players[key[0]], scoring_method=ScoringMethod(key[1]),
+                 **({"opponent": players[key[2]]} if len(key) > 2 else {}))
+            for key in unique_keys.tolist()
+        ]
+        session.execute(insert(model.__table__), [
+            dict(key_row, **{
+                name: int(value) if name not in ("score_for", "score_against") else value
+                for name, value in zip(_COUNTERS, row)
+            })
+            for key_row, row in zip(key_rows, zip(*(sums[name].tolist() for name in _COUNTERS)))
+        ])
+    return len(match_ids)
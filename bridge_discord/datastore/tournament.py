@@ -1,9 +1,10 @@
 import enum
+import threading
 
-from sqlalchemy import Column, ForeignKey, Enum, Integer, String
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, ForeignKey, Enum, Index, Integer, String, event, inspect, select
+from sqlalchemy.orm import make_transient_to_detached, relationship
 
-from .basic import Base, CreatedAtMixin
+from .basic import VERSION_POLL_INTERVAL, Base, CreatedAtMixin, DatastoreVersion, VersionPoller
 from .challenge import ScoringMethod
 
 
@@ -21,20 +22,80 @@ class TeamRRTournament(Base, CreatedAtMixin):
     scoring_method = Column(Enum(ScoringMethod), default=ScoringMethod.IMPS)
     segment_boards = Column(Integer, default=7)
     number_of_teams = Column(Integer, default=4)
-    state = Column(Enum(TournamentState))
+    state = Column(Enum(TournamentState), index=True)
 
     participants = relationship("TeamRREntry", backref="teamrr_tournament")
 
     @classmethod
     def get_active_tournament(cls, session):
-        return session.query(cls).where(cls.state != "Inactive").first()
+        return session.query(cls).where(cls.state.in_((TournamentState.SIGNUP, TournamentState.STARTED))).first()
 
 
 class TeamRREntry(Base):
     __tablename__ = "teamrr_entries"
+    __table_args__ = (Index("ix_teamrr_entries_tournament_team", "tournament_id", "team_number"),)
 
     tournament_id = Column(Integer, ForeignKey("teamrr_tournament.tournament_id"), primary_key=True)
     bbo_user = Column(String, ForeignKey("bbo_profile.bbo_user"), primary_key=True, nullable=False)
     team_number = Column(Integer, nullable=True)
 
     bbo_profile = relationship("BBOProfile", uselist=False, backref="teamrr_entries")
+
+
+class ActiveTournamentCache:
+    # The active tournament and its entrants, kept in memory. Writers call touch() in their transaction and this
+    # process drops its copy once the commit lands; other processes notice through the "tournament" VersionPoller.
+    # All methods run on the datastore thread.
+    def __init__(self, poll_interval=VERSION_POLL_INTERVAL):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._poller = VersionPoller("tournament", poll_interval)
+
+    def _load(self, session):
+        tournament = TeamRRTournament.get_active_tournament(session)
+        if tournament is None:
+            return None, frozenset()
+        values = {attribute.key: getattr(tournament, attribute.key)
+                  for attribute in inspect(TeamRRTournament).column_attrs}
+        participants = frozenset(session.execute(
+            select(TeamRREntry.bbo_user).where(TeamRREntry.tournament_id == tournament.tournament_id)
+        ).scalars())
+        return values, participants
+
+    def _current(self, session):
+        with self._lock:
+            snapshot = self._snapshot
+        if snapshot is None:
+            version = self._poller.read(session)
+        else:
+            version = self._poller.poll(session)
+            if version is None:
+                return snapshot
+        snapshot = self._load(session)
+        with self._lock:
+            self._snapshot = snapshot
+        self._poller.record(version)
+        return snapshot
+
+    def get(self, session):
+        # The active tournament attached to session, or None. Changes to it are flushed with the session as usual.
+        values, _ = self._current(session)
+        if values is None:
+            return None
+        tournament = TeamRRTournament(**values)
+        make_transient_to_detached(tournament)
+        return session.merge(tournament, load=False)
+
+    def participants(self, session):
+        return self._current(session)[1]
+
+    def invalidate(self, *args):
+        with self._lock:
+            self._snapshot = None
+
+    def touch(self, session):
+        DatastoreVersion.bump(session, "tournament")
+        event.listen(session, "after_commit", self.invalidate, once=True)
+
+
+tournament_cache = ActiveTournamentCache()
@@ -1,9 +1,15 @@
+import datetime
+import logging
+
 import interactions
 
-from bridge_discord import datastore
+from bridge_discord import datastore, metrics
 
 
 class ChallengeExtension(interactions.Extension):
+    def __init__(self, client):
+        self.ingestion = datastore.IngestionQueue(self.deliver_ingestion)
+
     @interactions.extension_command(
         name="parse_imp_challenge",
         description="Parses an IMP friend challenge from BBO.",
@@ -16,53 +22,198 @@ class ChallengeExtension(interactions.Extension):
             ),
         ],
     )
+    @metrics.instrumented
     async def parse_imp_challenge(self, ctx: interactions.CommandContext, matchlink: str):
-        with datastore.Session() as session:
+        # Fetching and parsing can outlast the interaction deadline, so the command only queues the link and the
+        # result arrives as a follow-up.
+        try:
+            datastore.FriendChallenge.validate_matchlink(datastore.normalize_matchlink(matchlink))
+        except ValueError as e:
+            await ctx.send(",".join(e.args), ephemeral=True)
+            return
+        await ctx.defer()
+        await self.ingestion.enqueue(matchlink, int(ctx.channel_id), int(ctx.author.id), ctx)
+
+    async def challenge_embed(self, match_id, rr_match_id):
+        async with datastore.AsyncSession() as session:
+            friend_challenge = await session.run_sync(datastore.FriendChallenge.get_with_profiles, match_id)
+            rr_match = await session.get(datastore.TeamRRMatch, rr_match_id) if rr_match_id is not None else None
+
+        line_sep = '\n+----+---------------+---------------+-----+\n'
+        hero_str = (
+            friend_challenge.hero_profile.to_str_with_mention()
+            if friend_challenge.hero_profile
+            else friend_challenge.hero
+        )
+        villain_str = (
+            friend_challenge.villain_profile.to_str_with_mention()
+            if friend_challenge.villain_profile
+            else friend_challenge.villain
+        )
+        embed = interactions.Embed(
+            title=f"{friend_challenge.scoring_method.name} Challenge",
+            description=(
+                f"**{hero_str}** - ({friend_challenge.hero_total:g}) \n"
+                f"**{villain_str}** - ({friend_challenge.villain_total:g})"
+            ),
+            fields=[
+                interactions.EmbedField(
+                    name='Board Details',
+                    value=(
+                        f'```     |{friend_challenge.hero:^15}|{friend_challenge.villain:^15}|{"imps":10}' +
+                        line_sep +
+                        line_sep.join(
+                            (
+                                f'|{i+1:^4}|{board.hero_result:<8}|{board.hero_score:<6d}|'
+                                f'{board.villain_result:<8}|{board.villain_score:<6d}|'
+                                f'{board.hero_matchscore or "":<2}|{board.villain_matchscore or "":<2}|'
+                            )
+                            for i, board in enumerate(friend_challenge.boards)
+                        ) +
+                        line_sep + "```"
+                    )
+                ),
+            ]
+        )
+        if rr_match is not None:
+            embed.add_field(
+                name=f"Team RR Round {rr_match.round_number + 1}",
+                value=(
+                    f"Team {rr_match.home_team + 1} {rr_match.home_imps:g} - {rr_match.away_imps:g} "
+                    f"Team {rr_match.away_team + 1} ({rr_match.home_vps:.2f} - {rr_match.away_vps:.2f} VPs)"
+                )
+            )
+        return embed
+
+    async def deliver_ingestion(self, jobs, result, error):
+        embed = None
+        if error is None:
+            try:
+                embed = await self.challenge_embed(*result)
+            except Exception:
+                logging.exception("Rendering challenge %s failed.", result[0])
+                error = "The challenge was recorded, but displaying it failed."
+        for job in jobs:
+            try:
+                await self._deliver_job(job, embed, error)
+            except Exception:
+                logging.exception("Delivering ingestion job %s failed.", job.job_id)
+
+    async def _deliver_job(self, job, embed, error):
+        if job.ctx is not None:
             try:
-                friend_challenge = datastore.FriendChallenge.init_from_matchlink(matchlink)
-            except ValueError as e:
-                await ctx.send(",".join(e.args), ephemeral=True)
+                await job.ctx.send(error or "", embeds=embed)
                 return
-            session.add(friend_challenge)
-            friend_challenge = session.merge(friend_challenge)
-
-            line_sep = '\n+----+---------------+---------------+-----+\n'
-            hero_str = (
-                await friend_challenge.hero_profile.to_str_with_linked_mention(self.client)
-                if friend_challenge.hero_profile
-                else friend_challenge.hero
-            )
-            villain_str = (
-                await friend_challenge.hero_profile.to_str_with_linked_mention(self.client)
-                if friend_challenge.villain_profile
-                else friend_challenge.villain
+            except interactions.LibraryException:
+                # The interaction token expired, fall back to the channel.
+                pass
+        channel = await interactions.get(self.client, interactions.Channel, object_id=job.channel_id)
+        await channel.send(f"<@{job.requested_by}> {error or ''}", embeds=embed)
+
+    @interactions.extension_listener(name="on_ready")
+    async def start_ingestion(self):
+        # Resumes the jobs left pending by the last run; on_ready fires again after a reconnect, start() is idempotent.
+        await self.ingestion.start()
+
+    @interactions.extension_command(
+        name="replay_mmr",
+        description="Recomputes all ratings from the friend challenge history.",
+        default_member_permissions=interactions.Permissions.MANAGE_MESSAGES,
+        options=[
+            interactions.Option(
+                name="since",
+                description="Only replay challenges from this date (YYYY-MM-DD) on, from the checkpoint before it.",
+                type=interactions.OptionType.STRING,
+            ),
+        ],
+    )
+    @metrics.instrumented
+    async def replay_mmr(self, ctx: interactions.CommandContext, since: str = None):
+        try:
+            since = datetime.datetime.fromisoformat(since) if since is not None else None
+        except ValueError:
+            await ctx.send("`since` must be a date such as 2024-01-31.", ephemeral=True)
+            return
+        async with datastore.AsyncSession() as session:
+            replayed = await session.run_and_commit(datastore.replay_mmr, since)
+        await ctx.send(f"Replayed {replayed} challenges.", ephemeral=True)
+
+    @interactions.extension_command(
+        name="stats",
+        description="Displays friend challenge statistics of a BBO user.",
+        options=[
+            interactions.Option(
+                name="bbo_user",
+                description="BBO user to show statistics for.",
+                type=interactions.OptionType.STRING,
+                required=True,
+            ),
+            interactions.Option(
+                name="opponent",
+                description="Only count challenges against this BBO user.",
+                type=interactions.OptionType.STRING,
+            ),
+        ],
+    )
+    @metrics.instrumented
+    async def stats(self, ctx: interactions.CommandContext, bbo_user: str, opponent: str = None):
+        async with datastore.AsyncSession() as session:
+            stats_by_method = await session.run_sync(datastore.get_stats, bbo_user, opponent)
+        subject = f"{bbo_user} vs {opponent}" if opponent else bbo_user
+        if not stats_by_method:
+            await ctx.send(f"No recorded challenges for {subject}.", ephemeral=True)
+            return
+        stats_embed = interactions.Embed(title=f"Challenge Stats: {subject}")
+        for scoring_method, stats in sorted(stats_by_method.items(), key=lambda item: item[0].value):
+            per_board = (
+                f"{stats.net_per_board:+.2f} IMPs/board" if scoring_method is datastore.ScoringMethod.IMPS
+                else f"{stats.average_per_board:.1f}% per board"
             )
-            embed = interactions.Embed(
-                title=f"{friend_challenge.scoring_method.name} Challenge",
-                description=(
-                    f"**{hero_str}** - ({sum(board.hero_matchscore for board in friend_challenge.boards)}) \n"
-                    f"**{villain_str}** - ({sum(board.villain_matchscore for board in friend_challenge.boards)})"
+            stats_embed.add_field(
+                name=scoring_method.name,
+                value=(
+                    f"Matches: {stats.matches} ({stats.wins}W {stats.draws}D {stats.losses}L)\n"
+                    f"Boards: {stats.boards}\n"
+                    f"Scored: {stats.score_for:g} - {stats.score_against:g} ({per_board})"
                 ),
-                fields=[
-                    interactions.EmbedField(
-                        name='Board Details',
-                        value=(
-                            f'```     |{friend_challenge.hero:^15}|{friend_challenge.villain:^15}|{"imps":10}' +
-                            line_sep +
-                            line_sep.join(
-                                (
-                                    f'|{i+1:^4}|{board.hero_result:<8}|{board.hero_score:<6d}|'
-                                    f'{board.villain_result:<8}|{board.villain_score:<6d}|'
-                                    f'{board.hero_matchscore or "":<2}|{board.villain_matchscore or "":<2}|'
-                                )
-                                for i, board in enumerate(friend_challenge.boards)
-                            ) +
-                            line_sep + "```"
-                        )
-                    ),
-                ]
+                inline=True
             )
-            await ctx.send(embeds=embed)
+        await ctx.send(embeds=stats_embed)
+
+    @interactions.extension_command(
+        name="rebuild_stats",
+        description="Recomputes challenge totals and player statistics from the stored boards.",
+        default_member_permissions=interactions.Permissions.MANAGE_MESSAGES,
+    )
+    @metrics.instrumented
+    async def rebuild_stats(self, ctx: interactions.CommandContext):
+        async with datastore.AsyncSession() as session:
+            rebuilt = await session.run_and_commit(datastore.rebuild_stats)
+        await ctx.send(f"Rebuilt statistics from {rebuilt} challenges.", ephemeral=True)
+
+    @interactions.extension_command(
+        name="bulk_ingest",
+        description="Ingests every BBO matchlink found in an uploaded text or CSV file.",
+        default_member_permissions=interactions.Permissions.MANAGE_MESSAGES,
+        options=[
+            interactions.Option(
+                name="links_file",
+                description="Text or CSV file containing BBO Friend Challenge Leaderboard links.",
+                type=interactions.OptionType.ATTACHMENT,
+                required=True,
+            ),
+        ],
+    )
+    @metrics.instrumented
+    async def bulk_ingest(self, ctx: interactions.CommandContext, links_file: interactions.Attachment):
+        await ctx.defer(ephemeral=True)
+        matchlinks = datastore.extract_matchlinks((await links_file.download()).read().decode(errors='replace'))
+        async with datastore.AsyncSession() as session:
+            report = await datastore.ingest_matchlinks(session, matchlinks)
+        failure_lines = [f"• {link}: {reason}" for link, reason in list(report.failures.items())[:10]]
+        if len(report.failures) > len(failure_lines):
+            failure_lines.append(f"... and {len(report.failures) - len(failure_lines)} more.")
+        await ctx.send("\n".join([report.summary(), *failure_lines])[:2000], ephemeral=True)
 
 
 def setup(client):
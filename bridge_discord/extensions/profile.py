@@ -1,7 +1,28 @@
 import interactions
 from sqlalchemy.exc import IntegrityError
 
-from bridge_discord import datastore
+from bridge_discord import datastore, metrics
+from bridge_discord.extensions import utilities
+
+MEMBER_SYNC_PAGE_SIZE = 1000
+
+
+def profile_description(session, discord_user):
+    profile_model = session.get(datastore.ServerProfile, discord_user)
+    if not profile_model:
+        return None
+    description = ""
+    if profile_model.bbo_main_account:
+        description += f"**BBO Username**: {profile_model.bbo_main_account.bbo_user}\n"
+    if profile_model.bbo_representing:
+        description += f"**Representing**: {', '.join(r.bbo_user for r in profile_model.bbo_representing)}\n"
+    return description or "No information to show."
+
+
+def touch_link(session, discord_user, bbo_user):
+    # The new profile enters the rankings and the identity cache once the link commits.
+    datastore.rankings.touch(session, [(bbo_user, datastore.rating.INITIAL_MU, datastore.rating.INITIAL_SIGMA)])
+    datastore.identities.touch(session, discord_user)
 
 
 class ProfileExtension(interactions.Extension):
@@ -29,6 +50,7 @@ class ProfileExtension(interactions.Extension):
             )
         ]
     )
+    @metrics.instrumented
     async def bbo_link(
         self,
         ctx: interactions.CommandContext,
@@ -37,13 +59,13 @@ class ProfileExtension(interactions.Extension):
         proxy: bool = False
     ):
         success = True
-        with datastore.Session() as session:
+        async with datastore.AsyncSession() as session:
             model_cls = datastore.BBORepresentative if proxy else datastore.BBOMain
             model = model_cls(bbo_user=bbo_user, discord_user=int(discord_user.id))
             session.add(model)
             session.add(datastore.BBOProfile(bbo_user=bbo_user))
             try:
-                session.commit()
+                await session.run_and_commit(touch_link, int(discord_user.id), bbo_user)
             except IntegrityError:
                 success = False
         await ctx.send(
@@ -65,19 +87,22 @@ class ProfileExtension(interactions.Extension):
             )
         ]
     )
+    @metrics.instrumented
     async def bbo_unlink(self, ctx: interactions.CommandContext, bbo_user: str):
         success = True
-        with datastore.Session() as session:
-            main_model = session.get(datastore.BBOMain, bbo_user)
+        async with datastore.AsyncSession() as session:
+            main_model = await session.get(datastore.BBOMain, bbo_user)
             if main_model:
-                session.delete(main_model)
-            representative_model = session.get(datastore.BBORepresentative, bbo_user)
+                await session.delete(main_model)
+            representative_model = await session.get(datastore.BBORepresentative, bbo_user)
             if representative_model:
-                session.delete(representative_model)
+                await session.delete(representative_model)
             if not (main_model or representative_model):
                 success = False
             else:
-                session.commit()
+                await session.run_and_commit(
+                    datastore.identities.touch,
+                    *(model.discord_user for model in (main_model, representative_model) if model))
         await ctx.send(
             f"Successfully unlinked {bbo_user}!" if success else
             f"Did not find entry for {bbo_user}!",
@@ -96,44 +121,81 @@ class ProfileExtension(interactions.Extension):
             )
         ]
     )
+    @metrics.instrumented
     async def profile(self, ctx: interactions.CommandContext, discord_user: interactions.Member):
-        with datastore.Session() as session:
-            profile_model = session.get(datastore.ServerProfile, int(discord_user.id))
-            if not profile_model:
-                await ctx.send("Failed to find profile for {discord_user.mention}!", ephemeral=True)
-                return
-            description = ""
-            if profile_model.bbo_main_account:
-                description += f"**BBO Username**: {profile_model.bbo_main_account.bbo_user}\n"
-            if profile_model.bbo_representing:
-                description += f"**Representing**: {', '.join(r.bbo_user for r in profile_model.bbo_representing)}\n"
-            description = description or "No information to show."
+        async with datastore.AsyncSession() as session:
+            description = await session.run_sync(profile_description, int(discord_user.id))
+        if description is None and int(discord_user.id) in datastore.pending_members:
+            # Joined moments ago, the profile is still in the write buffer.
+            description = "No information to show."
+        if description is None:
+            await ctx.send("Failed to find profile for {discord_user.mention}!", ephemeral=True)
+            return
         profile_embed = interactions.Embed(
             title=f"Card Games at 1430 Profile of User: `{discord_user.name}`",
             description=description
         )
         await ctx.send(embeds=profile_embed)
 
+    @interactions.extension_command(
+        name="leaderboard",
+        description="Displays the rating leaderboard.",
+        options=[
+            interactions.Option(
+                name="page",
+                description="Page of the leaderboard to show.",
+                type=interactions.OptionType.INTEGER,
+                min_value=1,
+            ),
+            interactions.Option(
+                name="bbo_user",
+                description="Show the page with this BBO user's rank instead.",
+                type=interactions.OptionType.STRING,
+            )
+        ]
+    )
+    @metrics.instrumented
+    async def leaderboard(self, ctx: interactions.CommandContext, page: int = 1, bbo_user: str = None):
+        async with datastore.AsyncSession() as session:
+            await session.run_sync(datastore.rankings.sync)
+        if bbo_user is not None:
+            rank = datastore.rankings.rank(bbo_user)
+            if rank is None:
+                await ctx.send(f"{bbo_user} does not have a rating yet.", ephemeral=True)
+                return
+            page = (rank - 1) // datastore.leaderboard.PAGE_SIZE + 1
+        page_count = datastore.rankings.page_count()
+        page = min(page, page_count)
+        lines = [
+            f"`{rank:>4}` {'**' + user + '**' if user == bbo_user else user} ({estimate:.0f})"
+            for rank, user, estimate in datastore.rankings.page(page)
+        ]
+        leaderboard_embed = interactions.Embed(
+            title=f"Rating Leaderboard (page {page}/{page_count})",
+            description="\n".join(lines) or "No rated players yet."
+        )
+        await ctx.send(embeds=leaderboard_embed)
+
     @interactions.extension_listener(name="on_guild_member_add")
+    @metrics.instrumented
     async def add_guild_member_to_db(self, member):
-        with datastore.Session() as session:
-            if not session.get(datastore.ServerProfile, int(member.id)):
-                model = datastore.ServerProfile(discord_user=int(member.id))
-                session.add(model)
-                session.commit()
+        # Buffered: a burst of joins is written as one upsert.
+        datastore.pending_members.add(int(member.id))
 
     @interactions.extension_listener(name="on_ready")
+    @metrics.instrumented
     async def sync_member_list(self):
-        all_discord_users = [int(m.id) async for m in self.client.guilds[0].get_members()]
-        with datastore.Session() as session:
-            for discord_user in all_discord_users:
-                model = session.get(datastore.ServerProfile, discord_user)
-                if model:
-                    continue
-                session.add(datastore.ServerProfile(discord_user=discord_user))
-            session.commit()
+        async with datastore.AsyncSession() as session:
+            known_users = await session.run_and_commit(datastore.ServerProfile.existing_ids)
+            # One short transaction per page, so the write lock is not held while members are being fetched.
+            async for page in utilities.paged(self.client.guilds[0].get_members(), MEMBER_SYNC_PAGE_SIZE):
+                new_users = {int(member.id) for member in page} - known_users
+                await session.run_and_commit(datastore.ServerProfile.bulk_insert, new_users)
+                known_users |= new_users
 
 
 def setup(client):
     datastore.setup_connection()
+    with datastore.Session() as session:
+        datastore.rankings.rebuild(session)
     ProfileExtension(client)
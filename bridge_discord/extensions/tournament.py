@@ -1,12 +1,11 @@
 import logging
-import random
 
-from boltons.iterutils import chunked
 import interactions
-from sqlalchemy import and_
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager
 
-from bridge_discord import datastore
+from bridge_discord import datastore, metrics
 from bridge_discord.extensions import utilities
 
 
@@ -18,6 +17,70 @@ def bbo_user_option_factory(description):
     )
 
 
+def tournament_entries(session, tournament):
+    # Everything the info view renders, participants through to their linked discord id, in one query.
+    return session.execute(
+        select(datastore.TeamRREntry)
+        .join(datastore.TeamRREntry.bbo_profile)
+        .where(datastore.TeamRREntry.tournament_id == tournament.tournament_id)
+        .options(
+            contains_eager(datastore.TeamRREntry.bbo_profile).joinedload(datastore.BBOProfile.discord_main)
+        )
+        .order_by(datastore.BBOProfile.conservative_mmr_estimate)
+    ).scalars().all()
+
+
+def representative_conflicts(session, tournament):
+    # (representative, represented) bbo_user pairs where both are entered, so they can be kept on different teams.
+    entered = select(datastore.TeamRREntry.bbo_user).where(
+        datastore.TeamRREntry.tournament_id == tournament.tournament_id)
+    return session.execute(
+        select(datastore.BBOMain.bbo_user, datastore.BBORepresentative.bbo_user)
+        .join(
+            datastore.BBORepresentative,
+            datastore.BBORepresentative.discord_user == datastore.BBOMain.discord_user
+        )
+        .where(datastore.BBOMain.bbo_user.in_(entered), datastore.BBORepresentative.bbo_user.in_(entered))
+    ).all()
+
+
+def assign_teams(session, tournament, balancer="variance"):
+    # Returns False, changing nothing, when the tournament is no longer in signup: the guard's copy may predate a
+    # /start that committed in the meantime.
+    session.refresh(tournament, ["state"])
+    if tournament.state is not datastore.TournamentState.SIGNUP:
+        return False
+    entries = tournament_entries(session, tournament)
+    player_ix = {entry_model.bbo_user: ix for ix, entry_model in enumerate(entries)}
+    conflicts = [
+        (player_ix[representative], player_ix[represented])
+        for representative, represented in representative_conflicts(session, tournament)
+    ]
+    teams = datastore.BALANCERS[balancer](
+        [(entry_model.bbo_profile.mmr_m, entry_model.bbo_profile.mmr_s) for entry_model in entries],
+        tournament.number_of_teams,
+        conflicts
+    )
+    for entry_model, team_number in zip(entries, teams):
+        entry_model.team_number = int(team_number)
+    datastore.create_schedule(session, tournament)
+    tournament.state = datastore.TournamentState.STARTED
+    datastore.tournament_cache.touch(session)
+    return True
+
+
+def drop_entry(session, tournament, bbo_user):
+    # Returns False when there is no entry to drop: the guard's cached participants predate a drop committed by
+    # another process, so the cache is reloaded on its next use.
+    entry_model = session.get(datastore.TeamRREntry, (tournament.tournament_id, bbo_user))
+    if entry_model is None:
+        datastore.tournament_cache.invalidate()
+        return False
+    session.delete(entry_model)
+    datastore.tournament_cache.touch(session)
+    return True
+
+
 class TeamRRManagerExtension(interactions.Extension):
     @interactions.extension_command(
         name="create",
@@ -32,12 +95,13 @@ class TeamRRManagerExtension(interactions.Extension):
             )
         ]
     )
+    @metrics.instrumented
     async def create(self, ctx, tournament_name):
-        with datastore.Session() as session:
+        async with datastore.AsyncSession() as session:
             session.add(
                 datastore.TeamRRTournament(state=datastore.TournamentState.SIGNUP, tournament_name=tournament_name)
             )
-            session.commit()
+            await session.run_and_commit(datastore.tournament_cache.touch)
         await ctx.send("Successfully created a new team round robin tournament!", ephemeral=True)
 
     @interactions.extension_command(
@@ -49,12 +113,16 @@ class TeamRRManagerExtension(interactions.Extension):
     )
     @utilities.SessionedGuard(
         active_tournament=utilities.assert_tournament_exists,
+        participants=utilities.tournament_participants,
         bbo_user=utilities.assert_bbo_rep
     )
     async def signup(self, ctx, *, bbo_user=None):
         guard = self.signup.coro
         if guard.active_tournament.state is not datastore.TournamentState.SIGNUP:
             await utilities.failed_guard(ctx, "The active tournament is not currently accepting signups.")
+        if guard.bbo_user in guard.participants:
+            await ctx.send("You are already signed up for the upcoming tournament.", ephemeral=True)
+            return
         guard.session.add(
             datastore.TeamRREntry(
                 tournament_id=guard.active_tournament.tournament_id,
@@ -62,7 +130,7 @@ class TeamRRManagerExtension(interactions.Extension):
             )
         )
         try:
-            guard.session.commit()
+            await guard.session.run_and_commit(datastore.tournament_cache.touch)
             await ctx.send("Signed up for the upcoming tournament!", ephemeral=True)
         except IntegrityError:
             await ctx.send("You are already signed up for the upcoming tournament.", ephemeral=True)
@@ -76,18 +144,18 @@ class TeamRRManagerExtension(interactions.Extension):
     )
     @utilities.SessionedGuard(
         active_tournament=utilities.assert_tournament_exists,
+        participants=utilities.tournament_participants,
         bbo_user=utilities.assert_bbo_rep
     )
     async def drop(self, ctx, *, bbo_user=None):
-        guard = self.drop_tournament.coro
-        entry_model = guard.session.get(datastore.TeamRREntry, (guard.active_tournament.tournament_id, guard.bbo_user))
-        if not entry_model:
+        guard = self.drop.coro
+        if guard.bbo_user not in guard.participants or not await guard.session.run_and_commit(
+                drop_entry, guard.active_tournament, guard.bbo_user):
             await ctx.send(
                 f"{guard.bbo_user} is not currently signed up for the upcoming tournament.",
                 ephemeral=True
             )
-        guard.session.delete(entry_model)
-        guard.session.commit()
+            return
         await ctx.send("Successfully dropped out from the upcoming tournament!", ephemeral=True)
 
     @interactions.extension_command(
@@ -96,7 +164,7 @@ class TeamRRManagerExtension(interactions.Extension):
     )
     @utilities.SessionedGuard(active_tournament=utilities.assert_tournament_exists)
     async def info(self, ctx):
-        guard = self.tournament_info.coro
+        guard = self.info.coro
 
         profile_embed = interactions.Embed(title=f"Team RR Tournament: {guard.active_tournament.tournament_name}")
         profile_embed.add_field(
@@ -111,21 +179,16 @@ class TeamRRManagerExtension(interactions.Extension):
             )
         )
         if guard.active_tournament.state is datastore.TournamentState.SIGNUP:
-            participant_strings = [
-                await entry_model.bbo_profile.to_str_with_linked_mention(self.client)
-                for entry_model in guard.active_tournament.participants
-            ]
+            entries = await guard.session.run_sync(tournament_entries, guard.active_tournament)
+            participant_strings = [entry_model.bbo_profile.to_str_with_mention() for entry_model in entries]
             profile_embed.add_field(name="Currently Registered Players", value="\n".join(participant_strings))
         elif guard.active_tournament.state is datastore.TournamentState.STARTED:
-            for team_number in range(guard.active_tournament.number_of_teams):
-                team_members = guard.session.query(
-                    datastore.TeamRREntry
-                ).join(datastore.BBOProfile).filter(
-                    and_(
-                        datastore.TeamRREntry.tournament_id == guard.active_tournament.tournament_id,
-                        datastore.TeamRREntry.team_number == team_number
-                    )
-                ).order_by(datastore.BBOProfile.conservative_mmr_estimate).all()
+            entries = await guard.session.run_sync(tournament_entries, guard.active_tournament)
+            teams = [[] for _ in range(guard.active_tournament.number_of_teams)]
+            for entry_model in entries:
+                if entry_model.team_number is not None:
+                    teams[entry_model.team_number].append(entry_model)
+            for team_number, team_members in enumerate(teams):
                 profile_embed.add_field(
                     name=f"Team {team_number + 1}",
                     value="\n".join(f"•{member.bbo_user}" for member in team_members),
@@ -136,29 +199,57 @@ class TeamRRManagerExtension(interactions.Extension):
     @interactions.extension_command(
         name="start",
         description="Ends the signup phase, starts matches.",
-        default_member_permissions=interactions.Permissions.MANAGE_MESSAGES
+        default_member_permissions=interactions.Permissions.MANAGE_MESSAGES,
+        options=[
+            interactions.Option(
+                name="balancer",
+                description="How players are split into teams (default: variance).",
+                type=interactions.OptionType.STRING,
+                choices=[interactions.Choice(name=name, value=name) for name in datastore.BALANCERS]
+            )
+        ]
     )
     @utilities.SessionedGuard(active_tournament=utilities.assert_tournament_exists)
-    async def start(self, ctx):
-        guard = self.start_tournament.coro
-
-        sorted_participants = sorted(
-            guard.active_tournament.participants, key=lambda p: p.bbo_profile.conservative_mmr_estimate, reverse=True)
-        for pot in chunked(sorted_participants, guard.active_tournament.number_of_teams):
-            random.shuffle(pot)
-            for ix, participant in enumerate(pot):
-                participant.team_number = ix
-        guard.active_tournament.state = datastore.TournamentState.STARTED
-        guard.session.commit()
+    async def start(self, ctx, balancer="variance"):
+        guard = self.start.coro
+        if guard.active_tournament.state is not datastore.TournamentState.SIGNUP:
+            await utilities.failed_guard(ctx, "The active tournament has already started.")
+
+        if not await guard.session.run_and_commit(assign_teams, guard.active_tournament, balancer):
+            await utilities.failed_guard(ctx, "The active tournament has already started.")
         await ctx.send("Tournament has been started and teams have been assigned.", ephemeral=True)
 
+    @interactions.extension_command(
+        name="standings",
+        description="Displays the standings of the currently running team round robin tournament.",
+    )
+    @utilities.SessionedGuard(active_tournament=utilities.assert_tournament_exists)
+    async def standings(self, ctx):
+        guard = self.standings.coro
+        if guard.active_tournament.state is not datastore.TournamentState.STARTED:
+            await utilities.failed_guard(ctx, "The active tournament has not started yet.")
+
+        standings = await guard.session.run_sync(datastore.get_standings, guard.active_tournament)
+        header = f'{"#":>2} {"Team":<7}{"P":>3}{"W":>3}{"D":>3}{"L":>3}{"IMPs+":>8}{"IMPs-":>8}{"VPs":>7}'
+        rows = [
+            f"{rank:>2} {f'Team {standing.team_number + 1}':<7}{standing.played:>3}{standing.won:>3}"
+            f"{standing.drawn:>3}{standing.lost:>3}{standing.imps_for:>8.1f}{standing.imps_against:>8.1f}"
+            f"{standing.victory_points:>7.2f}"
+            for rank, standing in enumerate(standings, start=1)
+        ]
+        await ctx.send(embeds=interactions.Embed(
+            title=f"Team RR Standings: {guard.active_tournament.tournament_name}",
+            description="```\n" + "\n".join([header, *rows]) + "\n```"
+        ))
+
 
 def setup(client):
     datastore.setup_connection()
     with datastore.Session() as session:
         active_tournament = session.query(
             datastore.TeamRRTournament
-        ).where(datastore.TeamRRTournament.state != datastore.TournamentState.INACTIVE).all()
+        ).where(datastore.TeamRRTournament.state.in_(
+            (datastore.TournamentState.SIGNUP, datastore.TournamentState.STARTED))).all()
         if active_tournament and len(active_tournament) > 1:
             logging.critical("There can only be one active Team RR tournament.")
             raise ValueError("Failed setup assumptions.")
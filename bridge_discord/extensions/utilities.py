@@ -1,6 +1,23 @@
+import asyncio
+import contextvars
 import functools
 
-from bridge_discord import datastore
+from bridge_discord import datastore, metrics
+
+
+class GuardFailed(Exception):
+    # Raised by guard coroutines with the message for the user.
+    pass
+
+
+# The GuardState of the command invocation running in the current task.
+_guard_state = contextvars.ContextVar("guard_state", default=None)
+
+
+class GuardState:
+    # Per invocation: the session and the result of each guard, stored under the guard's keyword.
+    def __init__(self, session):
+        self.session = session
 
 
 class SessionedGuard:
@@ -11,35 +28,78 @@ class SessionedGuard:
         coroutines_dict = self.guard_coroutines_dict
 
         class StateHolder:
+            # Commands read their guard results through `self.<command>.coro`, which is shared by every invocation.
+            # Attribute lookups are forwarded to the GuardState of the current invocation, so concurrent calls never
+            # see each other's session or results.
+            def __getattr__(self, name):
+                state = _guard_state.get()
+                if state is None or name.startswith("__"):
+                    raise AttributeError(name)
+                return getattr(state, name)
+
             async def __call__(self, *args, **kwargs):
-                with datastore.Session() as session:
-                    self.session = session
-                    for key, coro in coroutines_dict.items():
-                        result = await coro(self, args[1], **kwargs)
-                        setattr(self, key, result)
-                    return await func(*args, **kwargs)
+                async with metrics.track_command(func.__name__), datastore.AsyncSession() as session:
+                    state = GuardState(session)
+                    token = _guard_state.set(state)
+                    try:
+                        # Guards are independent of each other and run concurrently. When several fail, the user is
+                        # told about the first one in declaration order.
+                        results = await asyncio.gather(
+                            *(coro(state, args[1], **kwargs) for coro in coroutines_dict.values()),
+                            return_exceptions=True)
+                        for result in results:
+                            if isinstance(result, GuardFailed):
+                                await failed_guard(args[1], str(result))
+                            if isinstance(result, BaseException):
+                                raise result
+                        for key, result in zip(coroutines_dict, results):
+                            setattr(state, key, result)
+                        return await func(*args, **kwargs)
+                    finally:
+                        _guard_state.reset(token)
         return functools.wraps(func)(StateHolder())
 
 
+async def paged(async_iterable, page_size):
+    page = []
+    async for item in async_iterable:
+        page.append(item)
+        if len(page) == page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
 async def failed_guard(ctx, message):
     await ctx.send(message, ephemeral=True)
     raise ValueError("Failed guard.")
 
 
 async def assert_tournament_exists(guard_obj, ctx, **kwargs):
-    tournament = datastore.TeamRRTournament.get_active_tournament(guard_obj.session)
+    tournament = await guard_obj.session.run_sync(datastore.tournament_cache.get)
     if not tournament:
-        await failed_guard(ctx, "No tournament is currently running. Wait for one to start!")
+        raise GuardFailed("No tournament is currently running. Wait for one to start!")
     return tournament
 
 
-async def assert_bbo_rep(guard_obj, ctx, **kwargs):
-    bbo_user = kwargs.get('bbo_user')
-    profile = guard_obj.session.get(datastore.ServerProfile, int(ctx.user.id))
+async def tournament_participants(guard_obj, ctx, **kwargs):
+    return await guard_obj.session.run_sync(datastore.tournament_cache.participants)
+
+
+def resolve_bbo_rep(session, discord_user, bbo_user):
+    identity = datastore.identities.get(session, discord_user)
     if not bbo_user:
-        if not profile.bbo_main_account:
-            await failed_guard(ctx, "You are not linked to BBO. Contact a helper to link.")
-        bbo_user = profile.bbo_main_account.bbo_user
-    elif not profile.is_linked(bbo_user):
-        await failed_guard(ctx, f"You are not a representative of {bbo_user}. You cannot sign-up as them.")
+        if identity.main is None:
+            return None, "You are not linked to BBO. Contact a helper to link."
+        return identity.main, None
+    elif not identity.is_linked(bbo_user):
+        return None, f"You are not a representative of {bbo_user}. You cannot sign-up as them."
+    return bbo_user, None
+
+
+async def assert_bbo_rep(guard_obj, ctx, **kwargs):
+    bbo_user, failure = await guard_obj.session.run_sync(resolve_bbo_rep, int(ctx.user.id), kwargs.get('bbo_user'))
+    if failure:
+        raise GuardFailed(failure)
     return bbo_user
@@ -0,0 +1,251 @@
+import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+LOOP_LAG_INTERVAL = 0.5
+SUMMARY_INTERVAL = 60.0
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last count is the +Inf bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation, the best a histogram can tell.
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def prometheus_lines(self, name, labels=""):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}'
+        labels = f"{{{labels}}}" if labels else ""
+        yield f"{name}_sum{labels} {self.sum}"
+        yield f"{name}_count{labels} {self.count}"
+
+
+class _Invocation:
+    def __init__(self):
+        self.statements = 0
+
+
+class Registry:
+    # Observations come from the event loop and from the datastore thread, hence the lock.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.command_seconds = collections.defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.command_statements = collections.defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+        self.command_errors = collections.Counter()
+        self.statements = 0
+        self.loop_lag_seconds = Histogram(LATENCY_BUCKETS)
+        self.fetch_seconds = collections.defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.ingest_depth = 0
+        self.ingest_job_seconds = collections.defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+
+    def observe_command(self, command, seconds, statements, failed):
+        with self._lock:
+            self.command_seconds[command].observe(seconds)
+            self.command_statements[command].observe(statements)
+            self.command_errors[command] += failed
+
+    def observe_statement(self):
+        with self._lock:
+            self.statements += 1
+
+    def observe_loop_lag(self, seconds):
+        with self._lock:
+            self.loop_lag_seconds.observe(seconds)
+
+    def observe_fetch(self, outcome, seconds):
+        with self._lock:
+            self.fetch_seconds[outcome].observe(seconds)
+
+    def set_ingest_depth(self, depth):
+        with self._lock:
+            self.ingest_depth = depth
+
+    def observe_ingest_job(self, outcome, seconds):
+        with self._lock:
+            self.ingest_job_seconds[outcome].observe(seconds)
+
+    def prometheus_text(self):
+        with self._lock:
+            lines = [
+                "# HELP bridge_discord_command_seconds Latency of command and listener invocations.",
+                "# TYPE bridge_discord_command_seconds histogram",
+            ]
+            for command, histogram in sorted(self.command_seconds.items()):
+                lines.extend(histogram.prometheus_lines("bridge_discord_command_seconds", f'command="{command}"'))
+            lines += [
+                "# HELP bridge_discord_command_statements SQL statements executed per invocation.",
+                "# TYPE bridge_discord_command_statements histogram",
+            ]
+            for command, histogram in sorted(self.command_statements.items()):
+                lines.extend(histogram.prometheus_lines("bridge_discord_command_statements", f'command="{command}"'))
+            lines += [
+                "# HELP bridge_discord_command_errors_total Invocations that raised.",
+                "# TYPE bridge_discord_command_errors_total counter",
+            ]
+            lines.extend(
+                f'bridge_discord_command_errors_total{{command="{command}"}} {count}'
+                for command, count in sorted(self.command_errors.items())
+            )
+            lines += [
+                "# HELP bridge_discord_statements_total SQL statements executed.",
+                "# TYPE bridge_discord_statements_total counter",
+                f"bridge_discord_statements_total {self.statements}",
+                "# HELP bridge_discord_loop_lag_seconds Event loop scheduling delay.",
+                "# TYPE bridge_discord_loop_lag_seconds histogram",
+                *self.loop_lag_seconds.prometheus_lines("bridge_discord_loop_lag_seconds"),
+                "# HELP bridge_discord_fetch_seconds Latency of BBO page fetch attempts by outcome.",
+                "# TYPE bridge_discord_fetch_seconds histogram",
+            ]
+            for outcome, histogram in sorted(self.fetch_seconds.items()):
+                lines.extend(histogram.prometheus_lines("bridge_discord_fetch_seconds", f'outcome="{outcome}"'))
+            lines += [
+                "# HELP bridge_discord_ingest_queue_depth Matchlinks queued or being ingested in the background.",
+                "# TYPE bridge_discord_ingest_queue_depth gauge",
+                f"bridge_discord_ingest_queue_depth {self.ingest_depth}",
+                "# HELP bridge_discord_ingest_job_seconds Time from enqueueing a matchlink to delivering its result.",
+                "# TYPE bridge_discord_ingest_job_seconds histogram",
+            ]
+            for outcome, histogram in sorted(self.ingest_job_seconds.items()):
+                lines.extend(histogram.prometheus_lines("bridge_discord_ingest_job_seconds", f'outcome="{outcome}"'))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        with self._lock:
+            slowest = sorted(
+                self.command_seconds.items(), key=lambda item: item[1].quantile(0.95), reverse=True)[:3]
+            fetches = sum(histogram.count for histogram in self.fetch_seconds.values())
+            fetch_seconds = sum(histogram.sum for histogram in self.fetch_seconds.values())
+            ingest_jobs = sum(histogram.count for histogram in self.ingest_job_seconds.values())
+            ingest_seconds = sum(histogram.sum for histogram in self.ingest_job_seconds.values())
+            return (
+                f"commands={sum(histogram.count for histogram in self.command_seconds.values())} "
+                f"errors={sum(self.command_errors.values())} statements={self.statements} "
+                f"slowest_p95=[{', '.join(f'{command}<={h.quantile(0.95)}s' for command, h in slowest)}] "
+                f"loop_lag_p99<={self.loop_lag_seconds.quantile(0.99)}s max={self.loop_lag_seconds.max:.3f}s "
+                f"fetches={fetches} fetch_avg={fetch_seconds / fetches if fetches else 0.0:.3f}s "
+                f"ingest_depth={self.ingest_depth} ingest_jobs={ingest_jobs} "
+                f"ingest_avg={ingest_seconds / ingest_jobs if ingest_jobs else 0.0:.3f}s"
+            )
+
+
+registry = Registry()
+_invocation = contextvars.ContextVar("invocation", default=None)
+
+
+@contextlib.asynccontextmanager
+async def track_command(command):
+    # Times the block and counts the SQL statements it runs, including those on the datastore thread, which
+    # inherits the context. Nested blocks are folded into the outermost one.
+    if _invocation.get() is not None:
+        yield
+        return
+    invocation = _Invocation()
+    token = _invocation.set(invocation)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        _invocation.reset(token)
+        registry.observe_command(command, time.perf_counter() - start, invocation.statements, failed)
+
+
+def instrumented(func):
+    # For commands and listeners that do not go through SessionedGuard, which instruments itself.
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with track_command(func.__name__):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+def count_statement(*args):
+    # Engine "before_cursor_execute" listener.
+    invocation = _invocation.get()
+    if invocation is not None:
+        invocation.statements += 1
+    registry.observe_statement()
+
+
+async def sample_loop_lag(interval=LOOP_LAG_INTERVAL):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        registry.observe_loop_lag(max(time.perf_counter() - start - interval, 0.0))
+
+
+def write_textfile(path):
+    # Written to a temporary file and renamed, so a scraper never reads a partial file.
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.tmp", "w") as textfile:
+        textfile.write(registry.prometheus_text())
+    os.replace(f"{path}.tmp", path)
+
+
+async def _serve_http(port):
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.prometheus_text(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def run_exporter(config=None, name="bot"):
+    # config is the optional "metrics" section of the keyring: {"textfile": "metrics/{bot}.prom", "http_port": 9100,
+    # "summary_interval": 60}. Samples loop lag and, every summary_interval, logs a summary line and rewrites the
+    # text file. Runs until cancelled.
+    config = config or {}
+    textfile = config.get("textfile", "").format(bot=name)
+    runner = await _serve_http(config["http_port"]) if config.get("http_port") else None
+    lag_sampler = asyncio.ensure_future(sample_loop_lag())
+    try:
+        while True:
+            await asyncio.sleep(config.get("summary_interval", SUMMARY_INTERVAL))
+            logging.info("metrics %s: %s", name, registry.summary())
+            if textfile:
+                write_textfile(textfile)
+    finally:
+        lag_sampler.cancel()
+        if runner is not None:
+            await runner.cleanup()
@@ -0,0 +1,55 @@
+import argparse
+import re
+import subprocess
+import sys
+
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+DEFAULT_MODULES = [
+    'bridge_discord.extensions.challenge',
+    'bridge_discord.extensions.profile',
+    'bridge_discord.extensions.tournament',
+]
+
+parser = argparse.ArgumentParser(description='check the import time of bot modules against a budget.')
+parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+parser.add_argument('--budget-ms', default=1500.0, type=float, required=False)
+parser.add_argument(
+    '--forbid', nargs='*', default=['numpy', 'scipy', 'requests'],
+    help='packages that must only be imported on first use')
+parser.add_argument('--top', default=5, type=int, required=False)
+parser.add_argument('--runs', default=3, type=int, required=False)
+
+
+def measure(module):
+    # Returns (total microseconds, {imported module: self microseconds}) from a fresh interpreter's -X importtime.
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True
+    ).stderr
+    total, self_times = 0, {}
+    for self_us, cumulative_us, indent, name in IMPORT_TIME_PATTERN.findall(stderr):
+        self_times[name] = int(self_us)
+        if not indent:
+            total += int(cumulative_us)
+    return total, self_times
+
+
+def importtime_main(args):
+    failed = False
+    for module in args.modules:
+        # The fastest of a few runs, so a cold disk cache does not fail the check.
+        total, self_times = min((measure(module) for _ in range(args.runs)), key=lambda result: result[0])
+        forbidden = sorted(set(args.forbid).intersection(name.partition('.')[0] for name in self_times))
+        over_budget = total / 1000.0 > args.budget_ms
+        failed |= over_budget or bool(forbidden)
+        print(f"{'FAIL' if over_budget or forbidden else 'OK'} {module}: {total / 1000.0:.0f}ms "
+              f"(budget {args.budget_ms:.0f}ms)")
+        for name in sorted(self_times, key=self_times.get, reverse=True)[:args.top]:
+            print(f"    {self_times[name] / 1000.0:7.1f}ms {name}")
+        if forbidden:
+            print(f"    imported eagerly: {', '.join(forbidden)}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(importtime_main(parser.parse_args()))
@@ -0,0 +1,30 @@
+import argparse
+import asyncio
+import json
+
+from bridge_discord import datastore
+from bridge_discord.datastore import fetch
+
+parser = argparse.ArgumentParser(description='bulk ingest BBO friend challenge matchlinks.')
+parser.add_argument('links_file', type=open, help='text or CSV file containing webutil.bridgebase.com links')
+parser.add_argument('--workers', default=None, type=int, required=False)
+parser.add_argument('--keyring', default=None, type=open, required=False)
+
+
+async def ingest_main(args):
+    datastore.setup_connection(json.load(args.keyring).get('datastore') if args.keyring else None)
+    pool = datastore.ParsePool(args.workers)
+    try:
+        async with datastore.AsyncSession() as session:
+            report = await datastore.ingest_matchlinks(
+                session, datastore.extract_matchlinks(args.links_file.read()), pool=pool)
+    finally:
+        await pool.close()
+        await fetch.fetcher.close()
+    for link, reason in report.failures.items():
+        print(f"FAILED {link}: {reason}")
+    print(report.summary())
+
+
+if __name__ == '__main__':
+    asyncio.run(ingest_main(parser.parse_args()))
@@ -1,49 +1,224 @@
 import argparse
 import asyncio
+import collections
+import functools
 import json
 import logging
+import os
+import signal
+import sys
 import time
 
 import interactions
 
+from bridge_discord import datastore, metrics
+
 parser = argparse.ArgumentParser(description='start one or more bots.')
 parser.add_argument('--keyring', default=open('keyring.json'), type=open, required=False)
 parser.add_argument('--bot', default=None, type=str, required=False)
+parser.add_argument(
+    '--single-process', action='store_true',
+    help='run every bot on one event loop in this process instead of supervising one process per bot')
+
+
+# Printed by a bot once it is connected, so the supervisor can time startup.
+READY_MARKER = "bridge_discord: ready"
+# Discord allows one IDENTIFY per token every 5 seconds, so only bots sharing a token are staggered.
+IDENTIFY_INTERVAL = 5.0
+RESTART_BACKOFF = 1.0
+MAX_RESTART_BACKOFF = 60.0
+# A bot that stayed up this long is considered healthy again and restarts without backoff.
+STABLE_UPTIME = 60.0
+SHUTDOWN_TIMEOUT = 10.0
+
+
+def describe_rss(pid='self'):
+    # Resident set size from /proc, which only exists on Linux.
+    try:
+        with open(f'/proc/{pid}/statm') as statm:
+            return f"{int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20:.0f}MB"
+    except (OSError, ValueError):
+        return "unknown"
+
+
+def start_delays(keyring):
+    delays = {}
+    bots_per_token = collections.Counter()
+    for bot, bot_keyring in keyring['bots'].items():
+        delays[bot] = IDENTIFY_INTERVAL * bots_per_token[bot_keyring['bot_token']]
+        bots_per_token[bot_keyring['bot_token']] += 1
+    return delays
+
+
+def metrics_config(keyring, name):
+    # With one process per bot, each one serves its metrics on http_port plus its position in the keyring.
+    config = dict(keyring.get('metrics') or {})
+    if config.get('http_port') and name in keyring['bots']:
+        config['http_port'] += list(keyring['bots']).index(name)
+    return config
+
+
+def create_bot(keyring, name, on_ready):
+    # The datastore connection has to be set up before the modules are loaded.
+    bot_keyring = keyring['bots'][name]
+    intents = interactions.Intents.DEFAULT
+    for intent in bot_keyring.get('intents', []):
+        intents = intents | getattr(interactions.Intents, intent)
+    bot = interactions.Client(
+        token=bot_keyring['bot_token'],
+        default_scope=keyring['served_guild'],
+        intents=intents,
+    )
+    for module in bot_keyring['modules']:
+        bot.load(module)
+
+    @bot.event(name='on_ready')
+    async def verify_served_guilds():
+        if not (len(bot.guilds) == 1 and bot.guilds[0].id == keyring['served_guild']):
+            logging.critical("Present in unexpected guild. Shutting down.")
+            await bot._stop()
+            return
+        on_ready()
+
+    return bot
+
+
+class BotSupervisor:
+    def __init__(self, args, name, start_delay=0.0):
+        self.args = args
+        self.name = name
+        self.start_delay = start_delay
+        self.process = None
+        self.restarts = 0
+        self.startup_times = []
+        self.stopping = asyncio.Event()
+
+    async def _sleep(self, delay):
+        # Returns early once the supervisor is stopping.
+        try:
+            await asyncio.wait_for(self.stopping.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _forward_output(self, started_at):
+        ready = False
+        async for line in self.process.stdout:
+            line = line.decode(errors='replace').rstrip()
+            if line == READY_MARKER:
+                # on_ready fires again after every reconnect; only the first one ends startup.
+                if ready:
+                    continue
+                ready = True
+                self.startup_times.append(time.perf_counter() - started_at)
+                logging.info(
+                    "%s ready after %.1fs, RSS %s (restarts: %d)",
+                    self.name, self.startup_times[-1], describe_rss(self.process.pid), self.restarts)
+            else:
+                print(f"[{self.name}] {line}", flush=True)
+
+    async def run(self):
+        await self._sleep(self.start_delay)
+        backoff = RESTART_BACKOFF
+        while not self.stopping.is_set():
+            started_at = time.perf_counter()
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, __file__, '--keyring', self.args.keyring.name, '--bot', self.name,
+                stdout=asyncio.subprocess.PIPE)
+            await self._forward_output(started_at)
+            returncode = await self.process.wait()
+            if self.stopping.is_set() or returncode == 0:
+                break
+            if time.perf_counter() - started_at > STABLE_UPTIME:
+                backoff = RESTART_BACKOFF
+            logging.error("%s exited with %d, restarting in %.0fs.", self.name, returncode, backoff)
+            await self._sleep(backoff)
+            backoff = min(backoff * 2, MAX_RESTART_BACKOFF)
+            if not self.stopping.is_set():
+                self.restarts += 1
+        logging.info("%s stopped (restarts: %d).", self.name, self.restarts)
+
+    async def stop(self):
+        self.stopping.set()
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.process.kill()
 
 
 async def meta_main(args, keyring):
-    awaitables = []
-    for bot in keyring['bots']:
-        process = await asyncio.create_subprocess_shell(
-            f"python {__file__} --keyring {args.keyring.name} --bot {bot}")
-        time.sleep(2.0)
-        awaitables.append(process.wait())
-    await asyncio.gather(*awaitables)
+    # Starts every bot in parallel, restarts crashed ones with exponential backoff and stops them all on
+    # SIGINT/SIGTERM.
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    supervisors = [BotSupervisor(args, bot, start_delay) for bot, start_delay in start_delays(keyring).items()]
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(
+            signum, lambda: [asyncio.ensure_future(supervisor.stop()) for supervisor in supervisors])
+    await asyncio.gather(*(supervisor.run() for supervisor in supervisors))
+    for supervisor in supervisors:
+        startup_times = ", ".join(f"{startup_time:.1f}s" for startup_time in supervisor.startup_times)
+        logging.info("%s: startup times [%s], %d restarts.", supervisor.name, startup_times, supervisor.restarts)
+
+
+def single_process_main(keyring):
+    # Every bot is its own interactions.Client with its own modules and intents, but they share one event loop,
+    # one datastore engine and the module level caches. A crash takes every bot down; there is no supervisor.
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    started_at = time.perf_counter()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    datastore.setup_connection(keyring.get('datastore'))
+    ready = set()
+
+    def on_ready(name):
+        if name not in ready:
+            ready.add(name)
+            logging.info(
+                "%s ready after %.1fs, process RSS %s (%d/%d bots ready)",
+                name, time.perf_counter() - started_at, describe_rss(), len(ready), len(bots))
+
+    async def start_bot(bot, start_delay):
+        await asyncio.sleep(start_delay)
+        await bot._ready()
+
+    bots = {name: create_bot(keyring, name, functools.partial(on_ready, name)) for name in keyring['bots']}
+    delays = start_delays(keyring)
+    exporter = loop.create_task(metrics.run_exporter(metrics_config(keyring, 'all'), 'all'))
+    try:
+        loop.run_until_complete(asyncio.gather(*(start_bot(bot, delays[name]) for name, bot in bots.items())))
+    except KeyboardInterrupt:
+        logging.info("KeyboardInterrupt detected, shutting down all bots.")
+    finally:
+        exporter.cancel()
+        loop.run_until_complete(asyncio.gather(*(bot._logout() for bot in bots.values()), return_exceptions=True))
+        loop.run_until_complete(datastore.pending_members.flush())
+        loop.run_until_complete(datastore.parse_pool.close())
+        loop.run_until_complete(datastore.fetch.fetcher.close())
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
     keyring = json.load(args.keyring)
 
-    if not args.bot:
-        asyncio.run(meta_main(args, keyring))
+    # The supervisor stops bots with SIGTERM; handled like Ctrl-C so buffered writes are flushed on the way out.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if args.bot:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+        datastore.setup_connection(keyring.get('datastore'))
+        bot = create_bot(keyring, args.bot, lambda: print(READY_MARKER, flush=True))
+        bot._loop.create_task(metrics.run_exporter(metrics_config(keyring, args.bot), args.bot))
+        try:
+            bot.start()
+        finally:
+            # Also when start() raises: joins buffered since the last flush would be lost otherwise.
+            bot._loop.run_until_complete(datastore.pending_members.flush())
+            bot._loop.run_until_complete(datastore.parse_pool.close())
+            bot._loop.run_until_complete(datastore.fetch.fetcher.close())
+    elif args.single_process:
+        single_process_main(keyring)
     else:
-        bot_keyring = keyring['bots'][args.bot]
-        intents = interactions.Intents.DEFAULT
-        for intent in bot_keyring.get('intents', []):
-            intents = intents | getattr(interactions.Intents, intent)
-        bot = interactions.Client(
-            token=bot_keyring['bot_token'],
-            default_scope=keyring['served_guild'],
-            intents=intents,
-        )
-        for module in bot_keyring['modules']:
-            bot.load(module)
-
-        @bot.event(name='on_ready')
-        async def verify_served_guilds():
-            if not (len(bot.guilds) == 1 and bot.guilds[0].id == keyring['served_guild']):
-                logging.critical("Present in unexpected guild. Shutting down.")
-                await bot._stop()
-
-        bot.start()
+        asyncio.run(meta_main(args, keyring))
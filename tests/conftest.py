@@ -0,0 +1,145 @@
+import asyncio
+import os
+import sys
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import interactions
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bridge_discord import datastore  # noqa: E402
+from bridge_discord.datastore import basic, fetch  # noqa: E402
+
+
+class FakeGuild:
+    def __init__(self, member_ids):
+        self.member_ids = member_ids
+
+    async def get_members(self):
+        for member_id in self.member_ids:
+            yield interactions.Member(user=interactions.User(id=member_id))
+
+
+class FakeClient(interactions.Client):
+    # A client that never connects, enough to instantiate extensions and call their commands directly. Its one
+    # guild has member_ids as members.
+    def __init__(self, member_ids=()):
+        super().__init__(token="test")
+        self.fake_guild = FakeGuild(member_ids)
+
+    @property
+    def guilds(self):
+        return [self.fake_guild]
+
+
+class FakeContext:
+    def __init__(self, user_id=1, channel_id=1):
+        self.user = self.author = interactions.User(id=user_id)
+        self.channel_id = channel_id
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+    async def defer(self, *args, **kwargs):
+        pass
+
+
+def link(session, discord_user, bbo_user, mmr_m=1200.0):
+    # A server member whose main BBO account is bbo_user.
+    session.add(datastore.ServerProfile(discord_user=discord_user))
+    session.add(datastore.BBOProfile(bbo_user=bbo_user, mmr_m=mmr_m))
+    session.add(datastore.BBOMain(discord_user=discord_user, bbo_user=bbo_user))
+
+
+def challenge_page(scores, hero="hero", villain="villain", scoring="IMPs"):
+    # A BBO friend challenge page with one board per (hero_matchscore, villain_matchscore) pair.
+    rows = "".join(
+        f'<tr class="{"odd" if number % 2 else "even"}"><td>{number}</td>'
+        f'<td><a href="https://www.bridgebase.com/tools/handviewer.html?lin={number}h">3NT</a></td>'
+        f'<td>400</td><td>{hero_score}</td><td>{villain_score}</td>'
+        f'<td><a href="https://www.bridgebase.com/tools/handviewer.html?lin={number}v">4S</a></td>'
+        f'<td>-50</td></tr>'
+        for number, (hero_score, villain_score) in enumerate(scores, 1)
+    )
+    return (
+        '<html><body><table class="handrecords">'
+        f'<tr><td class="username">{hero}</td><td class="final_score">({scoring})</td>'
+        f'<td class="username">{villain}</td></tr>{rows}</table></body></html>'
+    )
+
+
+class PageServer:
+    # Serves pages[path] over HTTP, or the response of pages[path](request) for a coroutine function; requests
+    # records every path asked for.
+    def __init__(self):
+        self.pages = {}
+        self.requests = []
+        self.delay = 0.0
+        app = web.Application()
+        app.router.add_get("/{path:.*}", self.handle)
+        self.server = TestServer(app)
+
+    async def handle(self, request):
+        self.requests.append(request.path)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if request.path not in self.pages:
+            raise web.HTTPNotFound()
+        if callable(self.pages[request.path]):
+            return await self.pages[request.path](request)
+        return web.Response(text=self.pages[request.path], content_type="text/html")
+
+    def url(self, path):
+        return str(self.server.make_url(path))
+
+
+@pytest.fixture
+def page_server(loop, monkeypatch):
+    # A local stand-in for webutil.bridgebase.com, fetched through a fetcher of its own.
+    server = PageServer()
+    loop.run_until_complete(server.server.start_server())
+    monkeypatch.setattr(fetch, "fetcher", fetch.BBOFetcher(retries=1))
+    monkeypatch.setattr(datastore.FriendChallenge, "validate_matchlink", staticmethod(lambda matchlink: None))
+    yield server
+    loop.run_until_complete(fetch.fetcher.close())
+    loop.run_until_complete(server.server.close())
+
+
+@pytest.fixture
+def db(tmp_path):
+    # A fresh database per test; the module level caches are emptied so nothing leaks from the previous one.
+    basic._sessionmaker = None
+    datastore.setup_connection({"path": str(tmp_path / "test.db")})
+    datastore.tournament_cache.invalidate()
+    datastore.identities.clear()
+    with datastore.Session() as session:
+        datastore.rankings.rebuild(session)
+    yield
+    basic._sessionmaker = None
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def statements():
+    # Every SQL statement executed while the test runs.
+    executed = []
+
+    def record(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(Engine, "before_cursor_execute", record)
@@ -0,0 +1,31 @@
+import numpy as np
+
+from bridge_discord.datastore import balancing
+
+
+def test_greedy_fills_teams_evenly_and_splits_conflicts():
+    rng = np.random.default_rng(0)
+    mu, variance = rng.uniform(800.0, 1800.0, 23), rng.uniform(60.0, 400.0, 23) ** 2
+    # A representative and the players they represent, as representative_conflicts reports them.
+    conflicts = [(0, 1), (0, 2), (0, 3), (10, 11), (20, 21)]
+    teams = balancing._greedy(mu, variance, 4, balancing._conflict_matrix(len(mu), conflicts))
+    sizes = np.bincount(teams, minlength=4)
+    assert sizes.max() - sizes.min() <= 1
+    assert all(teams[i] != teams[j] for i, j in conflicts)
+
+
+def test_greedy_seeds_equal_ratings_by_certainty():
+    # Equal ratings: the most certain player is placed first, on team 0, and the least certain last.
+    teams = balancing._greedy(
+        np.full(3, 1200.0), np.array([400.0, 50.0, 200.0]) ** 2, 3, balancing._conflict_matrix(3, []))
+    assert teams.tolist() == [2, 0, 1]
+
+
+def test_variance_balance_keeps_sizes_and_conflicts():
+    rng = np.random.default_rng(1)
+    ratings = np.column_stack([rng.uniform(800.0, 1800.0, 30), rng.uniform(60.0, 400.0, 30)])
+    conflicts = [(0, 1), (0, 2), (5, 6), (5, 7), (12, 13)]
+    teams = balancing.variance_balance(ratings, 6, conflicts)
+    sizes = np.bincount(teams, minlength=6)
+    assert sizes.max() - sizes.min() <= 1
+    assert all(teams[i] != teams[j] for i, j in conflicts)
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from sqlalchemy import text
+
+from bridge_discord import datastore
+
+# About a quarter of a second of SQLite work.
+SLOW_QUERY = text(
+    "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 2000000) SELECT count(*) FROM c")
+
+
+async def max_lag(work, interval=0.005):
+    # The longest the event loop went without running a 5ms heartbeat while work ran, and how long work took.
+    lags = []
+
+    async def heartbeat():
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - started - interval)
+
+    beating = asyncio.ensure_future(heartbeat())
+    await asyncio.sleep(interval)
+    started = time.perf_counter()
+    await work()
+    elapsed = time.perf_counter() - started
+    # Lets a heartbeat held up by work report its lag.
+    await asyncio.sleep(2 * interval)
+    beating.cancel()
+    return max(lags), elapsed
+
+
+def test_async_session_keeps_the_event_loop_responsive(db, loop):
+    async def on_the_loop():
+        with datastore.Session() as session:
+            assert session.execute(SLOW_QUERY).scalar() == 2000000
+
+    async def on_the_datastore_thread():
+        async with datastore.AsyncSession() as session:
+            assert (await session.run_sync(lambda sync_session: sync_session.execute(SLOW_QUERY).scalar())) == 2000000
+
+    blocked_lag, blocked_elapsed = loop.run_until_complete(max_lag(on_the_loop))
+    lag, elapsed = loop.run_until_complete(max_lag(on_the_datastore_thread))
+    # Before: the loop stalls for the whole query. After: it keeps ticking while the query runs.
+    assert blocked_lag > blocked_elapsed / 2
+    assert lag < elapsed / 5
+
+
+def test_version_poller_reports_other_writers_after_the_poll_interval(db):
+    slow, fast = datastore.VersionPoller("test", poll_interval=60.0), datastore.VersionPoller("test", poll_interval=0.0)
+    with datastore.Session() as session:
+        for poller in (slow, fast):
+            poller.record(poller.read(session))
+        datastore.DatastoreVersion.bump(session, "test")
+        session.commit()
+        assert (slow.poll(session), fast.poll(session)) == (None, 1)
+
+        # A bump applied by the cache itself needs no reload, unless another one happened in between.
+        fast.advance(1)
+        assert fast.poll(session) is None
+        datastore.DatastoreVersion.bump(session, "test")
+        datastore.DatastoreVersion.bump(session, "test")
+        session.commit()
+        fast.advance(3)
+        assert fast.poll(session) == 3
@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+from bridge_discord import datastore
+from bridge_discord.datastore import fetch
+from bridge_discord.extensions import tournament
+
+from conftest import FakeClient, FakeContext, challenge_page
+
+
+def test_boards_are_parsed_while_the_page_arrives(db, loop, page_server):
+    page = challenge_page([(1, 0)] * 40, hero="h\u00e9ro")
+    first_half, second_half = page[:len(page) // 2].encode(), page[len(page) // 2:].encode()
+    parsed_first_half = asyncio.Event()
+
+    async def slow_page(request):
+        response = web.StreamResponse(headers={"Content-Type": "text/html; charset=utf-8"})
+        await response.prepare(request)
+        await response.write(first_half)
+        # The rest of the page is only sent once boards of the first half have come out of the parser.
+        await asyncio.wait_for(parsed_first_half.wait(), 5)
+        await response.write(second_half)
+        await response.write_eof()
+        return response
+
+    page_server.pages["/slow"] = slow_page
+
+    async def consume(response):
+        parser = datastore.challenge.BBOChallengeParser()
+        boards = []
+        # A tiny chunk size splits the multi-byte character of the hero's name across chunks.
+        async for board in parser.aiter_boards(fetch.iter_text(response, chunk_size=7)):
+            boards.append(board)
+            parsed_first_half.set()
+        return parser.finalize(boards)
+
+    friend_challenge = loop.run_until_complete(fetch.fetcher.stream(page_server.url("/slow"), consume))
+    assert (friend_challenge.hero, friend_challenge.board_count, friend_challenge.hero_total) == ("h\u00e9ro", 40, 40)
+
+
+def test_matchlink_parses_do_not_hold_up_other_commands(db, loop, page_server):
+    for ix in range(10):
+        page_server.pages[f"/{ix}"] = challenge_page([(ix, 1)] * 1000, hero=f"hero{ix}")
+    extension = tournament.TeamRRManagerExtension(FakeClient())
+
+    async def resolve(ix):
+        async with datastore.AsyncSession() as session:
+            friend_challenge, _ = await datastore.resolve_matchlink(session, page_server.url(f"/{ix}"))
+            await session.commit()
+            return friend_challenge.board_count
+
+    async def command():
+        ctx = FakeContext()
+        started = time.perf_counter()
+        try:
+            await extension.info.coro(extension, ctx)
+        except ValueError:
+            pass
+        return time.perf_counter() - started, ctx.sent
+
+    async def scenario():
+        started = time.perf_counter()
+        parses = asyncio.gather(*(resolve(ix) for ix in range(10)))
+        # Let the downloads start before the command comes in.
+        while not page_server.requests:
+            await asyncio.sleep(0.001)
+        latency, sent = await command()
+        return latency, sent, await parses, time.perf_counter() - started
+
+    latency, sent, board_counts, parse_time = loop.run_until_complete(scenario())
+    assert board_counts == [1000] * 10
+    assert sent == ["No tournament is currently running. Wait for one to start!"]
+    # The command is answered in a small fraction of the time the parses take together.
+    assert latency < parse_time / 5
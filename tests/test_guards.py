@@ -0,0 +1,34 @@
+import asyncio
+
+from bridge_discord import datastore
+from bridge_discord.extensions import tournament
+
+from conftest import FakeClient, FakeContext, link
+
+
+def test_concurrent_signups_keep_their_own_guard_state(db, loop):
+    with datastore.Session() as session:
+        session.add(datastore.TeamRRTournament(state=datastore.TournamentState.SIGNUP, tournament_name="t"))
+        link(session, 3, "u3")
+        link(session, 4, "u4")
+        session.commit()
+    extension = tournament.TeamRRManagerExtension(FakeClient())
+    contexts = [FakeContext(3), FakeContext(3), FakeContext(4)]
+
+    loop.run_until_complete(asyncio.gather(*(extension.signup.coro(extension, ctx) for ctx in contexts)))
+
+    assert sorted(ctx.sent[0] for ctx in contexts[:2]) == [
+        "Signed up for the upcoming tournament!", "You are already signed up for the upcoming tournament."]
+    assert contexts[2].sent == ["Signed up for the upcoming tournament!"]
+    with datastore.Session() as session:
+        assert sorted(entry.bbo_user for entry in session.query(datastore.TeamRREntry)) == ["u3", "u4"]
+
+
+def test_first_failed_guard_is_reported(db, loop):
+    extension = tournament.TeamRRManagerExtension(FakeClient())
+    ctx = FakeContext(3)
+    try:
+        loop.run_until_complete(extension.signup.coro(extension, ctx))
+    except ValueError:
+        pass
+    assert ctx.sent == ["No tournament is currently running. Wait for one to start!"]
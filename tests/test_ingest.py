@@ -0,0 +1,39 @@
+from aiohttp import web
+from sqlalchemy import select
+
+from bridge_discord import datastore
+
+from conftest import challenge_page
+
+
+def test_bulk_ingest_parses_in_a_long_lived_pool(db, loop, page_server):
+    page_server.pages["/a"] = challenge_page([(3, 0)], hero="a", villain="b")
+    page_server.pages["/login"] = "<html><body>Log in</body></html>"
+    pool = datastore.ParsePool(max_workers=2)
+    in_transaction = []
+
+    async def ingest(paths):
+        async with datastore.AsyncSession() as session:
+            async def page_b(request):
+                # Fetched after the cache read, which must have ended by now.
+                in_transaction.append(session.sync_session.in_transaction())
+                return web.Response(text=challenge_page([(0, 2), (1, 1)], hero="b", villain="c"),
+                                    content_type="text/html")
+
+            page_server.pages["/b"] = page_b
+            return await datastore.ingest_matchlinks(session, [page_server.url(path) for path in paths], pool=pool)
+
+    try:
+        first = loop.run_until_complete(ingest(["/a", "/login"]))
+        executor = pool.get()
+        second = loop.run_until_complete(ingest(["/a", "/b"]))
+        # The second batch reused the workers of the first.
+        assert pool.get() is executor
+    finally:
+        loop.run_until_complete(pool.close())
+
+    assert in_transaction == [False]
+    assert (len(first.created), len(first.failures), len(second.created), len(second.duplicates)) == (1, 1, 1, 1)
+    with datastore.Session() as session:
+        assert sorted(session.execute(
+            select(datastore.FriendChallenge.hero, datastore.FriendChallenge.board_count)).all()) == [("a", 1), ("b", 2)]
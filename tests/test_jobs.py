@@ -0,0 +1,76 @@
+import asyncio
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import OperationalError
+
+from bridge_discord import datastore
+from bridge_discord.datastore import jobs
+
+
+def failing(*args):
+    raise OperationalError("DELETE", {}, Exception("database is locked"))
+
+
+def test_worker_survives_bookkeeping_errors(db, loop, monkeypatch):
+    delivered = []
+
+    async def deliver(waiting, result, error):
+        delivered.append(([job.url for job in waiting], result, error))
+
+    async def ingest_one(url):
+        if url.endswith("flaky"):
+            raise RuntimeError("unreachable")
+        return 1, None
+
+    monkeypatch.setattr(jobs, "ingest_one", ingest_one)
+    monkeypatch.setattr(jobs, "_record_attempt", failing)
+    monkeypatch.setattr(jobs, "_finish_jobs", failing)
+    monkeypatch.setattr(jobs.FriendChallenge, "validate_matchlink", staticmethod(lambda url: None))
+
+    async def scenario():
+        queue = jobs.IngestionQueue(deliver, max_workers=1, retries=1, backoff=0)
+        await queue.start()
+        await queue.enqueue("https://www.bridgebase.com/flaky")
+        await queue.enqueue("https://www.bridgebase.com/ok")
+        await asyncio.wait_for(queue._queue.join(), 5)
+        depth = queue.depth
+        await queue.stop()
+        return depth
+
+    assert loop.run_until_complete(scenario()) == 0
+    assert delivered == [
+        (["https://www.bridgebase.com/flaky"], None, "Failed to ingest."),
+        (["https://www.bridgebase.com/ok"], (1, None), None),
+    ]
+
+
+def test_restored_jobs_past_the_attempt_limit_are_answered_and_dropped(db, loop, monkeypatch):
+    delivered, ingested = [], []
+
+    async def deliver(waiting, result, error):
+        delivered.append(([job.job_id for job in waiting], result, error))
+
+    async def ingest_one(url):
+        ingested.append(url)
+        return 1, None
+
+    monkeypatch.setattr(jobs, "ingest_one", ingest_one)
+    with datastore.Session() as session:
+        session.execute(insert(jobs.IngestJob.__table__), [
+            dict(job_id=1, url="https://www.bridgebase.com/crashes", attempts=3),
+            dict(job_id=2, url="https://www.bridgebase.com/crashes", attempts=3),
+            dict(job_id=3, url="https://www.bridgebase.com/ok", attempts=2),
+        ])
+        session.commit()
+
+    async def scenario():
+        queue = jobs.IngestionQueue(deliver, max_workers=1, max_attempts=3)
+        await queue.start()
+        await asyncio.wait_for(queue._queue.join(), 5)
+        await queue.stop()
+
+    loop.run_until_complete(scenario())
+    assert ingested == ["https://www.bridgebase.com/ok"]
+    assert delivered == [([1, 2], None, "Gave up after 3 attempts."), ([3], (1, None), None)]
+    with datastore.Session() as session:
+        assert session.execute(select(jobs.IngestJob)).all() == []
@@ -0,0 +1,47 @@
+from sqlalchemy import insert, update
+
+from bridge_discord import datastore
+from bridge_discord.datastore import leaderboard
+
+
+def add_profiles(session, *bbo_users):
+    session.execute(insert(datastore.BBOProfile.__table__), [dict(bbo_user=bbo_user) for bbo_user in bbo_users])
+    session.commit()
+
+
+def test_ratings_reach_the_rankings_only_when_committed(db):
+    rankings = leaderboard.Leaderboard()
+    with datastore.Session() as session:
+        add_profiles(session, "a", "b")
+        rankings.rebuild(session)
+
+        rankings.touch(session, [("b", 2000.0, 50.0)])
+        session.rollback()
+        assert rankings.page(1) == [(1, "a", 0.0), (2, "b", 0.0)]
+
+        rankings.touch(session, [("b", 2000.0, 50.0), ("unknown", 3000.0, 50.0)], known_only=True)
+        session.commit()
+        assert rankings.page(1) == [(1, "b", 1850.0), (2, "a", 0.0)]
+
+
+def test_other_processes_catch_up_through_the_version_stamp(db, monkeypatch):
+    # Two indexes over one database stand in for two bot processes.
+    writer, reader = leaderboard.Leaderboard(poll_interval=0.0), leaderboard.Leaderboard(poll_interval=0.0)
+    with datastore.Session() as session:
+        add_profiles(session, "a", "b")
+        writer.rebuild(session)
+        reader.rebuild(session)
+
+        rebuilds = []
+        monkeypatch.setattr(writer, "rebuild", lambda session: rebuilds.append(session))
+        session.execute(update(datastore.BBOProfile).where(datastore.BBOProfile.bbo_user == "a").values(
+            mmr_m=1500.0, mmr_s=100.0))
+        writer.touch(session, [("a", 1500.0, 100.0)])
+        session.commit()
+        writer.sync(session)
+        # The writer applied its own change and does not reload it.
+        assert rebuilds == []
+
+        assert reader.rank("a") == 1 and reader.page(1)[0][2] == 0.0
+        reader.sync(session)
+        assert reader.page(1)[0] == (1, "a", 1200.0)
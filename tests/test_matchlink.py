@@ -0,0 +1,89 @@
+import datetime
+
+import pytest
+from sqlalchemy import func, select
+
+from bridge_discord import datastore
+from bridge_discord.datastore import ScoringMethod
+from bridge_discord.datastore.matchlink import resolve_matchlink
+
+from conftest import challenge_page, link
+
+
+async def resolve(url, **kwargs):
+    async with datastore.AsyncSession() as session:
+        friend_challenge, created = await resolve_matchlink(session, url, **kwargs)
+        await session.commit()
+        return friend_challenge.match_id, created
+
+
+def stored(session):
+    challenges = session.execute(select(datastore.FriendChallenge)).scalars().all()
+    boards = session.execute(select(func.count()).select_from(datastore.FriendChallengeBoard)).scalar()
+    return challenges, boards
+
+
+def test_pages_without_a_challenge_are_not_stored(db, loop, page_server):
+    page_server.pages["/login"] = "<html><body><form>Log in</form></body></html>"
+    page_server.pages["/empty"] = challenge_page([])
+    for path in ("/login", "/empty"):
+        with pytest.raises(ValueError, match="does not contain a friend challenge"):
+            loop.run_until_complete(resolve(page_server.url(path)))
+    with datastore.Session() as session:
+        assert stored(session) == ([], 0)
+
+
+def test_changed_page_replaces_the_stored_challenge(db, loop, page_server):
+    url = page_server.url("/challenge")
+    page_server.pages["/challenge"] = challenge_page([(3, 0), (0, 1)])
+    match_id, created = loop.run_until_complete(resolve(url))
+    assert created
+
+    page_server.pages["/challenge"] = challenge_page([(3, 0), (0, 1), (5, 0)])
+    assert loop.run_until_complete(resolve(url, max_age=datetime.timedelta(0))) == (match_id, True)
+
+    with datastore.Session() as session:
+        challenges, boards = stored(session)
+        assert [(c.match_id, c.hero_total, c.villain_total, c.board_count) for c in challenges] == [
+            (match_id, 8, 1, 3)]
+        assert boards == 3
+        hero_stats = datastore.get_stats(session, "hero")[ScoringMethod.IMPS]
+        assert (hero_stats.matches, hero_stats.wins, hero_stats.boards, hero_stats.score_for) == (1, 1, 3, 8)
+
+
+
+def test_changed_segment_rescores_its_match_and_standings(db, loop, page_server):
+    with datastore.Session() as session:
+        active = datastore.TeamRRTournament(
+            state=datastore.TournamentState.STARTED, tournament_name="t", number_of_teams=2)
+        session.add(active)
+        link(session, 1, "hero")
+        link(session, 2, "villain")
+        session.flush()
+        session.add_all([
+            datastore.TeamRREntry(tournament_id=active.tournament_id, bbo_user="hero", team_number=1),
+            datastore.TeamRREntry(tournament_id=active.tournament_id, bbo_user="villain", team_number=0),
+        ])
+        datastore.create_schedule(session, active)
+        session.commit()
+
+    url = page_server.url("/challenge")
+    page_server.pages["/challenge"] = challenge_page([(3, 0), (0, 1)])
+    match_id, _ = loop.run_until_complete(resolve(url))
+    with datastore.Session() as session:
+        datastore.record_active_segment(session, match_id)
+        session.commit()
+
+    page_server.pages["/challenge"] = challenge_page([(3, 0), (0, 1), (0, 5)])
+    loop.run_until_complete(resolve(url, max_age=datetime.timedelta(0)))
+
+    with datastore.Session() as session:
+        rr_match = session.execute(select(datastore.TeamRRMatch)).scalars().one()
+        # Villain's team 0 is at home: 6 IMPs to 3 over three boards, as if only the new page had been recorded.
+        assert (rr_match.home_imps, rr_match.away_imps, rr_match.boards) == (6, 3, 3)
+        assert (rr_match.home_vps, rr_match.away_vps) == datastore.victory_points(3, 3)
+        standings = {standing.team_number: standing for standing in session.execute(
+            select(datastore.TeamRRStanding)).scalars()}
+        assert [(standings[team].played, standings[team].won, standings[team].lost, standings[team].imps_for,
+                 standings[team].victory_points) for team in (0, 1)] == [
+            (1, 1, 0, 6, rr_match.home_vps), (1, 0, 1, 3, rr_match.away_vps)]
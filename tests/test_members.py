@@ -0,0 +1,72 @@
+import asyncio
+
+import interactions
+import pytest
+from sqlalchemy import select
+
+from bridge_discord import datastore
+from bridge_discord.datastore import members
+from bridge_discord.extensions import profile
+
+from conftest import FakeClient, FakeContext
+
+
+def stored_members():
+    with datastore.Session() as session:
+        return set(session.execute(select(datastore.ServerProfile.discord_user)).scalars())
+
+
+def test_joins_are_visible_before_the_buffer_flushes(db, loop, monkeypatch):
+    buffer = members.MemberWriteBuffer(max_pending=100, max_delay=0.05)
+    monkeypatch.setattr(datastore, "pending_members", buffer)
+    extension = profile.ProfileExtension(FakeClient())
+
+    async def scenario():
+        buffer.add(7)
+        ctx = FakeContext()
+        await extension.profile.coro(extension, ctx, interactions.Member(user=interactions.User(id=7)))
+        before = stored_members()
+        await asyncio.sleep(0.2)
+        return ctx.sent, before
+
+    sent, before = loop.run_until_complete(scenario())
+    # The profile embed, not "Failed to find profile", although the row was not written yet.
+    assert (sent, before) == ([None], set())
+    assert 7 not in buffer and stored_members() == {7}
+
+
+def test_failed_flush_is_retried_with_the_next_one(db, loop, monkeypatch):
+    buffer = members.MemberWriteBuffer(max_pending=100, max_delay=60.0)
+    insert_members = members._insert_members
+
+    def fail_once(discord_users):
+        monkeypatch.setattr(members, "_insert_members", insert_members)
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(members, "_insert_members", fail_once)
+
+    async def scenario():
+        buffer.add(1)
+        buffer.add(2)
+        with pytest.raises(RuntimeError):
+            await buffer.flush()
+        # Still buffered, so still visible.
+        assert (1 in buffer, len(buffer), stored_members()) == (True, 2, set())
+        buffer.add(3)
+        await buffer.flush()
+
+    loop.run_until_complete(scenario())
+    assert (len(buffer), stored_members()) == (0, {1, 2, 3})
+
+
+def test_shutdown_flush_writes_joins_before_their_timer(db, loop):
+    # main.py flushes on the way out, long before max_delay would have.
+    buffer = members.MemberWriteBuffer(max_pending=100, max_delay=60.0)
+
+    async def scenario():
+        for discord_user in range(10):
+            buffer.add(discord_user)
+        await buffer.flush()
+
+    loop.run_until_complete(scenario())
+    assert (buffer._timer, len(buffer), stored_members()) == (None, 0, set(range(10)))
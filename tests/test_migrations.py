@@ -0,0 +1,69 @@
+import sqlite3
+
+from bridge_discord import datastore
+from bridge_discord.datastore import basic, migrations
+
+# The schema of a database created before MIGRATIONS existed, as the models of the time generated it.
+PRE_MIGRATION_SCHEMA = """
+CREATE TABLE bbo_friend_challenge (
+    match_id INTEGER NOT NULL, scoring_method VARCHAR(4), hero VARCHAR, villain VARCHAR,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (match_id));
+CREATE TABLE bbo_profile (
+    bbo_user VARCHAR NOT NULL, mmr_m FLOAT DEFAULT '1200.0', mmr_s FLOAT DEFAULT '400.0', PRIMARY KEY (bbo_user));
+CREATE TABLE server_profile (discord_user INTEGER NOT NULL, PRIMARY KEY (discord_user));
+CREATE TABLE teamrr_tournament (
+    tournament_id INTEGER NOT NULL, tournament_name VARCHAR, scoring_method VARCHAR(4), segment_boards INTEGER,
+    number_of_teams INTEGER, state VARCHAR(8), created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (tournament_id));
+CREATE TABLE bbo_friend_challenge_board (
+    match_id INTEGER NOT NULL, number INTEGER NOT NULL, hero_result VARCHAR, hero_score INTEGER,
+    hero_matchscore FLOAT, hero_lin VARCHAR, villain_result VARCHAR, villain_score INTEGER,
+    villain_matchscore FLOAT, villain_lin VARCHAR, PRIMARY KEY (match_id, number),
+    FOREIGN KEY(match_id) REFERENCES bbo_friend_challenge (match_id));
+CREATE TABLE bbo_main (
+    bbo_user VARCHAR NOT NULL, discord_user INTEGER NOT NULL, PRIMARY KEY (bbo_user),
+    FOREIGN KEY(bbo_user) REFERENCES bbo_profile (bbo_user), UNIQUE (discord_user),
+    FOREIGN KEY(discord_user) REFERENCES server_profile (discord_user));
+CREATE TABLE bbo_representative (
+    bbo_user VARCHAR NOT NULL, discord_user INTEGER, PRIMARY KEY (bbo_user),
+    FOREIGN KEY(bbo_user) REFERENCES bbo_profile (bbo_user),
+    FOREIGN KEY(discord_user) REFERENCES server_profile (discord_user));
+CREATE TABLE teamrr_entries (
+    tournament_id INTEGER NOT NULL, bbo_user VARCHAR NOT NULL, team_number INTEGER,
+    PRIMARY KEY (tournament_id, bbo_user), FOREIGN KEY(tournament_id) REFERENCES teamrr_tournament (tournament_id),
+    FOREIGN KEY(bbo_user) REFERENCES bbo_profile (bbo_user));
+INSERT INTO bbo_profile (bbo_user, mmr_m, mmr_s) VALUES ('hero', 1500.0, 100.0), ('villain', 1200.0, 400.0);
+INSERT INTO bbo_friend_challenge (match_id, scoring_method, hero, villain) VALUES (1, 'IMPS', 'hero', 'villain');
+INSERT INTO bbo_friend_challenge_board (match_id, number, hero_matchscore, villain_matchscore)
+VALUES (1, 1, 3.0, 0.0), (1, 2, 0.0, 1.0);
+"""
+
+
+def test_setup_connection_upgrades_a_pre_migration_database(tmp_path, monkeypatch):
+    path = str(tmp_path / "old.db")
+    with sqlite3.connect(path) as connection:
+        connection.executescript(PRE_MIGRATION_SCHEMA)
+    monkeypatch.setattr(basic, "_sessionmaker", None)
+    datastore.setup_connection({"path": path})
+
+    with sqlite3.connect(path) as connection:
+        assert connection.execute("PRAGMA user_version").fetchone()[0] == len(migrations.MIGRATIONS)
+        # hidden is 2 for a virtual generated column.
+        assert [
+            hidden for _, name, _, _, _, _, hidden in connection.execute("PRAGMA table_xinfo(bbo_profile)")
+            if name == "conservative_mmr_estimate"] == [2]
+        assert connection.execute(
+            "SELECT bbo_user, conservative_mmr_estimate FROM bbo_profile ORDER BY conservative_mmr_estimate DESC"
+        ).fetchall() == [("hero", 1200.0), ("villain", 0.0)]
+        indexes = {name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {index.name for table in basic.Base.metadata.tables.values() for index in table.indexes} <= indexes
+        assert connection.execute(
+            "SELECT hero_total, villain_total, board_count FROM bbo_friend_challenge").fetchall() == [(3.0, 1.0, 2)]
+
+    # Another bot starting on the upgraded database runs no migration again.
+    def already_applied(connection):
+        raise AssertionError("migration applied twice")
+
+    monkeypatch.setattr(basic, "_sessionmaker", None)
+    monkeypatch.setattr(migrations, "MIGRATIONS", [already_applied] * len(migrations.MIGRATIONS))
+    datastore.setup_connection({"path": path})
@@ -0,0 +1,79 @@
+import asyncio
+
+from sqlalchemy import func, select
+
+from bridge_discord import datastore
+from bridge_discord.extensions import profile, utilities
+from conftest import FakeClient
+
+
+def test_member_sync_does_not_stall_other_writers(db, loop, monkeypatch):
+    monkeypatch.setattr(profile, "MEMBER_SYNC_PAGE_SIZE", 10)
+    extension = profile.ProfileExtension(FakeClient(range(1, 201)))
+
+    async def writer():
+        async with datastore.AsyncSession() as session:
+            for _ in range(20):
+                await session.run_and_commit(datastore.DatastoreVersion.bump, "identity")
+
+    async def scenario():
+        # Before: a page written in one datastore call and committed in the next held the write lock while the
+        # writer's call waited on the datastore thread, until the busy_timeout raised "database is locked".
+        await asyncio.wait_for(asyncio.gather(extension.sync_member_list(), writer(), writer()), 4)
+
+    loop.run_until_complete(scenario())
+    with datastore.Session() as session:
+        assert session.execute(select(func.count()).select_from(datastore.ServerProfile)).scalar() == 200
+
+
+def test_member_sync_inserts_only_members_not_stored_yet(db, loop, monkeypatch):
+    with datastore.Session() as session:
+        datastore.ServerProfile.bulk_insert(session, range(1, 101, 2))
+        session.commit()
+    inserted = []
+    bulk_insert = datastore.ServerProfile.bulk_insert
+
+    def recording_bulk_insert(session, discord_users):
+        inserted.append(set(discord_users))
+        bulk_insert(session, discord_users)
+
+    monkeypatch.setattr(datastore.ServerProfile, "bulk_insert", recording_bulk_insert)
+    monkeypatch.setattr(profile, "MEMBER_SYNC_PAGE_SIZE", 7)
+    extension = profile.ProfileExtension(FakeClient(range(1, 121)))
+
+    loop.run_until_complete(extension.sync_member_list())
+    # Pages of 7 members, each inserting only its ids that were not stored before.
+    assert len(inserted) == 18
+    assert all(len(page) <= 7 for page in inserted)
+    assert set().union(*inserted) == set(range(2, 101, 2)) | set(range(101, 121))
+    assert sum(map(len, inserted)) == 70
+
+    inserted.clear()
+    loop.run_until_complete(extension.sync_member_list())
+    assert inserted == [set()] * 18
+    with datastore.Session() as session:
+        assert session.execute(select(func.count()).select_from(datastore.ServerProfile)).scalar() == 120
+
+
+def test_bulk_insert_ignores_members_already_stored(db):
+    with datastore.Session() as session:
+        datastore.ServerProfile.bulk_insert(session, {1, 2})
+        session.commit()
+        # Joined through the write buffer while a sync was paging: ON CONFLICT DO NOTHING, not an IntegrityError.
+        datastore.ServerProfile.bulk_insert(session, {2, 3})
+        datastore.ServerProfile.bulk_insert(session, set())
+        session.commit()
+        assert datastore.ServerProfile.existing_ids(session) == {1, 2, 3}
+
+
+def test_paged_yields_full_pages_then_the_rest(loop):
+    async def numbers(count):
+        for number in range(count):
+            yield number
+
+    async def pages(count, page_size):
+        return [page async for page in utilities.paged(numbers(count), page_size)]
+
+    assert loop.run_until_complete(pages(10, 4)) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert loop.run_until_complete(pages(8, 4)) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert loop.run_until_complete(pages(0, 4)) == []
@@ -0,0 +1,63 @@
+import math
+
+import numpy as np
+from scipy import integrate
+from scipy.special import ndtr
+
+from bridge_discord.datastore import rating
+
+import benchmark
+
+
+def posterior_moments(mu, sigma, opponent_mu, opponent_sigma, win):
+    # Mean and standard deviation of the skill posterior N(x; mu, sigma^2) * P(result | x), integrated numerically
+    # in standard units over +-12 sigma, where the prior's tails no longer register in double precision.
+    sign = 1.0 if win else -1.0
+
+    def density(z, power):
+        likelihood = ndtr(sign * (mu + sigma * z - opponent_mu) / opponent_sigma)
+        return z ** power * math.exp(-0.5 * z * z) * likelihood
+
+    def moment(power):
+        return integrate.quad(density, -12.0, 12.0, args=(power,), epsabs=0.0, epsrel=1e-13, limit=200)[0]
+
+    normalizer = moment(0)
+    mean = moment(1) / normalizer
+    variance = moment(2) / normalizer - mean * mean
+    return mu + sigma * mean, sigma * math.sqrt(variance)
+
+
+def test_update_ratings_matches_the_numerical_posterior():
+    cases = [
+        ((1200.0, 400.0), (1200.0, 400.0), True),
+        ((1500.0, 80.0), (1100.0, 350.0), False),
+        ((900.0, 250.0), (1600.0, 60.0), True),
+        ((1300.0, 150.0), (1250.0, 150.0), False),
+    ]
+    updated = rating.update_ratings(
+        [prior for prior, _, _ in cases], [opponent for _, opponent, _ in cases], [win for _, _, win in cases])
+    for (mu, sigma), ((prior_mu, prior_sigma), (opponent_mu, opponent_sigma), win) in zip(updated, cases):
+        expected_mu, expected_sigma = posterior_moments(prior_mu, prior_sigma, opponent_mu, opponent_sigma, win)
+        assert abs(mu - expected_mu) <= 1e-12 * prior_sigma
+        assert abs(sigma - expected_sigma) <= 1e-12 * prior_sigma
+
+
+def test_update_ratings_matches_the_quadrature_reference():
+    rng = np.random.default_rng(0)
+    ratings = np.column_stack([rng.uniform(800.0, 1800.0, 8), rng.uniform(60.0, 400.0, 8)])
+    opponents = np.column_stack([rng.uniform(800.0, 1800.0, 8), rng.uniform(60.0, 400.0, 8)])
+    wins = rng.random(8) < 0.5
+    updated = rating.update_ratings(ratings, opponents, wins)
+    for (mu, sigma), (prior_mu, prior_sigma), (opponent_mu, opponent_sigma), win in zip(
+            updated, ratings, opponents, wins):
+        expected_mu, expected_sigma = benchmark.quadrature_update(
+            prior_mu, prior_sigma, opponent_mu, opponent_sigma, win)
+        assert abs(mu - expected_mu) <= 1e-9 * prior_sigma
+        assert abs(sigma - expected_sigma) <= 1e-9 * prior_sigma
+
+
+def test_update_pairs_rates_both_sides_from_the_prior():
+    heroes, villains = np.array([[1200.0, 400.0], [1000.0, 100.0]]), np.array([[1300.0, 200.0], [1400.0, 300.0]])
+    new_heroes, new_villains = rating.update_pairs(heroes, villains, [True, False])
+    np.testing.assert_array_equal(new_heroes, rating.update_ratings(heroes, villains, [True, False]))
+    np.testing.assert_array_equal(new_villains, rating.update_ratings(villains, heroes, [False, True]))
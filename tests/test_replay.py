@@ -0,0 +1,63 @@
+import datetime
+
+from sqlalchemy import insert, select
+
+from bridge_discord import datastore
+from bridge_discord.datastore import rating
+from bridge_discord.extensions import challenge
+
+from conftest import FakeClient, FakeContext
+
+
+def add_challenges(session, results, start=datetime.datetime(2022, 1, 1)):
+    # results are (hero, villain, hero_total, villain_total), one challenge a day.
+    session.execute(insert(datastore.FriendChallenge.__table__), [
+        dict(created_at=start + datetime.timedelta(days=ix), hero=hero, villain=villain,
+             hero_total=hero_total, villain_total=villain_total, board_count=1)
+        for ix, (hero, villain, hero_total, villain_total) in enumerate(results)
+    ])
+
+
+def ratings(session):
+    return {
+        bbo_user: (mmr_m, mmr_s)
+        for bbo_user, mmr_m, mmr_s in session.execute(
+            select(datastore.BBOProfile.bbo_user, datastore.BBOProfile.mmr_m, datastore.BBOProfile.mmr_s))
+    }
+
+
+def test_replay_resets_players_without_replayed_results(db):
+    initial = (rating.INITIAL_MU, rating.INITIAL_SIGMA)
+    with datastore.Session() as session:
+        session.execute(insert(datastore.BBOProfile.__table__), [
+            dict(bbo_user=bbo_user, mmr_m=1500.0, mmr_s=100.0) for bbo_user in ("a", "b", "idle")])
+        add_challenges(session, [("a", "b", 10, 0)] * 4)
+        assert datastore.replay_mmr(session, checkpoint_interval=2) == 4
+        session.commit()
+        full = ratings(session)
+        assert full["idle"] == initial
+        assert full["a"][0] > rating.INITIAL_MU > full["b"][0]
+
+        # A partial replay restores from a checkpoint that never saw "late"; it starts over as well.
+        session.execute(insert(datastore.BBOProfile.__table__).values(bbo_user="late", mmr_m=1500.0, mmr_s=100.0))
+        assert datastore.replay_mmr(session, since=datetime.datetime(2022, 1, 4), checkpoint_interval=2) == 2
+        session.commit()
+        assert ratings(session) == dict(full, late=initial)
+
+
+def test_replay_command_starts_from_the_checkpoint_before_since(db, loop):
+    with datastore.Session() as session:
+        add_challenges(session, [("a", "b", 10, 0)] * 4)
+        datastore.replay_mmr(session, checkpoint_interval=2)
+        session.commit()
+        full = ratings(session)
+
+    extension = challenge.ChallengeExtension(FakeClient())
+    contexts = [FakeContext(), FakeContext()]
+    loop.run_until_complete(extension.replay_mmr.coro(extension, contexts[0], since="2022-01-04"))
+    loop.run_until_complete(extension.replay_mmr.coro(extension, contexts[1], since="yesterday"))
+    # Only the two challenges after the checkpoint of 2022-01-02 are replayed.
+    assert [ctx.sent for ctx in contexts] == [
+        ["Replayed 2 challenges."], ["`since` must be a date such as 2024-01-31."]]
+    with datastore.Session() as session:
+        assert ratings(session) == full
@@ -0,0 +1,93 @@
+import itertools
+import random
+
+import pytest
+from sqlalchemy import insert, select
+
+from bridge_discord import datastore
+
+from conftest import link
+
+
+@pytest.mark.parametrize("number_of_teams", [3, 4, 7])
+def test_round_robin_pairs_every_team_once_and_rotates_byes(number_of_teams):
+    rounds = datastore.round_robin_schedule(number_of_teams)
+    assert len(rounds) == number_of_teams - 1 + number_of_teams % 2
+    pairs = [frozenset(pair) for pairs in rounds for pair in pairs if None not in pair]
+    assert sorted(map(sorted, pairs)) == sorted(map(sorted, itertools.combinations(range(number_of_teams), 2)))
+    for pairs in rounds:
+        # Every team appears once a round, as home, away or the team with the bye.
+        assert sorted(team for pair in pairs for team in pair if team is not None) == list(range(number_of_teams))
+    byes = [home for pairs in rounds for home, away in pairs if away is None]
+    assert sorted(byes) == (list(range(number_of_teams)) if number_of_teams % 2 else [])
+
+
+def recomputed_standings(session, tournament):
+    # Every standing from scratch, from the totals of the played matches.
+    standings = {team: [0, 0, 0, 0, 0.0, 0.0, 0.0] for team in range(tournament.number_of_teams)}
+    for rr_match in session.execute(
+            select(datastore.TeamRRMatch).where(datastore.TeamRRMatch.tournament_id == tournament.tournament_id)
+    ).scalars():
+        if not rr_match.boards:
+            continue
+        vps = datastore.victory_points(rr_match.home_imps - rr_match.away_imps, rr_match.boards)
+        for team, imps_for, imps_against, team_vps in (
+                (rr_match.home_team, rr_match.home_imps, rr_match.away_imps, vps[0]),
+                (rr_match.away_team, rr_match.away_imps, rr_match.home_imps, vps[1])):
+            standing = standings[team]
+            standing[0] += 1
+            standing[1 + (imps_for == imps_against) + 2 * (imps_for < imps_against)] += 1
+            standing[4] += imps_for
+            standing[5] += imps_against
+            standing[6] += team_vps
+    return standings
+
+
+def stored_standings(session, tournament):
+    return {
+        standing.team_number: [
+            standing.played, standing.won, standing.drawn, standing.lost,
+            standing.imps_for, standing.imps_against, standing.victory_points]
+        for standing in datastore.get_standings(session, tournament)
+    }
+
+
+@pytest.mark.parametrize("number_of_teams", [3, 4, 7])
+def test_incremental_standings_match_a_full_recompute(db, number_of_teams):
+    rng = random.Random(number_of_teams)
+    with datastore.Session() as session:
+        tournament = datastore.TeamRRTournament(
+            state=datastore.TournamentState.STARTED, tournament_name="t", number_of_teams=number_of_teams)
+        session.add(tournament)
+        for team in range(number_of_teams):
+            link(session, team + 1, f"p{team}")
+        session.flush()
+        session.execute(insert(datastore.TeamRREntry.__table__), [
+            dict(tournament_id=tournament.tournament_id, bbo_user=f"p{team}", team_number=team)
+            for team in range(number_of_teams)
+        ])
+        datastore.create_schedule(session, tournament)
+        # Two segments per pair, from either side, some of them drawn.
+        session.execute(insert(datastore.FriendChallenge.__table__), [
+            dict(hero=f"p{hero}", villain=f"p{villain}", hero_total=float(rng.choice([0, 3, 12])),
+                 villain_total=float(rng.choice([0, 3, 5])), board_count=rng.randint(1, 8))
+            for first, second in itertools.combinations(range(number_of_teams), 2)
+            for hero, villain in ((first, second), (second, first))
+        ])
+        challenges = session.execute(select(datastore.FriendChallenge)).scalars().all()
+        for friend_challenge in challenges:
+            assert datastore.record_segment(session, tournament, friend_challenge) is not None
+        session.commit()
+
+        standings = stored_standings(session, tournament)
+        recomputed = recomputed_standings(session, tournament)
+        assert standings.keys() == recomputed.keys()
+        for team, standing in standings.items():
+            assert standing == pytest.approx(recomputed[team])
+        assert {team: standing[0] for team, standing in standings.items()} == {
+            team: number_of_teams - 1 for team in range(number_of_teams)}
+
+        # A challenge recorded twice counts once.
+        assert datastore.record_segment(session, tournament, challenges[0]) is None
+        session.commit()
+        assert stored_standings(session, tournament) == standings
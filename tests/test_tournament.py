@@ -0,0 +1,129 @@
+import asyncio
+
+from sqlalchemy import delete, insert, select, update
+
+from bridge_discord import datastore
+from bridge_discord.extensions import tournament
+
+from conftest import FakeClient, FakeContext, link
+
+
+def started_tournament(entrants=8):
+    with datastore.Session() as session:
+        active = datastore.TeamRRTournament(state=datastore.TournamentState.SIGNUP, tournament_name="t")
+        session.add(active)
+        for ix in range(entrants):
+            link(session, ix + 1, f"u{ix}", mmr_m=1000.0 + 50 * ix)
+        session.flush()
+        for ix in range(entrants):
+            session.add(datastore.TeamRREntry(tournament_id=active.tournament_id, bbo_user=f"u{ix}"))
+        session.commit()
+
+
+async def start(extension, ctx):
+    try:
+        await extension.start.coro(extension, ctx)
+    except ValueError:
+        pass
+
+
+def test_start_is_refused_once_the_tournament_has_started(db, loop):
+    started_tournament()
+    extension = tournament.TeamRRManagerExtension(FakeClient())
+    contexts = [FakeContext(), FakeContext()]
+    loop.run_until_complete(asyncio.gather(*(start(extension, ctx) for ctx in contexts)))
+    assert sorted(ctx.sent[0] for ctx in contexts) == [
+        "The active tournament has already started.", "Tournament has been started and teams have been assigned."]
+
+    with datastore.Session() as session:
+        session.execute(update(datastore.TeamRRStanding).values(played=1))
+        session.commit()
+        teams = session.execute(select(datastore.TeamRREntry.bbo_user, datastore.TeamRREntry.team_number)).all()
+
+    ctx = FakeContext()
+    loop.run_until_complete(start(extension, ctx))
+    assert ctx.sent == ["The active tournament has already started."]
+    with datastore.Session() as session:
+        assert session.execute(select(datastore.TeamRREntry.bbo_user, datastore.TeamRREntry.team_number)).all() == teams
+        assert {standing.played for standing in session.execute(select(datastore.TeamRRStanding)).scalars()} == {1}
+
+
+def test_segments_are_scored_from_the_challenge_totals(db, statements):
+    started_tournament()
+    with datastore.Session() as session:
+        assert tournament.assign_teams(session, datastore.TeamRRTournament.get_active_tournament(session))
+        teams = dict(session.execute(select(datastore.TeamRREntry.team_number, datastore.TeamRREntry.bbo_user)).all())
+        hero, villain = teams[0], teams[1]
+        session.execute(insert(datastore.FriendChallenge.__table__).values(
+            match_id=1, hero=hero, villain=villain, hero_total=20.0, villain_total=5.0, board_count=7))
+        session.commit()
+
+        statements.clear()
+        rr_match = datastore.record_active_segment(session, 1)
+        session.commit()
+        assert not any("bbo_friend_challenge_board" in statement for statement in statements)
+        hero_imps, villain_imps = (
+            (rr_match.home_imps, rr_match.away_imps) if rr_match.home_team == 0
+            else (rr_match.away_imps, rr_match.home_imps))
+        assert (hero_imps, villain_imps, rr_match.boards) == (20.0, 5.0, 7)
+
+
+def add_entrants(first, count, team_count=None):
+    # Enters count more linked players, spread over the teams when team_count is given.
+    with datastore.Session() as session:
+        active = datastore.TeamRRTournament.get_active_tournament(session)
+        for ix in range(first, first + count):
+            link(session, ix + 1, f"u{ix}")
+        session.flush()
+        session.execute(insert(datastore.TeamRREntry.__table__), [
+            dict(tournament_id=active.tournament_id, bbo_user=f"u{ix}",
+                 team_number=ix % team_count if team_count else None)
+            for ix in range(first, first + count)
+        ])
+        datastore.tournament_cache.touch(session)
+        session.commit()
+
+
+def info_statements(loop, extension, statements):
+    # Statements of a warm /info, after a first call has loaded the tournament cache.
+    loop.run_until_complete(extension.info.coro(extension, FakeContext()))
+    statements.clear()
+    ctx = FakeContext()
+    loop.run_until_complete(extension.info.coro(extension, ctx))
+    assert ctx.sent == [None]
+    return len(statements)
+
+
+def test_info_statements_do_not_grow_with_entrants(db, loop, statements):
+    extension = tournament.TeamRRManagerExtension(FakeClient())
+    started_tournament(entrants=8)
+    signup_counts = [info_statements(loop, extension, statements)]
+    add_entrants(8, 40)
+    signup_counts.append(info_statements(loop, extension, statements))
+
+    with datastore.Session() as session:
+        assert tournament.assign_teams(session, datastore.TeamRRTournament.get_active_tournament(session))
+        session.commit()
+    started_counts = [info_statements(loop, extension, statements)]
+    add_entrants(48, 40, team_count=4)
+    started_counts.append(info_statements(loop, extension, statements))
+
+    assert signup_counts[0] == signup_counts[1]
+    assert started_counts[0] == started_counts[1]
+
+
+def test_drop_with_a_stale_participant_list(db, loop):
+    started_tournament()
+    extension = tournament.TeamRRManagerExtension(FakeClient())
+    with datastore.Session() as session:
+        assert "u0" in datastore.tournament_cache.participants(session)
+        # Dropped by another process, whose version stamp this one has not polled yet.
+        session.execute(delete(datastore.TeamRREntry).where(datastore.TeamRREntry.bbo_user == "u0"))
+        session.commit()
+
+    contexts = [FakeContext(), FakeContext()]
+    for ctx in contexts:
+        loop.run_until_complete(extension.drop.coro(extension, ctx))
+    assert [ctx.sent for ctx in contexts] == [["u0 is not currently signed up for the upcoming tournament."]] * 2
+    with datastore.Session() as session:
+        assert "u0" not in datastore.tournament_cache.participants(session)